@@ -0,0 +1,392 @@
+import json
+import re
+import threading
+
+import boto3
+import psycopg2
+
+from object_store import LocalObjectStore, S3ObjectStore
+from settings import load_settings
+
+REDSHIFT = 'redshift'
+DUCKDB = 'duckdb'
+BACKENDS = [REDSHIFT, DUCKDB]
+
+# Redshift-only DDL that has no local equivalent. Constraints are dropped because Redshift does not
+# enforce them either, so the local engine accepts exactly the rows Redshift would.
+DDL_TRANSLATIONS = [
+    (re.compile(r'\b(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\bDISTKEY\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\bDISTSTYLE\s+(ALL|EVEN|KEY|AUTO)\b', re.IGNORECASE), ''),
+    (re.compile(r'\b(SORTKEY|DISTKEY)\b', re.IGNORECASE), ''),
+    (re.compile(r'\bENCODE\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\bPRIMARY\s+KEY\b', re.IGNORECASE), ''),
+    (re.compile(r'\bUNIQUE\b', re.IGNORECASE), ''),
+]
+
+SQL_TRANSLATIONS = [
+    (re.compile(r'\bGETDATE\(\)', re.IGNORECASE), 'CURRENT_TIMESTAMP'),
+    (re.compile(r'\bSYSDATE\b', re.IGNORECASE), 'CURRENT_TIMESTAMP'),
+    (re.compile(r'\bOCTET_LENGTH\(', re.IGNORECASE), 'strlen('),
+]
+
+# Redshift functions without a DuckDB equivalent. FNV_HASH only needs to be a stable BIGINT hash locally.
+DUCKDB_MACROS = [
+    "CREATE OR REPLACE MACRO fnv_hash(value) AS CAST(hash(value) >> 1 AS BIGINT)",
+]
+
+COPY_PATTERN = re.compile(
+    r"^\s*COPY\s+(?P<table>\w+)\s*(\((?P<columns>[^)]*)\))?\s+FROM\s+'(?P<source>[^']*)'(?P<options>.*)$",
+    re.IGNORECASE | re.DOTALL)
+# DuckDB has no LOCK. A local database is only written by one process at a time, so there is nothing to wait for.
+LOCK_PATTERN = re.compile(r"^\s*LOCK\b", re.IGNORECASE)
+CSV_OPTION_PATTERN = re.compile(r"\bCSV\b", re.IGNORECASE)
+PARQUET_OPTION_PATTERN = re.compile(r"\bFORMAT\s+(AS\s+)?PARQUET\b", re.IGNORECASE)
+JSON_OPTION_PATTERN = re.compile(r"\bjson\s+'(?P<format>[^']*)'", re.IGNORECASE)
+JSONPATH_PATTERN = re.compile(r"^\$(?:\['([^']+)'\]|\[\"([^\"]+)\"\]|\.(\w+))$")
+TEXT_TYPES = ('VARCHAR', 'TEXT', 'CHAR')
+
+
+def translate_sql(query):
+    """Translates a Redshift statement into DuckDB SQL.
+
+    Parameters:
+        query(str): The Redshift statement(s).
+
+    Returns:
+        str: The equivalent DuckDB statement(s).
+    """
+    if re.match(r'^\s*CREATE\s+(TEMP\s+|TEMPORARY\s+)?TABLE', query, re.IGNORECASE) and '(' in query:
+        for pattern, replacement in DDL_TRANSLATIONS:
+            query = pattern.sub(replacement, query)
+    for pattern, replacement in SQL_TRANSLATIONS:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def quote_literal(value):
+    """Renders a python value as a SQL literal the same way psycopg2 would for a parameter.
+
+    Parameters:
+        value(object): The parameter value.
+
+    Returns:
+        str: The SQL literal.
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def bind_params(query, params):
+    """Substitutes psycopg2 style %s parameters into a statement as literals.
+
+    Parameters:
+        query(str): The statement with %s placeholders.
+        params(tuple): The parameter values.
+
+    Returns:
+        str: The statement with the parameters inlined.
+    """
+    if params is None:
+        return query
+    values = iter(params)
+    return re.sub(r'%(s|%)', lambda m: quote_literal(next(values)) if m.group(1) == 's' else '%', query)
+
+
+def parse_jsonpath(path):
+    """Extracts the top-level key from a jsonpaths expression such as $['artist'].
+
+    Parameters:
+        path(str): The jsonpaths expression.
+
+    Returns:
+        str: The JSON key the expression selects.
+
+    Raises:
+        ValueError: If the expression selects anything other than a top-level key.
+    """
+    match = JSONPATH_PATTERN.match(path.strip())
+    if match is None:
+        raise ValueError("Only top-level jsonpaths are supported locally, got {}".format(path))
+    return next(group for group in match.groups() if group is not None)
+
+
+class DuckDBCursor:
+    """A psycopg2 style cursor over a DuckDB connection that also emulates Redshift COPY from local files."""
+
+    def __init__(self, connection, store):
+        self.connection = connection
+        self.store = store
+        self.rowcount = -1
+        self.result = None
+
+    def execute(self, query, params=None):
+        """Executes a Redshift statement, translating it, running COPY against the local object store and
+        skipping LOCK.
+
+        Parameters:
+            query(str): The statement(s) to execute.
+            params(tuple): Optional psycopg2 style parameters.
+        """
+        query = bind_params(query, params)
+        if LOCK_PATTERN.match(query):
+            self.result = None
+            self.rowcount = -1
+            return
+        copy = COPY_PATTERN.match(query)
+        if copy is not None:
+            self.result = None
+            self.rowcount = self.copy(copy)
+            return
+
+        self.result = self.connection.execute(translate_sql(query))
+        self.rowcount = -1
+        last_statement = [statement for statement in query.split(';') if statement.strip()][-1]
+        if re.match(r'^\s*(INSERT|UPDATE|DELETE)\b', last_statement, re.IGNORECASE):
+            self.rowcount = self.result.fetchone()[0]
+            self.result = None
+
+    def executemany(self, query, params_list):
+        """Executes a statement once for each set of parameters.
+
+        Parameters:
+            query(str): The statement to execute.
+            params_list(list of tuple): The parameters for each execution.
+        """
+        for params in params_list:
+            self.execute(query, params)
+
+    @property
+    def description(self):
+        return self.result.description if self.result is not None else None
+
+    def fetchone(self):
+        return self.result.fetchone()
+
+    def fetchall(self):
+        return self.result.fetchall()
+
+    def fetchmany(self, size):
+        return self.result.fetchmany(size)
+
+    def close(self):
+        self.result = None
+
+    def table_columns(self, table):
+        """Lists the columns of a table in declaration order.
+
+        The name is resolved like any other statement would resolve it, so a TEMP table shadows the table of the
+        same name in the current schema, as it does on Redshift.
+
+        Parameters:
+            table(str): The table name.
+
+        Returns:
+            list of tuple: The (column name, data type) of each column.
+        """
+        return [row[:2] for row in self.connection.execute("DESCRIBE {}".format(table)).fetchall()]
+
+    def resolve_files(self, source, manifest):
+        """Lists the local files a COPY reads, either every object under the prefix or the manifest entries.
+
+        Parameters:
+            source(str): The s3:// prefix or manifest uri from the COPY statement.
+            manifest(bool): Whether the source is a manifest.
+
+        Returns:
+            list of str: The local paths of the files to load.
+        """
+        if manifest:
+            entries = json.loads(self.store.get_object(source))['entries']
+            uris = [entry['url'] for entry in entries]
+        else:
+            uris = [uri for uri, _ in self.store.list_objects(source)]
+        return [self.store.local_path(uri) for uri in uris]
+
+    def copy(self, match):
+        """Emulates a Redshift JSON, Parquet or CSV COPY by reading the matching local files with DuckDB.
+
+        Parameters:
+            match(re.Match): The parsed COPY statement.
+
+        Returns:
+            int: The number of rows loaded.
+        """
+        table = match.group('table')
+        options = match.group('options')
+        columns = self.table_columns(table)
+        if match.group('columns'):
+            wanted = [name.strip().lower() for name in match.group('columns').split(',')]
+            columns = [column for name in wanted for column in columns if column[0].lower() == name]
+
+        files = self.resolve_files(match.group('source'), re.search(r'\bmanifest\b', options, re.IGNORECASE))
+        if not files:
+            return 0
+
+        if PARQUET_OPTION_PATTERN.search(options):
+            # Like Redshift, Parquet columns are matched to the table columns by position.
+            read_parquet = "read_parquet([{}], hive_partitioning = false)".format(
+                ', '.join(quote_literal(path) for path in files))
+            result = self.connection.execute("INSERT INTO {} ({}) SELECT * FROM {}".format(
+                table, ', '.join(name for name, _ in columns), read_parquet))
+            return result.fetchone()[0]
+
+        if CSV_OPTION_PATTERN.search(options):
+            read_csv = "read_csv([{}], header = false, all_varchar = true)".format(
+                ', '.join(quote_literal(path) for path in files))
+            result = self.connection.execute("INSERT INTO {} ({}) SELECT * FROM {}".format(
+                table, ', '.join(name for name, _ in columns), read_csv))
+            return result.fetchone()[0]
+
+        json_format = JSON_OPTION_PATTERN.search(options)
+        if json_format is None:
+            raise NotImplementedError("Only JSON, Parquet and CSV COPY are supported locally: {}".format(
+                options.strip()))
+        if json_format.group('format').lower() == 'auto':
+            keys = [name.lower() for name, _ in columns]
+        else:
+            jsonpaths = json.loads(self.store.get_object(json_format.group('format')))['jsonpaths']
+            keys = [parse_jsonpath(path) for path in jsonpaths]
+            if len(keys) != len(columns):
+                raise ValueError("{} jsonpaths for {} columns of {}".format(len(keys), len(columns), table))
+
+        selects = []
+        for key, (_, data_type) in zip(keys, columns):
+            value = '"{}"'.format(key)
+            if not data_type.upper().startswith(TEXT_TYPES):
+                value = "NULLIF({}, '')".format(value)
+            selects.append(value)
+        read_json = "read_json([{}], columns={{{}}}, format='auto')".format(
+            ', '.join(quote_literal(path) for path in files),
+            ', '.join("{}: 'VARCHAR'".format(quote_literal(key)) for key in keys))
+        result = self.connection.execute("INSERT INTO {} ({}) SELECT {} FROM {}".format(
+            table, ', '.join(name for name, _ in columns), ', '.join(selects), read_json))
+        return result.fetchone()[0]
+
+
+class DuckDBConnection:
+    """A psycopg2 style connection to a local DuckDB database.
+
+    DuckDB runs in autocommit mode here, so commit is a no-op and rollback only undoes an explicit BEGIN.
+    """
+
+    def __init__(self, connection, store):
+        self.connection = connection
+        self.store = store
+
+    def cursor(self):
+        return DuckDBCursor(self.connection, self.store)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        try:
+            self.connection.rollback()
+        except Exception:
+            pass
+
+    def close(self):
+        self.connection.close()
+
+
+class DuckDBPool:
+    """A psycopg2 style connection pool handing out one DuckDB cursor connection per borrower."""
+
+    def __init__(self, connection, store):
+        self.connection = connection
+        self.store = store
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            return DuckDBConnection(self.connection.cursor(), self.store)
+
+    def putconn(self, conn):
+        conn.close()
+
+    def closeall(self):
+        self.connection.close()
+
+
+def get_dsn(config):
+    """Builds the psycopg2 connection string from the [CLUSTER] section of dwh.cfg.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        str: The connection string.
+    """
+    return "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+
+
+def open_duckdb(config):
+    """Opens the local DuckDB database and object store configured in the [LOCAL] section of dwh.cfg.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        tuple: The raw duckdb connection and the LocalObjectStore holding the source data.
+    """
+    import duckdb
+
+    connection = duckdb.connect(config['LOCAL']['DATABASE'])
+    for macro in DUCKDB_MACROS:
+        connection.execute(macro)
+    return connection, get_object_store(config, DUCKDB)
+
+
+def get_object_store(config, backend=REDSHIFT):
+    """Returns the object store holding the source data for the chosen backend.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' for S3 in the REGION of [S3], 'duckdb' for the local DATA_ROOT directory in [LOCAL].
+
+    Returns:
+        object store: An S3ObjectStore or LocalObjectStore.
+    """
+    if backend == DUCKDB:
+        return LocalObjectStore(config['LOCAL']['DATA_ROOT'])
+    return S3ObjectStore(boto3.client('s3', region_name=load_settings().s3.region))
+
+
+def connect(config, backend=REDSHIFT):
+    """Opens a connection to the data warehouse on the chosen backend.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' for the cluster in [CLUSTER], 'duckdb' for the local engine in [LOCAL].
+
+    Returns:
+        connection: A psycopg2 connection, or a DuckDBConnection with the same interface.
+    """
+    if backend == DUCKDB:
+        connection, store = open_duckdb(config)
+        return DuckDBConnection(connection, store)
+    return psycopg2.connect(get_dsn(config))
+
+
+def create_pool(config, max_connections, backend=REDSHIFT):
+    """Creates a thread-safe connection pool on the chosen backend.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        max_connections(int): The maximum number of connections the pool hands out.
+        backend(str): 'redshift' or 'duckdb'.
+
+    Returns:
+        connection pool: An object with getconn, putconn and closeall.
+    """
+    if backend == DUCKDB:
+        connection, store = open_duckdb(config)
+        return DuckDBPool(connection, store)
+
+    import psycopg2.pool
+
+    return psycopg2.pool.ThreadedConnectionPool(1, max_connections, get_dsn(config))
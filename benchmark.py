@@ -0,0 +1,309 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from backends import DUCKDB_MACROS, DuckDBConnection
+from create_tables import create_tables, drop_tables
+from etl import insert_tables, load_staging_tables
+from object_store import LocalObjectStore
+
+# Rows generated at scale 1x, roughly the size of the udacity-dend sample data.
+BASE_SONGS = 1000
+BASE_EVENTS = 10000
+BASE_USERS = 100
+DAYS = 30
+
+BUCKET = 's3://udacity-dend'
+LOG_JSONPATHS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level',
+                 'location', 'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent',
+                 'userId']
+STAGING_TABLES = ['staging_events', 'staging_songs']
+FINAL_TABLES = ['fact_songplays', 'dim_users', 'dim_songs', 'dim_artists', 'dim_times']
+
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Atlanta-Sandy Springs-Roswell, GA', 'Lansing-East Lansing, MI',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Chicago-Naperville-Elgin, IL-IN-WI']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko)"',
+               'Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0']
+PAGES = ['NextSong'] * 8 + ['Home', 'Logout']
+
+
+def generate_songs(store, count, rng):
+    """Writes synthetic song_data objects, one song per file like the udacity-dend layout.
+
+    Parameters:
+        store(LocalObjectStore): The store to write song_data into.
+        count(int): The number of songs to generate.
+        rng(random.Random): The seeded random generator.
+
+    Returns:
+        list of dict: The generated songs, for the event generator to reference.
+    """
+    songs = []
+    artists = max(count // 3, 1)
+    for index in range(count):
+        artist = index % artists
+        song = {
+            "num_songs": 1,
+            "artist_id": "AR{:016X}".format(artist),
+            "artist_latitude": round(rng.uniform(-90, 90), 5) if artist % 2 else None,
+            "artist_longitude": round(rng.uniform(-180, 180), 5) if artist % 2 else None,
+            "artist_location": rng.choice(LOCATIONS) if artist % 3 else "",
+            "artist_name": "Artist {}".format(artist),
+            "song_id": "SO{:016X}".format(index),
+            "title": "Song {}".format(index),
+            "duration": round(rng.uniform(60, 600), 5),
+            "year": rng.choice([0, rng.randint(1960, 2018)]),
+        }
+        key = "TR{:016X}".format(index)
+        store.put_object("{}/song_data/{}/{}/{}/{}.json".format(BUCKET, key[2], key[3], key[4], key),
+                         json.dumps(song))
+        songs.append(song)
+    return songs
+
+
+def generate_events(store, count, users, songs, rng):
+    """Writes synthetic log_data objects, one newline-delimited JSON file per day.
+
+    Parameters:
+        store(LocalObjectStore): The store to write log_data into.
+        count(int): The number of events to generate.
+        users(int): The number of distinct users.
+        songs(list of dict): The songs that NextSong events play.
+        rng(random.Random): The seeded random generator.
+    """
+    start = datetime.datetime(2018, 11, 1)
+    per_day = max(count // DAYS, 1)
+    user_profiles = [(str(user + 1), "First{}".format(user), "Last{}".format(user), rng.choice('MF'))
+                     for user in range(users)]
+    session = 0
+    for day in range(DAYS):
+        date = start + datetime.timedelta(days=day)
+        day_ms = int((date - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+        lines = []
+        item = 0
+        for event in range(per_day if day < DAYS - 1 else count - per_day * (DAYS - 1)):
+            if item == 0 or rng.random() < 0.05:
+                session += 1
+                item = 0
+                user_id, first_name, last_name, gender = rng.choice(user_profiles)
+                level = rng.choice(['free', 'paid'])
+            page = rng.choice(PAGES)
+            song = rng.choice(songs) if page == 'NextSong' else None
+            logged_in = page != 'Logout' or rng.random() < 0.5
+            lines.append(json.dumps({
+                "artist": song["artist_name"] if song else None,
+                "auth": "Logged In" if logged_in else "Logged Out",
+                "firstName": first_name if logged_in else None,
+                "gender": gender if logged_in else None,
+                "itemInSession": item,
+                "lastName": last_name if logged_in else None,
+                "length": song["duration"] if song else None,
+                "level": level,
+                "location": rng.choice(LOCATIONS),
+                "method": "PUT" if song else "GET",
+                "page": page,
+                "registration": 1.540919166796E12,
+                "sessionId": session % 32767,
+                "song": song["title"] if song else None,
+                "status": 200,
+                "ts": day_ms + event * (86400000 // per_day),
+                "userAgent": rng.choice(USER_AGENTS),
+                "userId": user_id if logged_in else "",
+            }))
+            item += 1
+        store.put_object("{}/log_data/{:%Y/%m}/{:%Y-%m-%d}-events.json".format(BUCKET, date, date),
+                         "\n".join(lines) + "\n")
+
+
+def generate_dataset(root, scale, seed=0):
+    """Generates a synthetic udacity-dend bucket, including log_json_path.json, at the given scale.
+
+    Parameters:
+        root(str): The directory to use as the local object store root.
+        scale(int): The multiple of the base row counts to generate.
+        seed(int): The random seed, so that runs are comparable between commits.
+
+    Returns:
+        LocalObjectStore: The store holding the generated data.
+    """
+    rng = random.Random(seed)
+    store = LocalObjectStore(root)
+    store.put_object(BUCKET + '/log_json_path.json',
+                     json.dumps({"jsonpaths": ["$['{}']".format(key) for key in LOG_JSONPATHS]}))
+    songs = generate_songs(store, BASE_SONGS * scale, rng)
+    generate_events(store, BASE_EVENTS * scale, BASE_USERS * scale, songs, rng)
+    return store
+
+
+def count_rows(cur, tables):
+    """Counts the rows across the given tables.
+
+    Parameters:
+        cur(cursor): The cursor to count with.
+        tables(list of str): The table names.
+
+    Returns:
+        int: The total number of rows.
+    """
+    total = 0
+    for table in tables:
+        cur.execute("SELECT COUNT(*) FROM {}".format(table))
+        total += cur.fetchone()[0]
+    return total
+
+
+def peak_memory_mb():
+    """Returns the peak resident set size of this process so far.
+
+    Returns:
+        float: The peak RSS in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_stage(results, scale, stage, function, cur, conn, tables):
+    """Runs one pipeline stage and records its timing, throughput and memory high-water mark.
+
+    Parameters:
+        results(list of dict): The list to append the stage result to.
+        scale(int): The scale the data was generated at.
+        stage(str): The name of the stage.
+        function(function): The stage to run, called as function(cur, conn).
+        cur(cursor): The cursor to run the stage with.
+        conn(connection): The connection to run the stage with.
+        tables(list of str): The tables the stage writes, used to count the rows it produced.
+    """
+    start = time.perf_counter()
+    function(cur, conn)
+    seconds = time.perf_counter() - start
+    rows = count_rows(cur, tables) if tables else 0
+    results.append({
+        "scale": scale,
+        "stage": stage,
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+        "peak_memory_mb": round(peak_memory_mb(), 1),
+    })
+    print("{:>4}x {:<20} {:>10.3f}s {:>12} rows".format(scale, stage, seconds, rows))
+
+
+def run_scale(scale, data_dir, seed):
+    """Generates data at one scale and runs the full pipeline on a fresh local DuckDB database.
+
+    Parameters:
+        scale(int): The multiple of the base row counts to generate.
+        data_dir(str): The directory to generate data and the database in.
+        seed(int): The random seed.
+
+    Returns:
+        list of dict: The result of each stage.
+    """
+    import duckdb
+
+    results = []
+    root = os.path.join(data_dir, "{}x".format(scale))
+    start = time.perf_counter()
+    store = generate_dataset(root, scale, seed)
+    print("{:>4}x {:<20} {:>10.3f}s".format(scale, 'generate', time.perf_counter() - start))
+
+    connection = duckdb.connect(os.path.join(root, 'benchmark.duckdb'))
+    for macro in DUCKDB_MACROS:
+        connection.execute(macro)
+    conn = DuckDBConnection(connection, store)
+    cur = conn.cursor()
+    run_stage(results, scale, 'drop_tables', drop_tables, cur, conn, [])
+    run_stage(results, scale, 'create_tables', create_tables, cur, conn, [])
+    run_stage(results, scale, 'load_staging_tables', load_staging_tables, cur, conn, STAGING_TABLES)
+    run_stage(results, scale, 'insert_tables', insert_tables, cur, conn, FINAL_TABLES)
+    conn.close()
+    return results
+
+
+def run_scale_in_subprocess(scale, data_dir, seed):
+    """Runs a scale in a fresh interpreter so that its peak memory is not inflated by earlier scales.
+
+    Parameters:
+        scale(int): The multiple of the base row counts to generate.
+        data_dir(str): The directory to generate data and the database in.
+        seed(int): The random seed.
+
+    Returns:
+        list of dict: The result of each stage.
+    """
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-scale', str(scale), '--data-dir', data_dir,
+         '--seed', str(seed)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    lines = output.splitlines()
+    print("\n".join(lines[:-1]))
+    return json.loads(lines[-1])
+
+
+def current_commit():
+    """Returns the git commit the benchmark is running on, if any.
+
+    Returns:
+        str: The commit hash, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """The main function for benchmark.py.
+
+    Generates synthetic song and log data at each requested scale, runs the full pipeline against the local
+    DuckDB engine and writes the per-stage timing, rows/sec and peak memory to a JSON results file.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the ETL pipeline on synthetic data.")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help="multiples of the base data size to benchmark")
+    parser.add_argument('--output', default='benchmark_results.json', help="the JSON results file to write")
+    parser.add_argument('--data-dir', help="where to generate data, defaults to a temporary directory")
+    parser.add_argument('--seed', type=int, default=0, help="the random seed for the data generator")
+    parser.add_argument('--run-scale', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scale is not None:
+        print(json.dumps(run_scale(args.run_scale, args.data_dir, args.seed)))
+        return
+
+    import duckdb
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        data_dir = args.data_dir or temporary_dir
+        results = []
+        for scale in args.scales:
+            results.extend(run_scale_in_subprocess(scale, data_dir, args.seed))
+
+    report = {
+        "commit": current_commit(),
+        "created_at": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "duckdb": duckdb.__version__,
+        "base_rows": {"songs": BASE_SONGS, "events": BASE_EVENTS, "users": BASE_USERS},
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
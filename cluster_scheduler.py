@@ -0,0 +1,193 @@
+import argparse
+import configparser
+import math
+
+from botocore.waiter import WaiterModel, create_waiter_with_client
+
+import etl
+import iac
+from backends import BACKENDS, REDSHIFT, connect, get_object_store
+from etl import EVENTS_SOURCE, SONGS_SOURCE, get_loaded_objects
+from settings import load_aws_settings
+
+# Redshift has no waiter for a paused cluster, so one is defined the way botocore defines cluster_available.
+PAUSED_WAITER_MODEL = WaiterModel({
+    'version': 2,
+    'waiters': {
+        'ClusterPaused': {
+            'operation': 'DescribeClusters',
+            'delay': iac.WAITER_CONFIG['Delay'],
+            'maxAttempts': iac.WAITER_CONFIG['MaxAttempts'],
+            'acceptors': [
+                {'state': 'success', 'matcher': 'pathAll', 'argument': 'Clusters[].ClusterStatus',
+                 'expected': 'paused'},
+                {'state': 'failure', 'matcher': 'pathAny', 'argument': 'Clusters[].ClusterStatus',
+                 'expected': 'deleting'},
+            ],
+        },
+    },
+})
+AFTER_ACTIONS = ('pause', 'resize', 'none')
+
+
+def measure_staging_bytes(store, config, loaded=None):
+    """Sums the size of the song and log objects a run will stage.
+
+    Parameters:
+        store(object store): The object store holding the source data.
+        config(ConfigParser): The parsed dwh.cfg.
+        loaded(dict): The uris already loaded per source, for an incremental run, or None for a full run.
+
+    Returns:
+        int: The bytes to stage.
+    """
+    loaded = loaded or {}
+    total = 0
+    for source, prefix in ((SONGS_SOURCE, config['S3']['SONG_DATA']), (EVENTS_SOURCE, config['S3']['LOG_DATA'])):
+        skipped = loaded.get(source, set())
+        total += sum(size for uri, size in store.list_objects(prefix.strip("'")) if uri not in skipped)
+    return total
+
+
+def choose_node_count(staging_bytes, current_nodes, scaling):
+    """Picks the node count for a run from the bytes it stages.
+
+    Each node is given BYTES_PER_NODE of input, within MIN_NODES and MAX_NODES. Elastic resize can at most
+    double or halve a cluster in one step, so the count is also kept within that range of the current size.
+
+    Parameters:
+        staging_bytes(int): The bytes the run will stage.
+        current_nodes(int): The current node count of the cluster.
+        scaling(SectionProxy): The [SCALING] section of dwh.cfg.
+
+    Returns:
+        int: The node count.
+    """
+    nodes = math.ceil(staging_bytes / scaling.getint('BYTES_PER_NODE'))
+    nodes = min(max(nodes, scaling.getint('MIN_NODES')), scaling.getint('MAX_NODES'))
+    return min(max(nodes, math.ceil(current_nodes / 2)), current_nodes * 2)
+
+
+def resume_cluster(redshift_resource, cluster_identifier):
+    """Resumes the cluster if it is paused and waits until it is available.
+
+    Parameters:
+        redshift_resource(boto3 resource): The Redshift Resource that contains the DWH cluster.
+        cluster_identifier(str): The DWH identifier on Redshift.
+
+    Returns:
+        dict: The cluster details once it is available.
+    """
+    cluster_props = iac.get_redshift_cluster_props(redshift_resource, cluster_identifier)
+    if cluster_props is None:
+        raise RuntimeError("Cluster {} does not exist, run iac.py first".format(cluster_identifier))
+    if cluster_props['ClusterStatus'] == 'paused':
+        print("Resuming Redshift Cluster")
+        redshift_resource.resume_cluster(ClusterIdentifier=cluster_identifier)
+    return iac.wait_for_cluster(redshift_resource, cluster_identifier)
+
+
+def resize_cluster(redshift_resource, cluster_identifier, nodes):
+    """Elastic resizes the cluster to a node count, if it has a different one, and waits until it is available.
+
+    Parameters:
+        redshift_resource(boto3 resource): The Redshift Resource that contains the DWH cluster.
+        cluster_identifier(str): The DWH identifier on Redshift.
+        nodes(int): The node count.
+
+    Returns:
+        bool: Whether the cluster was resized.
+    """
+    cluster_props = iac.wait_for_cluster(redshift_resource, cluster_identifier)
+    if cluster_props['NumberOfNodes'] == nodes:
+        return False
+    print("Resizing Redshift Cluster from {} to {} nodes".format(cluster_props['NumberOfNodes'], nodes))
+    redshift_resource.resize_cluster(ClusterIdentifier=cluster_identifier, NumberOfNodes=nodes, Classic=False)
+    iac.wait_for_cluster(redshift_resource, cluster_identifier)
+    return True
+
+
+def pause_cluster(redshift_resource, cluster_identifier):
+    """Pauses the cluster, so only its storage is billed, and waits until it is paused.
+
+    Parameters:
+        redshift_resource(boto3 resource): The Redshift Resource that contains the DWH cluster.
+        cluster_identifier(str): The DWH identifier on Redshift.
+    """
+    print("Pausing Redshift Cluster")
+    redshift_resource.pause_cluster(ClusterIdentifier=cluster_identifier)
+    create_waiter_with_client('ClusterPaused', PAUSED_WAITER_MODEL, redshift_resource).wait(
+        ClusterIdentifier=cluster_identifier)
+
+
+def run_scaled(redshift_resource, cluster_identifier, config, etl_args, backend=REDSHIFT, incremental=False,
+               after='pause', nodes=None):
+    """Scales the cluster for one ETL run, runs it and scales the cluster back down.
+
+    The cluster is resumed if it is paused and resized to a node count picked from the bytes the run stages.
+    Once the run finishes, whether or not it succeeds, the cluster is paused, or resized to BASE_NODES.
+
+    Parameters:
+        redshift_resource(boto3 resource): The Redshift Resource that contains the DWH cluster.
+        cluster_identifier(str): The DWH identifier on Redshift.
+        config(ConfigParser): The parsed dwh.cfg.
+        etl_args(list of str): The arguments to run etl.py with.
+        backend(str): The backend etl.py runs against.
+        incremental(bool): Whether the run is incremental, so only objects not yet loaded are measured.
+        after(str): 'pause', 'resize' or 'none'.
+        nodes(int): The node count to use instead of the measured one.
+    """
+    scaling = config['SCALING']
+    current_nodes = resume_cluster(redshift_resource, cluster_identifier)['NumberOfNodes']
+
+    if nodes is None:
+        loaded = None
+        if incremental:
+            conn = connect(config, backend)
+            cur = conn.cursor()
+            loaded = {source: get_loaded_objects(cur, source) for source in (SONGS_SOURCE, EVENTS_SOURCE)}
+            conn.close()
+        staging_bytes = measure_staging_bytes(get_object_store(config, backend), config, loaded)
+        nodes = choose_node_count(staging_bytes, current_nodes, scaling)
+        print("Staging {:,.1f} MB on {} nodes".format(staging_bytes / 1e6, nodes))
+
+    try:
+        resize_cluster(redshift_resource, cluster_identifier, nodes)
+        etl.main(etl_args)
+    finally:
+        if after == 'pause':
+            pause_cluster(redshift_resource, cluster_identifier)
+        elif after == 'resize':
+            resize_cluster(redshift_resource, cluster_identifier, scaling.getint('BASE_NODES'))
+
+
+def main():
+    """The main function for cluster_scheduler.py.
+
+    Runs etl.py on a cluster sized for the run by the [SCALING] section of dwh.cfg. Arguments it does not know
+    are passed on to etl.py, e.g. python cluster_scheduler.py --incremental --maintain, and are checked before the
+    cluster is resized.
+    """
+    parser = argparse.ArgumentParser(description="Scale the cluster up for an ETL run and back down after it.")
+    parser.add_argument('--after', choices=AFTER_ACTIONS,
+                        help="pause the cluster, resize it to BASE_NODES or leave it after the run "
+                             "(AFTER in [SCALING] by default)")
+    parser.add_argument('--nodes', type=int, help="the node count to run with instead of the measured one")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only load objects and events that are new since the previous run")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse etl.py runs against: the Redshift cluster or the local DuckDB engine")
+    args, etl_args = parser.parse_known_args()
+    if args.incremental:
+        etl_args.append('--incremental')
+    etl_args += ['--backend', args.backend]
+    etl.parse_args(etl_args)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    run_scaled(iac.create_redshift_resource(), load_aws_settings().cluster_identifier, config, etl_args, args.backend,
+               args.incremental, args.after or config['SCALING']['AFTER'], args.nodes)
+
+
+if __name__ == "__main__":
+    main()
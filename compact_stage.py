@@ -0,0 +1,183 @@
+import argparse
+import configparser
+import gzip
+import heapq
+import math
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import iac
+from backends import BACKENDS, REDSHIFT, get_object_store
+from object_store import build_manifest
+from parquet_stage import clear_prefix
+from settings import load_aws_settings
+
+# Slices per node of each node type. COPY loads one file per slice at a time.
+SLICES_PER_NODE = {'dc2.large': 2, 'dc2.8xlarge': 16, 'ds2.xlarge': 2, 'ds2.8xlarge': 16, 'ra3.large': 2,
+                   'ra3.xlplus': 2, 'ra3.4xlarge': 4, 'ra3.16xlarge': 16}
+# The smallest slice count of any node type, for node types missing above.
+DEFAULT_SLICES_PER_NODE = 2
+# Uncompressed bytes per compacted file. Redshift recommends files of 1 MB to 1 GB after compression.
+TARGET_FILE_BYTES = 128 * 1024 * 1024
+MAX_WORKERS = 8
+
+
+def cluster_slices(backend=REDSHIFT):
+    """Returns the number of slices that load files in parallel.
+
+    Parameters:
+        backend(str): 'redshift' for the cluster in aws_cred.cfg, 'duckdb' for the local engine, which reads
+            files with one thread per core.
+
+    Returns:
+        int: The slice count.
+    """
+    if backend != REDSHIFT:
+        return os.cpu_count() or 1
+    cluster_props = iac.get_redshift_cluster_props(iac.create_redshift_resource(),
+                                                   load_aws_settings().cluster_identifier)
+    return cluster_props['NumberOfNodes'] * SLICES_PER_NODE.get(cluster_props['NodeType'], DEFAULT_SLICES_PER_NODE)
+
+
+def plan_files(objects, slices, target_file_bytes=TARGET_FILE_BYTES):
+    """Groups small objects into files of about target_file_bytes, as many as a multiple of the slice count.
+
+    Objects are assigned largest first to whichever file is currently smallest, so every slice gets about the
+    same number of bytes to load. Objects are never split, so when there are fewer objects than the files
+    wanted, the count drops to the largest multiple of the slice count they can fill; with fewer objects than
+    slices, every object becomes its own file and some slices load nothing.
+
+    Parameters:
+        objects(list of tuple): The (uri, size in bytes) of each object, as returned by list_objects.
+        slices(int): The number of slices loading the files.
+        target_file_bytes(int): The uncompressed size to aim for per file.
+
+    Returns:
+        list of list of str: The sorted object uris of each non-empty file, none for no objects.
+    """
+    if not objects:
+        return []
+    total = sum(size for _, size in objects)
+    count = math.ceil(max(math.ceil(total / target_file_bytes), 1) / slices) * slices
+    if count > len(objects):
+        count = len(objects) // slices * slices or len(objects)
+    files = [(0, index, []) for index in range(count)]
+    for uri, size in sorted(objects, key=lambda item: (-item[1], item[0])):
+        file_size, index, uris = heapq.heappop(files)
+        uris.append(uri)
+        heapq.heappush(files, (file_size + size, index, uris))
+    return [sorted(uris) for _, _, uris in sorted(files, key=lambda item: item[1]) if uris]
+
+
+def write_compacted(store, uris, output_uri):
+    """Concatenates newline-delimited JSON objects into one gzipped object.
+
+    The gzip is streamed into a temporary file, so only one source object is held in memory at a time.
+
+    Parameters:
+        store(object store): The object store holding the objects and the output.
+        uris(list of str): The objects to concatenate.
+        output_uri(str): The uri of the gzipped object.
+
+    Returns:
+        int: The size of the gzipped object in bytes.
+    """
+    with tempfile.TemporaryFile() as output:
+        with gzip.GzipFile(fileobj=output, mode='wb') as f:
+            for uri in uris:
+                source = store.get_object(uri)
+                f.write(source)
+                if source and not source.endswith(b'\n'):
+                    f.write(b'\n')
+        size = output.tell()
+        output.seek(0)
+        store.put_object(output_uri, output)
+    return size
+
+
+def compact_prefix(store, prefix_uri, output_prefix, manifest_uri, slices, target_file_bytes=TARGET_FILE_BYTES,
+                   max_workers=MAX_WORKERS):
+    """Merges the objects under a prefix into slice-aligned gzipped files and writes a manifest of them.
+
+    Parameters:
+        store(object store): The object store holding the source data and the output.
+        prefix_uri(str): The s3:// prefix of the source data.
+        output_prefix(str): The s3:// prefix to write the gzipped files under.
+        manifest_uri(str): The uri of the manifest to write.
+        slices(int): The number of slices loading the files.
+        target_file_bytes(int): The uncompressed size to aim for per file.
+        max_workers(int): The number of files to write at the same time.
+
+    Returns:
+        tuple: The number of source objects, their size in bytes, and the sizes of the gzipped files. Without
+            source objects nothing is written, since COPY rejects a manifest without entries.
+    """
+    clear_prefix(store, output_prefix)
+    objects = store.list_objects(prefix_uri)
+    groups = plan_files(objects, slices, target_file_bytes)
+    if not groups:
+        return 0, 0, []
+    output_uris = ["{}/part-{:05d}.json.gz".format(output_prefix.rstrip('/'), index) for index in range(len(groups))]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        sizes = list(pool.map(lambda args: write_compacted(store, *args), zip(groups, output_uris)))
+    store.put_object(manifest_uri, build_manifest(output_uris))
+    return len(objects), sum(size for _, size in objects), sizes
+
+
+def get_compact_locations(config):
+    """Returns where the compacted log and song data and their manifests live.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        dict: The (output prefix, manifest uri) of the compacted copy of each [S3] source.
+    """
+    prefix = config['ETL']['COMPACT_PREFIX'].strip("'").rstrip('/')
+    manifest_prefix = config['ETL']['MANIFEST_PREFIX'].strip("'").rstrip('/')
+    return {source: ("{}/{}".format(prefix, name), "{}/compact-{}.manifest".format(manifest_prefix, name))
+            for source, name in (('LOG_DATA', 'log_data'), ('SONG_DATA', 'song_data'))}
+
+
+def compact_all(store, config, slices):
+    """Compacts both the log and song data configured in the [S3] section of dwh.cfg.
+
+    Parameters:
+        store(object store): The object store holding the source data and the output.
+        config(ConfigParser): The parsed dwh.cfg.
+        slices(int): The number of slices loading the files.
+
+    Returns:
+        tuple: The manifest uris of the compacted log and song data, None for a source without objects.
+    """
+    target_file_bytes = config.getint('ETL', 'COMPACT_FILE_BYTES', fallback=TARGET_FILE_BYTES)
+    manifests = []
+    for source, (output_prefix, manifest_uri) in get_compact_locations(config).items():
+        count, total, sizes = compact_prefix(store, config['S3'][source].strip("'"), output_prefix, manifest_uri,
+                                             slices, target_file_bytes)
+        print("Compacted {:,} {} objects ({:,.1f} MB) into {} gzip files ({:,.1f} MB) for {} slices".format(
+            count, source, total / 1e6, len(sizes), sum(sizes) / 1e6, slices))
+        manifests.append(manifest_uri if sizes else None)
+    return tuple(manifests)
+
+
+def main():
+    """The main function for compact_stage.py.
+
+    Merges the small raw log and song JSON objects into gzipped files sized for the slices of the cluster
+    under COMPACT_PREFIX, either in S3 or in the local object store used by the duckdb backend.
+    """
+    parser = argparse.ArgumentParser(description="Compact the raw song and log JSON into slice-aligned gzip files.")
+    parser.add_argument('--slices', type=int, help="the slice count to align to instead of the cluster's")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="read and write S3, or the local object store of the duckdb backend")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    compact_all(get_object_store(config, args.backend), config, args.slices or cluster_slices(args.backend))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import re
+import instrumentation
+from backends import BACKENDS, REDSHIFT, connect, get_object_store
+from ddl import normalize_type, parse_create_table, table_keys, types_match
+from spectrum_stage import create_external_tables, render_ddl
+from sql_queries import (create_table_queries, drop_table_queries, catalog_columns_select, catalog_keys_select,
+                         dim_dedupe_queries, dim_songs_song_key_backfill)
+
+# pg_class.reldiststyle values, with the AUTO styles reported as the style Redshift picked.
+REDSHIFT_DISTSTYLES = {0: 'EVEN', 1: 'KEY', 8: 'ALL', 10: 'ALL', 11: 'EVEN', 12: 'KEY'}
 
 
 def drop_tables(cur, conn):
@@ -11,7 +20,7 @@ def drop_tables(cur, conn):
         conn(psycopg2 connection): The connection to the database that holds the Data Warehouse tables.
     """
     for query in drop_table_queries:
-        cur.execute(query)
+        instrumentation.execute(cur, query)
         conn.commit()
 
 
@@ -23,8 +32,195 @@ def create_tables(cur, conn):
         conn(psycopg2 connection): The connection to the database that will hold the Data Warehouse tables.
     """
     for query in create_table_queries:
-        cur.execute(query)
+        instrumentation.execute(cur, query)
+        conn.commit()
+
+
+def catalog_type(data_type, max_length, precision, scale):
+    """Rebuilds a column type from its information_schema.columns fields, e.g. character varying(256).
+
+    Parameters:
+        data_type(str): The data_type column.
+        max_length(int): The character_maximum_length column.
+        precision(int): The numeric_precision column.
+        scale(int): The numeric_scale column.
+
+    Returns:
+        str: The column type.
+    """
+    if '(' in data_type:
+        return data_type
+    family, _ = normalize_type(data_type)
+    if family in ('VARCHAR', 'CHAR') and max_length is not None:
+        return "{}({})".format(data_type, max_length)
+    if family == 'NUMERIC' and precision is not None:
+        return "{}({},{})".format(data_type, precision, scale or 0)
+    return data_type
+
+
+def read_catalog(cur, include_keys):
+    """Reads the columns, and on Redshift the distribution and sort keys, of the live tables.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to query the catalog with.
+        include_keys(bool): Whether to read the keys from pg_table_def, which only exists on Redshift.
+
+    Returns:
+        dict: The live columns as (name, type) pairs and the keys of each table, keyed by lower case table name.
+    """
+    catalog = {}
+    instrumentation.execute(cur, catalog_columns_select)
+    for table, column, data_type, max_length, precision, scale in cur.fetchall():
+        entry = catalog.setdefault(table.lower(), {'columns': [], 'keys': None})
+        entry['columns'].append((column.lower(), catalog_type(data_type, max_length, precision, scale)))
+
+    if include_keys:
+        instrumentation.execute(cur, catalog_keys_select)
+        for table, column, distkey, sortkey, diststyle in cur.fetchall():
+            entry = catalog.get(table.lower())
+            if entry is None:
+                continue
+            if entry['keys'] is None:
+                entry['keys'] = {'diststyle': REDSHIFT_DISTSTYLES.get(diststyle, 'AUTO'), 'distkey': None,
+                                 'sortkeys': {}}
+            if distkey:
+                entry['keys']['distkey'] = column.lower()
+            if sortkey and sortkey > 0:
+                entry['keys']['sortkeys'][sortkey] = column.lower()
+        for entry in catalog.values():
+            if entry['keys'] is not None:
+                entry['keys']['sortkeys'] = [entry['keys']['sortkeys'][position]
+                                             for position in sorted(entry['keys']['sortkeys'])]
+    return catalog
+
+
+def table_differences(statement, live):
+    """Lists how a live table differs from its CREATE TABLE statement.
+
+    A statement without a distribution style or key leaves it AUTO, and one without a SORTKEY leaves the sort key
+    AUTO, so the keys Redshift picked for the table are not differences.
+
+    Parameters:
+        statement(str): The desired CREATE TABLE statement.
+        live(dict): The table's entry from read_catalog.
+
+    Returns:
+        list of str: A description of each difference, empty if the table is up to date.
+    """
+    _, columns, attributes = parse_create_table(statement)
+    desired = [(column.name.lower(), column.data_type) for column in columns]
+    differences = []
+    if [name for name, _ in desired] != [name for name, _ in live['columns']]:
+        differences.append("columns {} -> {}".format([name for name, _ in live['columns']],
+                                                     [name for name, _ in desired]))
+    live_types = dict(live['columns'])
+    for name, data_type in desired:
+        if name in live_types and not types_match(data_type, live_types[name]):
+            differences.append("{} {} -> {}".format(name, live_types[name], data_type))
+
+    if live['keys'] is not None:
+        diststyle, distkey, sortkeys = table_keys(columns, attributes)
+        distkey = distkey.lower() if distkey else None
+        sortkeys = [key.lower() for key in sortkeys]
+        if diststyle != 'AUTO' and diststyle != live['keys']['diststyle']:
+            differences.append("DISTSTYLE {} -> {}".format(live['keys']['diststyle'], diststyle))
+        if diststyle != 'AUTO' and distkey != live['keys']['distkey']:
+            differences.append("DISTKEY {} -> {}".format(live['keys']['distkey'], distkey))
+        if sortkeys and sortkeys != live['keys']['sortkeys']:
+            differences.append("SORTKEY {} -> {}".format(live['keys']['sortkeys'], sortkeys))
+    return differences
+
+
+def plan_migration(catalog, queries=create_table_queries):
+    """Decides what to do with each table in create_table_queries given the live catalog.
+
+    Parameters:
+        catalog(dict): The live tables, as returned by read_catalog.
+        queries(list of str): The desired CREATE TABLE statements.
+
+    Returns:
+        list of tuple: The (table, action, statement, differences) of each table, where action is 'create',
+        'rebuild' or 'keep'.
+    """
+    plan = []
+    for statement in queries:
+        table = parse_create_table(statement)[0]
+        live = catalog.get(table.lower())
+        if live is None:
+            plan.append((table, 'create', statement, []))
+            continue
+        differences = table_differences(statement, live)
+        plan.append((table, 'rebuild' if differences else 'keep', statement, differences))
+    return plan
+
+
+def deep_copy_queries(table, statement, live_columns):
+    """Builds the statements that rebuild a table as a shadow copy and swap it in.
+
+    Columns present in both the live and the desired table are copied, cast to their new types; new columns
+    are left to their defaults.
+
+    Parameters:
+        table(str): The table name.
+        statement(str): The desired CREATE TABLE statement.
+        live_columns(list of tuple): The live (name, type) columns.
+
+    Returns:
+        list of str: The statements to run in one transaction.
+    """
+    shadow = table + '_migrate_new'
+    backup = table + '_migrate_old'
+    _, columns, _ = parse_create_table(statement)
+    live_names = {name for name, _ in live_columns}
+    copied = [column for column in columns if column.name.lower() in live_names]
+    create_shadow = re.sub(r'CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?' + re.escape(table) + r'\b',
+                           'CREATE TABLE ' + shadow, statement, count=1, flags=re.IGNORECASE)
+    return [
+        "DROP TABLE IF EXISTS {}".format(shadow),
+        create_shadow,
+        "INSERT INTO {} ({}) SELECT {} FROM {}".format(
+            shadow, ', '.join(column.name for column in copied),
+            ', '.join("CAST({} AS {})".format(column.name, column.data_type) for column in copied), table),
+        "ALTER TABLE {} RENAME TO {}".format(table, backup),
+        "ALTER TABLE {} RENAME TO {}".format(shadow, table),
+        "DROP TABLE {}".format(backup),
+    ]
+
+
+def migrate_tables(cur, conn, include_keys):
+    """Brings the live tables in line with create_table_queries without dropping unchanged tables.
+
+    Missing tables are created. Tables whose columns, types or keys changed are deep copied into a shadow
+    table that is swapped in by renaming, all in one transaction, so they keep their data and readers never
+    see a missing table. Tables that already match are left alone. Songs kept from before dim_songs had a
+    song_key get theirs derived, so incremental loads resolve events to them, and dimension keys that earlier
+    merges left with several rows are collapsed to one.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the migration with.
+        conn(psycopg2 connection): The connection to the data warehouse.
+        include_keys(bool): Whether to compare distribution and sort keys, which needs the Redshift catalog.
+
+    Returns:
+        list of tuple: The migration plan that was carried out.
+    """
+    catalog = read_catalog(cur, include_keys)
+    conn.commit()
+    plan = plan_migration(catalog)
+    for table, action, statement, differences in plan:
+        print("{:<24} {:<8} {}".format(table, action, '; '.join(differences)))
+        if action == 'create':
+            instrumentation.execute(cur, statement)
+        elif action == 'rebuild':
+            for query in deep_copy_queries(table, statement, catalog[table.lower()]['columns']):
+                instrumentation.execute(cur, query)
+        conn.commit()
+    instrumentation.execute(cur, dim_songs_song_key_backfill)
+    conn.commit()
+    for query in dim_dedupe_queries:
+        instrumentation.execute(cur, query)
         conn.commit()
+    return plan
 
 
 def main():
@@ -32,19 +228,39 @@ def main():
 
     Reads in the database connection details, creates a database connection and cursor to execute commands.
     Drops all tables in drop_talbes_queries, then creates all tables in create_table_queries.
+    With --migrate, only the tables that are missing or differ from create_table_queries are touched.
+    With --spectrum, the external staging tables over the Parquet log and song data are defined as well.
     Closes the connection to the database.
     """
+    parser = argparse.ArgumentParser(description="Drop and recreate the data warehouse tables.")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to run against: the Redshift cluster or the local DuckDB engine")
+    parser.add_argument('--migrate', action='store_true',
+                        help="create missing tables and deep copy changed ones instead of dropping everything")
+    parser.add_argument('--spectrum', action='store_true',
+                        help="also define external staging tables over the Parquet copies of the source data")
+    parser.add_argument('--metrics-file', help="write per-statement metrics to this Prometheus textfile")
+    args = parser.parse_args()
+    instrumentation.configure(capture_query_ids=args.backend == REDSHIFT)
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
-        *config['CLUSTER'].values()))
+    conn = connect(config, args.backend)
     cur = conn.cursor()
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    if args.migrate:
+        migrate_tables(cur, conn, include_keys=args.backend == REDSHIFT)
+    else:
+        drop_tables(cur, conn)
+        create_tables(cur, conn)
+
+    if args.spectrum:
+        create_external_tables(conn, render_ddl(config, get_object_store(config, args.backend), args.backend))
 
     conn.close()
+    if args.metrics_file:
+        instrumentation.write_prometheus_textfile(args.metrics_file, instrumentation.recorder.records)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+import re
+
+CREATE_TABLE_PATTERN = re.compile(r'CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(?P<table>[\w.]+)\s*\(', re.IGNORECASE)
+TYPE_PATTERN = re.compile(r'^(?P<type>(DOUBLE\s+PRECISION|CHARACTER\s+VARYING|[A-Z]+)(\s*\([^)]*\))?)(?P<rest>.*)$',
+                          re.IGNORECASE | re.DOTALL)
+
+
+class Column:
+    """A column of a CREATE TABLE statement: its name, data type and the remaining column attributes."""
+
+    def __init__(self, name, data_type, attributes=''):
+        self.name = name
+        self.data_type = data_type
+        self.attributes = attributes
+
+    @property
+    def base_type(self):
+        """The data type without its length or precision, upper cased, e.g. VARCHAR."""
+        return re.sub(r'\s*\(.*\)', '', self.data_type).upper()
+
+    @property
+    def not_null(self):
+        return bool(re.search(r'\bNOT\s+NULL\b|\bPRIMARY\s+KEY\b', self.attributes, re.IGNORECASE))
+
+    def __repr__(self):
+        return "Column({!r}, {!r})".format(self.name, self.data_type)
+
+
+# Type names as written in DDL or reported by a catalog, mapped to one name per type family.
+TYPE_FAMILIES = {
+    'TEXT': 'VARCHAR',
+    'VARCHAR': 'VARCHAR',
+    'CHARACTER VARYING': 'VARCHAR',
+    'NVARCHAR': 'VARCHAR',
+    'CHAR': 'CHAR',
+    'CHARACTER': 'CHAR',
+    'BPCHAR': 'CHAR',
+    'NCHAR': 'CHAR',
+    'DECIMAL': 'NUMERIC',
+    'NUMERIC': 'NUMERIC',
+    'SMALLINT': 'SMALLINT',
+    'INT2': 'SMALLINT',
+    'INTEGER': 'INTEGER',
+    'INT': 'INTEGER',
+    'INT4': 'INTEGER',
+    'BIGINT': 'BIGINT',
+    'INT8': 'BIGINT',
+    'REAL': 'REAL',
+    'FLOAT4': 'REAL',
+    'FLOAT': 'DOUBLE',
+    'FLOAT8': 'DOUBLE',
+    'DOUBLE': 'DOUBLE',
+    'DOUBLE PRECISION': 'DOUBLE',
+    'BOOLEAN': 'BOOLEAN',
+    'BOOL': 'BOOLEAN',
+    'DATE': 'DATE',
+    'TIMESTAMP': 'TIMESTAMP',
+    'TIMESTAMP WITHOUT TIME ZONE': 'TIMESTAMP',
+    'TIMESTAMPTZ': 'TIMESTAMPTZ',
+    'TIMESTAMP WITH TIME ZONE': 'TIMESTAMPTZ',
+}
+
+
+def normalize_type(data_type):
+    """Splits a data type into its type family and its explicit parameters.
+
+    Parameters:
+        data_type(str): The data type as written in DDL or reported by a catalog, e.g. VARCHAR(5).
+
+    Returns:
+        tuple: The family, e.g. 'VARCHAR', and a tuple of the length or precision and scale, empty when
+        the type relies on the engine default.
+    """
+    match = re.match(r'^\s*([A-Za-z ]+?)\s*(\(([^)]*)\))?\s*$', data_type)
+    if match is None:
+        return data_type.strip().upper(), ()
+    name = re.sub(r'\s+', ' ', match.group(1)).upper()
+    params = tuple(int(param) for param in match.group(3).split(',')) if match.group(3) else ()
+    return TYPE_FAMILIES.get(name, name), params
+
+
+def types_match(desired, live):
+    """Checks whether a live column type satisfies a desired one.
+
+    Types of different families never match. When the desired type has no explicit length or precision,
+    e.g. TEXT or DECIMAL, it matches whatever default the engine chose.
+
+    Parameters:
+        desired(str): The data type in the DDL.
+        live(str): The data type reported by the catalog.
+
+    Returns:
+        bool: Whether the live column can be kept as is.
+    """
+    desired_family, desired_params = normalize_type(desired)
+    live_family, live_params = normalize_type(live)
+    if desired_family != live_family:
+        return False
+    return not desired_params or not live_params or desired_params == live_params
+
+
+def split_top_level(body):
+    """Splits a comma separated list, ignoring commas nested in parentheses.
+
+    Parameters:
+        body(str): The text between the parentheses of a CREATE TABLE statement.
+
+    Returns:
+        list of str: The stripped items.
+    """
+    items = []
+    depth = 0
+    current = []
+    for char in body:
+        if char == ',' and depth == 0:
+            items.append(''.join(current).strip())
+            current = []
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current.append(char)
+    items.append(''.join(current).strip())
+    return [item for item in items if item]
+
+
+def parse_create_table(statement):
+    """Parses a CREATE TABLE statement from sql_queries into its table name, columns and table attributes.
+
+    Table constraints such as PRIMARY KEY (a, b) are skipped; table attributes such as DISTSTYLE or
+    SORTKEY (a) that follow the column list are returned as written.
+
+    Parameters:
+        statement(str): The CREATE TABLE statement.
+
+    Returns:
+        tuple: The table name, the list of Column, and the table attributes string.
+    """
+    statement = statement.strip().rstrip(';')
+    match = CREATE_TABLE_PATTERN.search(statement)
+    if match is None:
+        raise ValueError("Not a CREATE TABLE statement: {}".format(statement[:60]))
+
+    depth = 1
+    end = match.end()
+    while depth:
+        depth += {'(': 1, ')': -1}.get(statement[end], 0)
+        end += 1
+
+    columns = []
+    for item in split_top_level(statement[match.end():end - 1]):
+        if re.match(r'^(PRIMARY\s+KEY|UNIQUE|FOREIGN\s+KEY|CONSTRAINT)\b', item, re.IGNORECASE):
+            continue
+        name, definition = item.split(None, 1)
+        type_match = TYPE_PATTERN.match(definition.strip())
+        columns.append(Column(name, type_match.group('type').strip(), type_match.group('rest').strip()))
+    return match.group('table'), columns, statement[end:].strip()
+
+
+def table_keys(columns, attributes):
+    """Extracts the distribution style, distribution key and sort keys a CREATE TABLE statement declares.
+
+    Parameters:
+        columns(list of Column): The parsed columns.
+        attributes(str): The table attributes that follow the column list.
+
+    Returns:
+        tuple: The DISTSTYLE (KEY, ALL, EVEN or AUTO), the DISTKEY column or None, and the list of SORTKEY columns.
+    """
+    distkey = next((column.name for column in columns
+                    if re.search(r'\bDISTKEY\b', column.attributes, re.IGNORECASE)), None)
+    sortkeys = [column.name for column in columns if re.search(r'\bSORTKEY\b', column.attributes, re.IGNORECASE)]
+
+    match = re.search(r'\bDISTKEY\s*\(\s*(\w+)\s*\)', attributes, re.IGNORECASE)
+    if match:
+        distkey = match.group(1)
+    match = re.search(r'\bSORTKEY\s*\(([^)]*)\)', attributes, re.IGNORECASE)
+    if match:
+        sortkeys = [name.strip() for name in match.group(1).split(',')]
+    match = re.search(r'\bDISTSTYLE\s+(\w+)', attributes, re.IGNORECASE)
+    diststyle = match.group(1).upper() if match else ('KEY' if distkey else 'AUTO')
+    return diststyle, distkey, sortkeys
+
+
+def strip_key_attributes(attributes):
+    """Removes column level DISTKEY and SORTKEY attributes.
+
+    Parameters:
+        attributes(str): The column attributes, e.g. 'NOT NULL    DISTKEY'.
+
+    Returns:
+        str: The remaining attributes.
+    """
+    return re.sub(r'\s+', ' ', re.sub(r'\b(DISTKEY|SORTKEY)\b', '', attributes, flags=re.IGNORECASE)).strip()
+
+
+def render_create_table(table, columns, attributes=''):
+    """Renders a CREATE TABLE statement in the layout used by sql_queries.
+
+    Parameters:
+        table(str): The table name.
+        columns(list of Column): The columns.
+        attributes(str): Table attributes to add after the column list, one per line.
+
+    Returns:
+        str: The CREATE TABLE statement.
+    """
+    lines = ["    {:<20}{:<12}{}".format(column.name, column.data_type, column.attributes).rstrip()
+             for column in columns]
+    statement = "\nCREATE TABLE IF NOT EXISTS {}\n(\n{}\n)\n".format(table, ",\n".join(lines))
+    if attributes:
+        statement += attributes.strip() + "\n"
+    return statement
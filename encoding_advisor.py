@@ -0,0 +1,319 @@
+import argparse
+import configparser
+import datetime
+import decimal
+import math
+import struct
+import zlib
+
+import instrumentation
+from backends import BACKENDS, REDSHIFT, connect
+from ddl import Column, normalize_type, render_create_table
+from key_advisor import format_ddl, load_schema
+
+SAMPLE_ROWS = 100000
+# Bytes per value of the fixed width types.
+FIXED_WIDTHS = {'SMALLINT': 2, 'INTEGER': 4, 'BIGINT': 8, 'REAL': 4, 'DOUBLE': 8, 'BOOLEAN': 1, 'DATE': 4,
+                'TIMESTAMP': 8, 'TIMESTAMPTZ': 8}
+AZ64_FAMILIES = ('SMALLINT', 'INTEGER', 'BIGINT', 'NUMERIC', 'DATE', 'TIMESTAMP', 'TIMESTAMPTZ')
+TEXT_FAMILIES = ('VARCHAR', 'CHAR')
+# Redshift stores TEXT as VARCHAR(256). A byte dictionary holds at most 256 values per block.
+DEFAULT_VARCHAR_BYTES = 256
+BYTEDICT_MAX_DISTINCT = 256
+# Right-sized VARCHAR widths leave this much room above the longest value, rounded up to a power of two.
+VARCHAR_HEADROOM = 1.25
+MIN_VARCHAR_WIDTH = 16
+MAX_VARCHAR_WIDTH = 65535
+# zlib stands in for ZSTD, and for AZ64 on delta encoded values, when estimating compressed sizes locally.
+ZLIB_LEVEL = 6
+
+
+def value_width(data_type):
+    """Returns the stored width of a fixed width type in bytes, or None for variable width types.
+
+    Parameters:
+        data_type(str): The column type.
+
+    Returns:
+        int: The width, None for VARCHAR and CHAR.
+    """
+    family, params = normalize_type(data_type)
+    if family == 'NUMERIC':
+        return 8 if not params or params[0] <= 18 else 16
+    return FIXED_WIDTHS.get(family)
+
+
+def encode_value(value, family, width):
+    """Serializes a value the way a column stores it, for estimating sizes.
+
+    Parameters:
+        value(object): The value.
+        family(str): The type family of the column.
+        width(int): The fixed width of the column, or None.
+
+    Returns:
+        bytes: The stored bytes.
+    """
+    if family in TEXT_FAMILIES:
+        return str(value).encode('utf-8')
+    if isinstance(value, float) and family in ('REAL', 'DOUBLE'):
+        return struct.pack('<d', value)
+    return as_integer(value).to_bytes(width, 'little', signed=True)
+
+
+def as_integer(value):
+    """Maps a numeric or temporal value to the integer AZ64 would encode."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        return int((value - datetime.datetime(1970, 1, 1, tzinfo=value.tzinfo)).total_seconds() * 1000000)
+    if isinstance(value, datetime.date):
+        return value.toordinal()
+    if isinstance(value, decimal.Decimal):
+        return int(value.scaleb(-value.as_tuple().exponent))
+    return int(value)
+
+
+def estimate_sizes(values, data_type):
+    """Estimates the stored size of a column sample under every encoding that applies to its type.
+
+    Parameters:
+        values(list): The sampled values in storage order, None for NULL.
+        data_type(str): The column type.
+
+    Returns:
+        dict: The estimated bytes for RAW and each candidate encoding.
+    """
+    family, _ = normalize_type(data_type)
+    width = value_width(data_type)
+    present = [value for value in values if value is not None]
+    encoded = [encode_value(value, family, width) for value in present]
+    # Variable width values carry a 4 byte length.
+    raw = sum(len(value) + (0 if width else 4) for value in encoded)
+    sizes = {'RAW': raw}
+    if not encoded:
+        return sizes
+
+    runs = 1 + sum(1 for previous, value in zip(encoded, encoded[1:]) if previous != value)
+    sizes['RUNLENGTH'] = int(runs * (raw / len(encoded) + 1))
+    sizes['ZSTD'] = len(zlib.compress(b''.join(len(value).to_bytes(4, 'little') + value for value in encoded)
+                                      if not width else b''.join(encoded), ZLIB_LEVEL))
+    distinct = set(encoded)
+    if len(distinct) <= BYTEDICT_MAX_DISTINCT and family != 'BOOLEAN':
+        sizes['BYTEDICT'] = len(encoded) + sum(len(value) for value in distinct)
+    if family in AZ64_FAMILIES:
+        numbers = [as_integer(value) for value in present]
+        deltas = [numbers[0]] + [value - previous for previous, value in zip(numbers, numbers[1:])]
+        sizes['AZ64'] = len(zlib.compress(b''.join(delta.to_bytes(max(width, 9), 'little', signed=True)
+                                                   for delta in deltas), ZLIB_LEVEL))
+    return sizes
+
+
+def choose_encoding(sizes, leading_sortkey):
+    """Picks the encoding with the smallest estimated size.
+
+    The leading sort key column is left RAW: compressing it packs far more rows per block than the other
+    columns, so range restricted scans end up reading more blocks of every other column.
+
+    Parameters:
+        sizes(dict): The output of estimate_sizes.
+        leading_sortkey(bool): Whether the column is the first sort key column.
+
+    Returns:
+        str: The encoding.
+    """
+    if leading_sortkey:
+        return 'RAW'
+    preference = ['AZ64', 'ZSTD', 'BYTEDICT', 'RUNLENGTH', 'RAW']
+    return min(sizes, key=lambda encoding: (sizes[encoding], preference.index(encoding)))
+
+
+def right_size(data_type, max_bytes):
+    """Picks a VARCHAR width for the longest value in a column.
+
+    Parameters:
+        data_type(str): The declared type.
+        max_bytes(int): The longest value in bytes, None if the column holds no values.
+
+    Returns:
+        str: The new type, the declared one when it is not a VARCHAR or there is nothing to size it by.
+    """
+    family, params = normalize_type(data_type)
+    if family != 'VARCHAR' or not max_bytes:
+        return data_type
+    declared = params[0] if params else DEFAULT_VARCHAR_BYTES
+    width = max(MIN_VARCHAR_WIDTH, 2 ** math.ceil(math.log2(max_bytes * VARCHAR_HEADROOM)))
+    return "VARCHAR({})".format(min(width, declared, MAX_VARCHAR_WIDTH))
+
+
+def profile_table(cur, table, columns, sample_rows):
+    """Reads the row count, the longest value of each VARCHAR column and a sample of a table.
+
+    The sample is the first rows in storage order, which is the order the encodings compress them in.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to query the table with.
+        table(str): The table name.
+        columns(list of Column): The declared columns.
+        sample_rows(int): The number of rows to sample.
+
+    Returns:
+        tuple: The row count, a dict of the longest value in bytes per VARCHAR column, and the sampled rows.
+    """
+    text_columns = [column.name for column in columns if normalize_type(column.data_type)[0] == 'VARCHAR']
+    selects = ["COUNT(*)"] + ["MAX(OCTET_LENGTH({}))".format(name) for name in text_columns]
+    instrumentation.execute(cur, "SELECT {} FROM {}".format(", ".join(selects), table),
+                            name="profile_{}".format(table))
+    counts = cur.fetchone()
+    instrumentation.execute(cur, "SELECT {} FROM {} LIMIT {}".format(
+        ", ".join(column.name for column in columns), table, int(sample_rows)), name="sample_{}".format(table))
+    return counts[0], dict(zip(text_columns, counts[1:])), cur.fetchall()
+
+
+def analyze_compression(conn, table, sample_rows):
+    """Asks Redshift for its encoding recommendations with ANALYZE COMPRESSION.
+
+    ANALYZE COMPRESSION cannot run inside a transaction, so it runs in autocommit mode.
+
+    Parameters:
+        conn(psycopg2 connection): The connection to the cluster.
+        table(str): The table name.
+        sample_rows(int): The number of rows to analyze per slice, raised by Redshift to at least 100,000.
+
+    Returns:
+        dict: The (encoding, estimated reduction in percent) of each column, keyed by lower case column name.
+    """
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        instrumentation.execute(cur, "ANALYZE COMPRESSION {} COMPROWS {}".format(table, int(sample_rows)),
+                                name="analyze_compression_{}".format(table))
+        return {column.lower(): (encoding.upper(), float(reduction))
+                for _, column, encoding, reduction in cur.fetchall()}
+    finally:
+        conn.autocommit = False
+
+
+def advise(conn, sample_rows=SAMPLE_ROWS, use_analyze_compression=False):
+    """Recommends an encoding for every column and a width for every VARCHAR column of the live tables.
+
+    Staging tables keep their declared widths, since they have to accept whatever the source data holds.
+
+    Parameters:
+        conn(psycopg2 connection): The connection to the data warehouse.
+        sample_rows(int): The number of rows to sample per table.
+        use_analyze_compression(bool): Whether to take the encodings from Redshift's ANALYZE COMPRESSION
+            instead of the local estimates.
+
+    Returns:
+        list of dict: One recommendation per table with rows, with the estimated sizes of each column and
+        the alternative CREATE TABLE statement.
+    """
+    recommendations = []
+    cur = conn.cursor()
+    for table, definition in load_schema().items():
+        rows, max_bytes, sample = profile_table(cur, table, definition['columns'], sample_rows)
+        if not rows:
+            continue
+        analyzed = analyze_compression(conn, table, sample_rows) if use_analyze_compression else {}
+        scale = rows / len(sample) if sample else 0
+        leading_sortkey = definition['sortkeys'][0].lower() if definition['sortkeys'] else None
+
+        columns = []
+        new_columns = []
+        for index, column in enumerate(definition['columns']):
+            sizes = estimate_sizes([row[index] for row in sample], column.data_type)
+            encoding = choose_encoding(sizes, column.name.lower() == leading_sortkey)
+            if column.name.lower() in analyzed:
+                encoding = analyzed[column.name.lower()][0]
+            data_type = column.data_type
+            if not table.startswith('staging_'):
+                data_type = right_size(column.data_type, max_bytes.get(column.name))
+            columns.append({
+                'column': column.name,
+                'type': column.data_type,
+                'recommended_type': data_type,
+                'encoding': encoding,
+                'raw_bytes': int(sizes['RAW'] * scale),
+                'encoded_bytes': int(sizes.get(encoding, sizes['RAW']) * scale),
+                'analyze_compression_reduction': analyzed.get(column.name.lower(), (None, None))[1],
+            })
+            new_columns.append(Column(column.name, data_type,
+                                      "{} ENCODE {}".format(column.attributes, encoding).strip()))
+        recommendations.append({
+            'table': table,
+            'variable': definition['variable'],
+            'rows': rows,
+            'columns': columns,
+            'ddl': render_create_table(table, new_columns, definition['attributes']),
+        })
+    return recommendations
+
+
+def format_report(recommendations):
+    """Formats the recommendations as a plain text report of encodings, widths and estimated savings.
+
+    Parameters:
+        recommendations(list of dict): The output of advise.
+
+    Returns:
+        str: The report.
+    """
+    lines = []
+    total_raw = sum(column['raw_bytes'] for recommendation in recommendations
+                    for column in recommendation['columns'])
+    total_encoded = sum(column['encoded_bytes'] for recommendation in recommendations
+                        for column in recommendation['columns'])
+    lines.append("Estimated column data: {:,.1f} MB raw, {:,.1f} MB encoded ({:.0%} smaller)".format(
+        total_raw / 1e6, total_encoded / 1e6, 1 - total_encoded / total_raw if total_raw else 0))
+    for recommendation in recommendations:
+        raw = sum(column['raw_bytes'] for column in recommendation['columns'])
+        encoded = sum(column['encoded_bytes'] for column in recommendation['columns'])
+        lines.append("")
+        lines.append("{} ({:,} rows): {:,.1f} MB raw, {:,.1f} MB encoded".format(
+            recommendation['table'], recommendation['rows'], raw / 1e6, encoded / 1e6))
+        for column in recommendation['columns']:
+            resized = ("  {} -> {}".format(column['type'], column['recommended_type'])
+                       if column['recommended_type'] != column['type'] else "")
+            reduction = column['analyze_compression_reduction']
+            lines.append("  {:<20}{:<10}{:>12,} -> {:>12,} bytes{}{}".format(
+                column['column'], column['encoding'], column['raw_bytes'], column['encoded_bytes'],
+                "  (ANALYZE COMPRESSION: {:.1f}% smaller)".format(reduction) if reduction is not None else "",
+                resized))
+    return "\n".join(lines)
+
+
+def main():
+    """The main function for encoding_advisor.py.
+
+    Samples the live tables, recommends column encodings and VARCHAR widths, prints a report of the estimated
+    savings and writes the alternative DDL.
+    """
+    parser = argparse.ArgumentParser(description="Recommend column encodings and VARCHAR widths from live data.")
+    parser.add_argument('--sample-rows', type=int, default=SAMPLE_ROWS, help="rows to sample per table")
+    parser.add_argument('--analyze-compression', action='store_true',
+                        help="take the encodings from Redshift's ANALYZE COMPRESSION instead of local estimates")
+    parser.add_argument('--ddl-output', default='encoded_tables.py',
+                        help="where to write the alternative *_table_create statements")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to sample: the Redshift cluster or the local DuckDB engine")
+    args = parser.parse_args()
+    if args.analyze_compression and args.backend != REDSHIFT:
+        parser.error("--analyze-compression needs the redshift backend")
+    instrumentation.configure(capture_query_ids=args.backend == REDSHIFT)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = connect(config, args.backend)
+    recommendations = advise(conn, args.sample_rows, args.analyze_compression)
+    conn.close()
+
+    print(format_report(recommendations))
+    with open(args.ddl_output, 'w') as f:
+        f.write(format_ddl(recommendations))
+    print("\nWrote {}".format(args.ddl_output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,37 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import datetime
+import instrumentation
+import query_cache
+import sql_queries
+from backends import BACKENDS, REDSHIFT, connect, create_pool, get_object_store
+from compact_stage import cluster_slices, compact_all
+from object_store import build_manifest, shard_objects
+from log_cleaner import clean_logs
+from maintenance import maintain
+from parquet_stage import convert_all
+from scheduler import Step, expand_dependencies, print_timings, run_steps
+from spectrum_stage import (SPECTRUM_EVENTS_SOURCE, SPECTRUM_SONGS_SOURCE, convert_new_objects,
+                            create_external_tables, parse_date, partition_predicate, render_ddl,
+                            spectrum_insert_steps)
+from sql_queries import (song_key_update_queries, insert_table_queries, song_key_steps, insert_table_steps,
+                         rollup_refresh_queries)
+from sql_queries import (staging_events_truncate, staging_songs_truncate, staging_events_ts_range,
+                         user_table_insert, song_table_insert, artist_table_insert,
+                         songplay_incremental_insert, time_table_insert, songplay_stream_insert, time_stream_insert,
+                         watermark_select, watermark_delete, watermark_insert,
+                         loaded_objects_select, loaded_objects_insert,
+                         rollup_refresh_start, spectrum_staging_events_ts_range, load_lock)
+
+EVENTS_SOURCE = 'events'
+SONGS_SOURCE = 'songs'
+COPY_GROUP = 'copy'
+# The objects recorded by one multi-row INSERT into etl_loaded_objects, well below the statement size limit.
+LOADED_OBJECTS_BATCH = 1000
+# The source in [S3] and the sql_queries name of the manifest COPY of each staging COPY that can be sharded.
+# The COPY statements are rendered from dwh.cfg on first use, so they are looked up when a load runs.
+COPY_SHARDING = {'staging_events_copy': ('LOG_DATA', 'staging_events_manifest_copy'),
+                 'staging_songs_copy': ('SONG_DATA', 'staging_songs_manifest_copy')}
 
 
 def load_staging_tables(cur, conn):
@@ -10,9 +41,72 @@ def load_staging_tables(cur, conn):
         cur(psycopg2 cursor): The cursor to execute the queries in copy_table_queries.
         conn(psycopg2 connection): The connection to the database that holds the staging tables.
     """
-    for query in copy_table_queries:
-        cur.execute(query)
+    for query in sql_queries.copy_table_queries:
+        instrumentation.execute(cur, query)
+        conn.commit()
+    update_song_keys(cur, conn)
+
+
+def update_song_keys(cur, conn):
+    """Derives the song_key of the staged events and songs that the songplay insert joins them on.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the queries in song_key_update_queries.
+        conn(psycopg2 connection): The connection to the database that holds the staging tables.
+    """
+    for query in song_key_update_queries:
+        instrumentation.execute(cur, load_lock)
+        instrumentation.execute(cur, query)
+        conn.commit()
+
+
+def load_staging_tables_parquet(cur, conn, log_prefix, song_prefix):
+    """Loads the staging tables from the Parquet copies of the log and song data.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the COPY queries.
+        conn(psycopg2 connection): The connection to the database that holds the staging tables.
+        log_prefix(str): The s3:// prefix of the log Parquet files.
+        song_prefix(str): The s3:// prefix of the song Parquet files.
+    """
+    for query, prefix in [(sql_queries.staging_events_parquet_copy, log_prefix),
+                          (sql_queries.staging_songs_parquet_copy, song_prefix)]:
+        instrumentation.execute(cur, query, (prefix,))
+        conn.commit()
+    update_song_keys(cur, conn)
+
+
+def load_staging_tables_clean(cur, conn, clean_prefix):
+    """Loads staging_events from the cleaned logs and staging_songs from the song data.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the COPY queries.
+        conn(psycopg2 connection): The connection to the database that holds the staging tables.
+        clean_prefix(str): The s3:// prefix of the gzipped cleaned logs.
+    """
+    instrumentation.execute(cur, sql_queries.staging_events_clean_copy, (clean_prefix,))
+    conn.commit()
+    instrumentation.execute(cur, sql_queries.staging_songs_copy)
+    conn.commit()
+    update_song_keys(cur, conn)
+
+
+def load_staging_tables_compact(cur, conn, events_manifest, songs_manifest):
+    """Loads the staging tables from the compacted, gzipped log and song data.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the COPY queries.
+        conn(psycopg2 connection): The connection to the database that holds the staging tables.
+        events_manifest(str): The s3:// uri of the manifest of the compacted logs, None if there are none.
+        songs_manifest(str): The s3:// uri of the manifest of the compacted songs, None if there are none.
+    """
+    for query, manifest_uri in [(sql_queries.staging_events_compact_copy, events_manifest),
+                                (sql_queries.staging_songs_compact_copy, songs_manifest)]:
+        if manifest_uri is None:
+            continue
+        instrumentation.execute(cur, query, (manifest_uri,))
         conn.commit()
+    update_song_keys(cur, conn)
 
 
 def insert_tables(cur, conn):
@@ -23,26 +117,456 @@ def insert_tables(cur, conn):
         conn(psycopg2 connection): The connection to the data warehouse.
     """
     for query in insert_table_queries:
-        cur.execute(query)
+        instrumentation.execute(cur, load_lock)
+        instrumentation.execute(cur, query)
         conn.commit()
+        query_cache.invalidate_written([query])
+    refresh_rollups(cur, conn)
+
+
+def load_spectrum(cur, conn, store, config, backend=REDSHIFT, start_date=None, end_date=None):
+    """Inserts into the data warehouse tables straight from external tables over the Parquet source data.
+
+    Only the log and song objects no earlier run converted are converted to Parquet, next to the files already
+    there. The inserts only read the events past the Spectrum watermark, within the date range if one is given,
+    so the log partitions before it are pruned. The watermark and the converted objects are committed in the
+    same transaction as the inserts, then the rollups are refreshed from the first event read.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the queries.
+        conn(psycopg2 connection): The connection to the data warehouse.
+        store(object store): The object store holding the source data and the Parquet files.
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' for Spectrum external tables, 'duckdb' for local views.
+        start_date(date): The first day of log data to insert, or None.
+        end_date(date): The day after the last day of log data to insert, or None.
+    """
+    loaded = {source: get_loaded_objects(cur, source) for source in (SPECTRUM_EVENTS_SOURCE, SPECTRUM_SONGS_SOURCE)}
+    new_objects = convert_new_objects(store, config, loaded)
+    create_external_tables(conn, render_ddl(config, store, backend))
 
+    schema = config['SPECTRUM']['SCHEMA']
+    instrumentation.execute(cur, load_lock)
+    watermark = get_watermark(cur, SPECTRUM_EVENTS_SOURCE)
+    predicate = partition_predicate(start_date, end_date, watermark or None)
+    steps = spectrum_insert_steps(schema, predicate)
+    for name, query in steps:
+        instrumentation.execute(cur, query, name=name)
+
+    instrumentation.execute(cur, spectrum_staging_events_ts_range.format(schema=schema, predicate=predicate))
+    min_ts, max_ts = cur.fetchone()
+    if max_ts is not None and max_ts > watermark:
+        set_watermark(cur, SPECTRUM_EVENTS_SOURCE, max_ts)
+    for source, uris in new_objects.items():
+        record_loaded_objects(cur, source, uris)
+    conn.commit()
+    query_cache.invalidate_written([query for _, query in steps])
+    if min_ts is not None:
+        refresh_rollups(cur, conn, min_ts)
+
+
+def refresh_rollups(cur, conn, start_time=None):
+    """Rebuilds the periods of the rollup tables that a load may have changed.
+
+    The periods from the one holding start_time on are rebuilt from the fact table, whichever process inserted
+    its rows, so plays that arrive late or from another loader are always counted.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the queries in rollup_refresh_queries.
+        conn(psycopg2 connection): The connection to the data warehouse.
+        start_time(int): The earliest start_time the load may have inserted, or None to rebuild every period.
+    """
+    instrumentation.execute(cur, load_lock)
+    instrumentation.execute(cur, rollup_refresh_start, (start_time,))
+    for query in rollup_refresh_queries:
+        instrumentation.execute(cur, query)
+    conn.commit()
+    query_cache.invalidate_written(rollup_refresh_queries)
+
+
+def build_steps(step_definitions):
+    """Builds scheduler steps from (name, query, depends_on) definitions in sql_queries.
+
+    Parameters:
+        step_definitions(list of tuple): The step definitions, e.g. sql_queries.insert_table_steps.
+
+    Returns:
+        list of Step: The steps to hand to the scheduler.
+    """
+    return [Step(name, query, depends_on) for name, query, depends_on in step_definitions]
+
+
+def build_copy_steps(store, name, prefix_uri, manifest_copy_query, num_shards, depth, manifest_prefix):
+    """Splits a staging COPY into manifest shards that can load in parallel.
+
+    Objects under the prefix are grouped by partition (the first depth directory levels, e.g. year/month
+    of log_data or the leading letter of song_data) and the partitions are balanced by size into at most
+    num_shards manifests.
+
+    Parameters:
+        store(object store): The object store holding the source data and manifests.
+        name(str): The name of the unsharded COPY step, e.g. 'staging_events_copy'.
+        prefix_uri(str): The s3:// prefix of the source data.
+        manifest_copy_query(str): The manifest COPY statement for the staging table.
+        num_shards(int): The maximum number of shards.
+        depth(int): The number of directory levels below the prefix that make up a partition.
+        manifest_prefix(str): The s3:// prefix to write the shard manifests under.
+
+    Returns:
+        list of Step: One COPY step per non-empty shard.
+    """
+    shards = shard_objects(store.list_objects(prefix_uri), prefix_uri, num_shards, depth)
+    steps = []
+    for index, uris in enumerate(shards):
+        manifest_uri = "{}/{}-shard-{}.manifest".format(manifest_prefix.rstrip('/'), name, index)
+        store.put_object(manifest_uri, build_manifest(uris))
+        steps.append(Step("{}_shard_{}".format(name, index), manifest_copy_query, params=(manifest_uri,),
+                          group=COPY_GROUP))
+    return steps
+
+
+def build_staging_steps(store, config):
+    """Builds the staging COPY steps, sharding each source as configured in the [ETL] section of dwh.cfg.
+
+    Parameters:
+        store(object store): The object store holding the source data and manifests.
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        tuple: The list of COPY steps, and a dict of the shard step names replacing each sharded COPY.
+    """
+    steps = []
+    replacements = {}
+    for name, query, _ in sql_queries.staging_table_steps:
+        source, manifest_copy_name = COPY_SHARDING[name]
+        num_shards = config.getint('ETL', source + '_SHARDS', fallback=1)
+        if num_shards <= 1:
+            steps.append(Step(name, query, group=COPY_GROUP))
+            continue
+
+        shard_steps = build_copy_steps(store, name, config['S3'][source].strip("'"),
+                                       getattr(sql_queries, manifest_copy_name),
+                                       num_shards, config.getint('ETL', source + '_PARTITION_DEPTH'),
+                                       config['ETL']['MANIFEST_PREFIX'].strip("'"))
+        steps.extend(shard_steps)
+        replacements[name] = [step.name for step in shard_steps]
+    return steps, replacements
+
+
+def run_parallel(pool, max_workers, staging_steps, replacements, copy_concurrency):
+    """Runs the staging COPYs and the inserts as a dependency DAG over a connection pool.
+
+    The COPYs for both staging tables, and the shards of a sharded COPY, run concurrently on separate
+    connections up to copy_concurrency at a time. Independent statements such as the dimension inserts also
+    run concurrently, and every insert starts as soon as the staging tables it reads from are loaded.
+
+    Parameters:
+        pool(psycopg2 connection pool): The pool to borrow connections from.
+        max_workers(int): The maximum number of statements to run at the same time.
+        staging_steps(list of Step): The staging COPY steps, as built by build_staging_steps.
+        replacements(dict): The shard step names replacing each sharded COPY.
+        copy_concurrency(int): The maximum number of COPYs to run at the same time.
+
+    Returns:
+        dict: The wall time in seconds of each step, keyed by step name.
+    """
+    insert_steps = expand_dependencies(build_steps(song_key_steps + insert_table_steps), replacements)
+    return run_steps(staging_steps + insert_steps, pool, max_workers,
+                     group_limits={COPY_GROUP: copy_concurrency})
 
-def main():
+
+def get_watermark(cur, source):
+    """Retrieves the high-watermark recorded for a source, or 0 if it has never been loaded.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to read the etl_watermarks control table with.
+        source(str): The name of the source, e.g. 'events'.
+
+    Returns:
+        int: The recorded watermark.
+    """
+    instrumentation.execute(cur, watermark_select, (source,))
+    row = cur.fetchone()
+    return row[0] if row is not None else 0
+
+
+def set_watermark(cur, source, watermark):
+    """Records a new high-watermark for a source. The caller owns the commit.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to write the etl_watermarks control table with.
+        source(str): The name of the source, e.g. 'events'.
+        watermark(int): The new watermark.
+    """
+    instrumentation.execute(cur, watermark_delete, (source,))
+    instrumentation.execute(cur, watermark_insert, (source, watermark, datetime.datetime.utcnow()))
+
+
+def get_loaded_objects(cur, source):
+    """Retrieves the object keys that have already been loaded for a source.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to read the etl_loaded_objects control table with.
+        source(str): The name of the source, e.g. 'songs'.
+
+    Returns:
+        set of str: The uris of every object already loaded.
+    """
+    instrumentation.execute(cur, loaded_objects_select, (source,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def record_loaded_objects(cur, source, uris):
+    """Marks objects as loaded for a source, LOADED_OBJECTS_BATCH objects per INSERT. The caller owns the commit.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to write the etl_loaded_objects control table with.
+        source(str): The name of the source, e.g. 'songs'.
+        uris(list of str): The uris of the objects that were loaded.
+    """
+    loaded_at = datetime.datetime.utcnow()
+    uris = list(uris)
+    for start in range(0, len(uris), LOADED_OBJECTS_BATCH):
+        batch = uris[start:start + LOADED_OBJECTS_BATCH]
+        params = [value for uri in batch for value in (source, uri, loaded_at)]
+        instrumentation.execute(cur, loaded_objects_insert.format(', '.join(['(%s, %s, %s)'] * len(batch))),
+                                params, name='loaded_objects_insert')
+
+
+def find_new_objects(store, prefix_uri, loaded):
+    """Lists the objects under a prefix that have not been loaded yet.
+
+    Parameters:
+        store(object store): The object store holding the source data.
+        prefix_uri(str): The s3:// prefix of the source data.
+        loaded(set of str): The uris that have already been loaded.
+
+    Returns:
+        list of str: The uris of the new objects, sorted.
+    """
+    return [uri for uri, _ in store.list_objects(prefix_uri) if uri not in loaded]
+
+
+def stage_objects(cur, store, source, uris, manifest_prefix, copy_query):
+    """Writes a manifest of objects for a source and COPYs them into staging.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the COPY with.
+        store(object store): The object store holding the source data and manifests.
+        source(str): The name of the source, e.g. 'events'.
+        uris(list of str): The uris of the objects to stage.
+        manifest_prefix(str): The s3:// prefix to write the manifest under.
+        copy_query(str): The manifest COPY statement for the source's staging table.
+    """
+    manifest_uri = "{}/{}-{}.manifest".format(
+        manifest_prefix.rstrip('/'), source, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'))
+    store.put_object(manifest_uri, build_manifest(uris))
+    instrumentation.execute(cur, copy_query, (manifest_uri,))
+
+
+def stage_new_objects(cur, store, source, prefix_uri, manifest_prefix, copy_query):
+    """Writes a manifest of the new objects for a source and COPYs only those into staging.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the COPY with.
+        store(object store): The object store holding the source data and manifests.
+        source(str): The name of the source, e.g. 'events'.
+        prefix_uri(str): The s3:// prefix of the source data.
+        manifest_prefix(str): The s3:// prefix to write the manifest under.
+        copy_query(str): The manifest COPY statement for the source's staging table.
+
+    Returns:
+        list of str: The uris that were staged, empty if there was nothing new.
+    """
+    new_objects = find_new_objects(store, prefix_uri, get_loaded_objects(cur, source))
+    if new_objects:
+        stage_objects(cur, store, source, new_objects, manifest_prefix, copy_query)
+    return new_objects
+
+
+def load_staged_delta(cur, conn, staged_objects, watermark_source=EVENTS_SOURCE, late_events=False):
+    """Loads the dimension and fact tables from a staged delta and marks the staged objects as loaded.
+
+    The dimension tables are merged from staging, the fact table only takes events past the watermark of
+    watermark_source, resolving their songs in dim_songs, and the time table only start times past its latest one.
+    With late_events, for sources whose events arrive out of order, both instead take every staged event they do
+    not hold yet. The watermark and the loaded object keys are committed in the same transaction as the inserts,
+    then the rollups are refreshed from the first staged event.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the queries.
+        conn(psycopg2 connection): The connection to the data warehouse.
+        staged_objects(dict): The uris that were staged for each source, e.g. {'events': [...]}.
+        watermark_source(str): The etl_watermarks source that tracks the loaded events.
+        late_events(bool): Whether to deduplicate on the songplay id and start time rather than the watermark.
+    """
+    instrumentation.execute(cur, load_lock)
+    events_watermark = get_watermark(cur, watermark_source)
+    if late_events:
+        songplay_insert, time_insert, params = songplay_stream_insert, time_stream_insert, None
+    else:
+        songplay_insert, time_insert, params = songplay_incremental_insert, time_table_insert, (events_watermark,)
+    instrumentation.execute(cur, user_table_insert)
+    instrumentation.execute(cur, song_table_insert)
+    instrumentation.execute(cur, artist_table_insert)
+    instrumentation.execute(cur, songplay_insert, params)
+    instrumentation.execute(cur, time_insert)
+
+    instrumentation.execute(cur, staging_events_ts_range)
+    min_ts, max_ts = cur.fetchone()
+    if max_ts is not None and max_ts > events_watermark:
+        set_watermark(cur, watermark_source, max_ts)
+    for source, uris in staged_objects.items():
+        record_loaded_objects(cur, source, uris)
+    conn.commit()
+    query_cache.invalidate_written([user_table_insert, song_table_insert, artist_table_insert,
+                                    songplay_insert, time_insert])
+    if min_ts is not None:
+        refresh_rollups(cur, conn, min_ts)
+
+
+def load_incremental(cur, conn, store, log_data, song_data, manifest_prefix):
+    """Loads only the source objects and events that arrived since the previous run.
+
+    Staging is truncated and refilled with just the new objects, and the warehouse tables are loaded from that
+    delta by load_staged_delta.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the queries.
+        conn(psycopg2 connection): The connection to the data warehouse.
+        store(object store): The object store holding the source data and manifests.
+        log_data(str): The s3:// prefix of the song play logs.
+        song_data(str): The s3:// prefix of the song metadata.
+        manifest_prefix(str): The s3:// prefix to write generated manifests under.
+    """
+    instrumentation.execute(cur, staging_events_truncate)
+    instrumentation.execute(cur, staging_songs_truncate)
+    conn.commit()
+
+    new_songs = stage_new_objects(cur, store, SONGS_SOURCE, song_data, manifest_prefix,
+                                  sql_queries.staging_songs_manifest_copy)
+    new_events = stage_new_objects(cur, store, EVENTS_SOURCE, log_data, manifest_prefix,
+                                   sql_queries.staging_events_manifest_copy)
+    conn.commit()
+    update_song_keys(cur, conn)
+    load_staged_delta(cur, conn, {SONGS_SOURCE: new_songs, EVENTS_SOURCE: new_events})
+
+
+def parse_args(argv=None):
+    """Parses and validates the command line of etl.py, exiting with a usage error on invalid arguments.
+
+    Parameters:
+        argv(list of str): The command line arguments, sys.argv[1:] when None.
+
+    Returns:
+        argparse.Namespace: The arguments.
+    """
+    parser = argparse.ArgumentParser(description="Load the S3 song and log data into the data warehouse.")
+    # Each mode is its own load path, so at most one of them can be chosen.
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--incremental', action='store_true',
+                      help="only load objects and events that are new since the previous run")
+    mode.add_argument('--parallel', action='store_true',
+                      help="run independent statements concurrently over a connection pool")
+    mode.add_argument('--parquet', action='store_true',
+                      help="convert the raw JSON to Parquet first and stage it with COPY ... FORMAT AS PARQUET")
+    mode.add_argument('--clean', action='store_true',
+                      help="validate and deduplicate the log JSON first, rejecting events that would fail COPY")
+    mode.add_argument('--compact', action='store_true',
+                      help="merge the small source objects into slice-aligned gzip files first")
+    mode.add_argument('--spectrum', action='store_true',
+                      help="read the Parquet copies through external tables instead of loading staging tables")
+    parser.add_argument('--start-date', type=parse_date,
+                        help="with --spectrum, the first day of log data to insert, YYYY-MM-DD")
+    parser.add_argument('--end-date', type=parse_date,
+                        help="with --spectrum, the day after the last day of log data to insert, YYYY-MM-DD")
+    parser.add_argument('--maintain', action='store_true',
+                        help="vacuum and analyze the tables past the [MAINTENANCE] thresholds after the load")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to run against: the Redshift cluster or the local DuckDB engine")
+    parser.add_argument('--metrics-file', help="write per-statement metrics to this Prometheus textfile")
+    args = parser.parse_args(argv)
+    if (args.start_date or args.end_date) and not args.spectrum:
+        parser.error("--start-date and --end-date need --spectrum")
+    if args.maintain and args.backend != REDSHIFT:
+        parser.error("--maintain needs the redshift backend")
+    return args
+
+
+def main(argv=None):
     """The main function for etl.py.
 
     Reads in database parameters, then creates a connection and cursor to execute queries.
-    Copies S3 buckets into staging tables, then inserts data into data warehouse tables.
+    Copies S3 buckets into staging tables, then inserts data into data warehouse tables. At most one mode can be
+    chosen: with --incremental only the objects and events that are new since the last run are loaded, with
+    --parallel the statements run as a dependency DAG over a connection pool, with --parquet the raw JSON
+    is converted to Parquet before it is staged, with --clean only valid, unique song plays are staged,
+    with --compact the small source objects are merged into gzipped files sized for the cluster's slices
+    first, and with --spectrum nothing is staged: the new source objects are converted to Parquet and the
+    inserts read them in place through external tables, pruned to the log partitions past the last run and
+    between --start-date and --end-date. Every mode ends by refreshing the rollup tables, and cached query
+    results that read a loaded table are invalidated. With --maintain the tables whose sort order or
+    statistics degraded are then vacuumed and analyzed.
+
+    Parameters:
+        argv(list of str): The command line arguments, sys.argv[1:] when None.
     """
+    args = parse_args(argv)
+    instrumentation.configure(capture_query_ids=args.backend == REDSHIFT)
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    query_cache.configure(config.get('CACHE', 'DIRECTORY', fallback=None))
+    store = get_object_store(config, args.backend)
+
+    if args.parallel:
+        staging_steps, replacements = build_staging_steps(store, config)
+        max_connections = config.getint('ETL', 'MAX_CONNECTIONS')
+        pool = create_pool(config, max_connections, args.backend)
+        try:
+            print_timings(run_parallel(pool, max_connections, staging_steps, replacements,
+                                       config.getint('ETL', 'COPY_CONCURRENCY')))
+            query_cache.invalidate_written(insert_table_queries)
+            conn = pool.getconn()
+            try:
+                refresh_rollups(conn.cursor(), conn)
+            finally:
+                pool.putconn(conn)
+        finally:
+            pool.closeall()
+    else:
+        conn = connect(config, args.backend)
+        cur = conn.cursor()
+
+        if args.incremental:
+            load_incremental(cur, conn, store,
+                             log_data=config['S3']['LOG_DATA'].strip("'"),
+                             song_data=config['S3']['SONG_DATA'].strip("'"),
+                             manifest_prefix=config['ETL']['MANIFEST_PREFIX'].strip("'"))
+        elif args.parquet:
+            load_staging_tables_parquet(cur, conn, *convert_all(store, config))
+            insert_tables(cur, conn)
+        elif args.clean:
+            load_staging_tables_clean(cur, conn, clean_logs(store, config))
+            insert_tables(cur, conn)
+        elif args.compact:
+            load_staging_tables_compact(cur, conn, *compact_all(store, config, cluster_slices(args.backend)))
+            insert_tables(cur, conn)
+        elif args.spectrum:
+            load_spectrum(cur, conn, store, config, args.backend, args.start_date, args.end_date)
+        else:
+            load_staging_tables(cur, conn)
+            insert_tables(cur, conn)
+
+        conn.close()
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    if args.maintain:
+        conn = connect(config, args.backend)
+        maintain(conn, config)
+        conn.close()
 
-    conn.close()
+    if args.metrics_file:
+        instrumentation.write_prometheus_textfile(args.metrics_file, instrumentation.recorder.records)
 
 
 if __name__ == "__main__":
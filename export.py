@@ -0,0 +1,306 @@
+import argparse
+import configparser
+import itertools
+import os
+import re
+
+import instrumentation
+from backends import BACKENDS, REDSHIFT, connect, get_object_store
+from parquet_stage import clear_prefix
+from settings import load_settings
+from sql_queries import export_queries, unload_query
+
+METHODS = ('unload', 'stream')
+BATCH_ROWS = 100000
+MAX_ROWS_PER_FILE = 1000000
+MAX_FILE_SIZE_MB = 256
+TABLE_PATTERN = re.compile(r'^\w+$')
+# The files and partition directories a stream export writes, the only ones it deletes again.
+EXPORT_FILE_PATTERN = re.compile(r'^part-\d+\.parquet$')
+PARTITION_DIRECTORY_PATTERN = re.compile(r'^\w+=[^/]*$')
+# The Arrow types of the Postgres type OIDs psycopg2 reports for Redshift columns. Other columns, and every
+# column of the duckdb backend, get the type Arrow infers from the values of the first batch.
+ARROW_TYPES = {16: 'bool', 20: 'int64', 21: 'int16', 23: 'int32', 700: 'float', 701: 'double', 25: 'string',
+               1042: 'string', 1043: 'string', 1082: 'date32', 1114: 'timestamp[us]'}
+
+
+def export_query(source):
+    """Returns the query of a named export in export_queries, or one that selects a whole table.
+
+    Parameters:
+        source(str): An export_queries name or a table name.
+
+    Returns:
+        str: The SELECT statement.
+
+    Raises:
+        ValueError: If the source is neither an export name nor a table name.
+    """
+    if source in export_queries:
+        return export_queries[source]
+    if TABLE_PATTERN.match(source) is None:
+        raise ValueError("{!r} is neither an export in export_queries nor a table name".format(source))
+    return "SELECT * FROM {}".format(source)
+
+
+def render_unload(query, destination, role_arn, partition_by=(), max_file_size_mb=MAX_FILE_SIZE_MB):
+    """Renders the UNLOAD of a query to Parquet files under an S3 prefix.
+
+    Parameters:
+        query(str): The SELECT statement.
+        destination(str): The s3:// prefix to write under.
+        role_arn(str): The ARN of the role the cluster writes S3 with.
+        partition_by(list of str): The columns to partition the files by, as col=value/ directories.
+        max_file_size_mb(int): The size at which the files of a slice roll over.
+
+    Returns:
+        str: The UNLOAD statement.
+    """
+    partition = "PARTITION BY ({})\n".format(', '.join(partition_by)) if partition_by else ''
+    return unload_query.format(query="'{}'".format(query.strip().replace("'", "''")),
+                               destination=destination.rstrip('/') + '/', role_arn=role_arn,
+                               partition_by=partition, max_file_size_mb=int(max_file_size_mb))
+
+
+def unload(conn, store, query, destination, role_arn, partition_by=(), max_file_size_mb=MAX_FILE_SIZE_MB):
+    """Exports a query to Parquet in S3 with UNLOAD, every slice of the cluster writing its own files.
+
+    The previous export under the destination is deleted first. UNLOAD also writes a manifest listing the files,
+    at <destination>/manifest.
+
+    Parameters:
+        conn(psycopg2 connection): The connection to the cluster.
+        store(object store): The object store holding the destination.
+        query(str): The SELECT statement.
+        destination(str): The s3:// prefix to write under.
+        role_arn(str): The ARN of the role the cluster writes S3 with.
+        partition_by(list of str): The columns to partition the files by.
+        max_file_size_mb(int): The size at which the files of a slice roll over.
+
+    Returns:
+        list of tuple: The (uri, size in bytes) of each Parquet file written.
+    """
+    destination = destination.rstrip('/') + '/'
+    clear_prefix(store, destination)
+    cur = conn.cursor()
+    instrumentation.execute(cur, render_unload(query, destination, role_arn, partition_by, max_file_size_mb),
+                            name='unload')
+    conn.commit()
+    return [(uri, size) for uri, size in store.list_objects(destination) if not uri.endswith('manifest')]
+
+
+def arrow_schema(description, rows):
+    """Builds the Arrow schema of a result from its cursor description and first rows.
+
+    Parameters:
+        description(list of tuple): The cursor description, with the name and type code of each column.
+        rows(list of tuple): The first batch of rows.
+
+    Returns:
+        pyarrow.Schema: The schema.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for index, column in enumerate(description):
+        name, type_code = column[0], column[1]
+        if type_code in ARROW_TYPES:
+            data_type = pa.type_for_alias(ARROW_TYPES[type_code])
+        else:
+            data_type = pa.array([row[index] for row in rows]).type
+            if pa.types.is_null(data_type):
+                data_type = pa.string()
+            elif pa.types.is_decimal(data_type):
+                # Later batches may hold wider values than the first, so keep only the scale.
+                data_type = pa.decimal128(38, data_type.scale)
+        fields.append(pa.field(name, data_type))
+    return pa.schema(fields)
+
+
+def iter_batches(cur, batch_rows=BATCH_ROWS):
+    """Fetches the rows of an executed query as Arrow record batches, holding one batch in memory at a time.
+
+    Parameters:
+        cur(cursor): The cursor the query was executed on.
+        batch_rows(int): The rows per batch.
+
+    Yields:
+        pyarrow.RecordBatch: Each batch of rows.
+    """
+    import pyarrow as pa
+
+    schema = None
+    while True:
+        rows = cur.fetchmany(batch_rows)
+        if not rows:
+            return
+        if schema is None:
+            schema = arrow_schema(cur.description, rows)
+        yield pa.RecordBatch.from_arrays([pa.array(values, type=field.type)
+                                          for values, field in zip(zip(*rows), schema)], schema=schema)
+
+
+def open_stream_cursor(conn, backend=REDSHIFT, batch_rows=BATCH_ROWS):
+    """Opens a cursor that fetches a result in batches instead of all at once.
+
+    On Redshift this is a named, server-side cursor, so every fetchmany is one FETCH of batch_rows rows. Redshift
+    materializes a cursor's result on the leader node, which is why UNLOAD is preferred for large exports.
+
+    Parameters:
+        conn(connection): The connection to the data warehouse.
+        backend(str): 'redshift' or 'duckdb', whose results are already streamed by fetchmany.
+        batch_rows(int): The rows per fetch.
+
+    Returns:
+        cursor: The cursor.
+    """
+    if backend != REDSHIFT:
+        return conn.cursor()
+    cur = conn.cursor(name='export_stream')
+    cur.itersize = batch_rows
+    return cur
+
+
+def clear_export(output_dir, overwrite=False):
+    """Deletes the files of a previous stream export from a directory, leaving every other file alone.
+
+    Only part-<n>.parquet files, directly in the directory or in its col=value/ partition directories, are
+    deleted, and then the partition directories they leave empty.
+
+    Parameters:
+        output_dir(str): The local directory of the export.
+        overwrite(bool): Whether to export into a directory that also holds other files.
+
+    Raises:
+        ValueError: If the directory holds other files and overwrite is not set.
+    """
+    if not os.path.isdir(output_dir):
+        return
+    exported = []
+    others = []
+    for directory, subdirectories, files in os.walk(output_dir):
+        relative = os.path.relpath(directory, output_dir)
+        in_export = relative == '.' or all(PARTITION_DIRECTORY_PATTERN.match(part) for part in relative.split(os.sep))
+        for name in files:
+            path = os.path.join(directory, name)
+            (exported if in_export and EXPORT_FILE_PATTERN.match(name) else others).append(path)
+    if others and not overwrite:
+        raise ValueError("{} holds {} files that are not from an export, e.g. {}; use --overwrite to export next "
+                         "to them".format(output_dir, len(others), others[0]))
+
+    for path in exported:
+        os.remove(path)
+    for directory, _, _ in sorted(os.walk(output_dir), key=lambda entry: -len(entry[0])):
+        if directory != output_dir and PARTITION_DIRECTORY_PATTERN.match(os.path.basename(directory)) \
+                and not os.listdir(directory):
+            os.rmdir(directory)
+
+
+def stream_export(conn, query, output_dir, backend=REDSHIFT, partition_by=(), batch_rows=BATCH_ROWS,
+                  max_rows_per_file=MAX_ROWS_PER_FILE, overwrite=False):
+    """Exports a query to local Parquet files through a cursor, for when UNLOAD is not available.
+
+    Rows are fetched and written batch_rows at a time and files roll over after max_rows_per_file rows, so
+    memory stays bounded regardless of the result size. Partitioned files use the col=value/ directories of
+    UNLOAD. The files of the previous export in output_dir are deleted first, by clear_export.
+
+    Parameters:
+        conn(connection): The connection to the data warehouse.
+        query(str): The SELECT statement.
+        output_dir(str): The local directory to write under.
+        backend(str): 'redshift' or 'duckdb'.
+        partition_by(list of str): The columns to partition the files by.
+        batch_rows(int): The rows per fetch and per row group.
+        max_rows_per_file(int): The rows after which a file rolls over.
+        overwrite(bool): Whether to export into a directory that also holds other files.
+
+    Returns:
+        int: The number of rows exported.
+
+    Raises:
+        ValueError: If output_dir holds files that are not from an export and overwrite is not set.
+    """
+    import pyarrow.dataset as ds
+
+    clear_export(output_dir, overwrite)
+    cur = open_stream_cursor(conn, backend, batch_rows)
+    try:
+        instrumentation.execute(cur, query, name='export_stream')
+        batches = iter_batches(cur, batch_rows)
+        first = next(batches, None)
+        if first is None:
+            return 0
+        exported = [0]
+
+        def counted(batches):
+            for batch in batches:
+                exported[0] += batch.num_rows
+                yield batch
+
+        ds.write_dataset(counted(itertools.chain([first], batches)), output_dir, schema=first.schema,
+                         format='parquet', partitioning=list(partition_by) or None,
+                         partitioning_flavor='hive' if partition_by else None,
+                         basename_template='part-{i}.parquet', max_rows_per_file=max_rows_per_file,
+                         max_rows_per_group=min(batch_rows, max_rows_per_file),
+                         existing_data_behavior='overwrite_or_ignore')
+        return exported[0]
+    finally:
+        cur.close()
+        conn.commit()
+
+
+def main():
+    """The main function for export.py.
+
+    Exports a named query from export_queries, e.g. user_song_plays, or a whole table to Parquet for
+    downstream ML. By default the cluster UNLOADs it in parallel under PREFIX in the [EXPORT] section of
+    dwh.cfg; with --method stream, or the duckdb backend, it is fetched in batches into LOCAL_DIRECTORY instead.
+    """
+    parser = argparse.ArgumentParser(description="Export a query or table to Parquet for ML feature extraction.")
+    parser.add_argument('source', help="a query name from export_queries ({}) or a table name".format(
+        ', '.join(sorted(export_queries))))
+    parser.add_argument('--method', choices=METHODS,
+                        help="UNLOAD from the cluster to S3, or stream through a cursor into local files "
+                             "(unload on redshift, stream on duckdb by default)")
+    parser.add_argument('--partition-by', action='append', default=[], metavar='COLUMN',
+                        help="partition the files by this column, may be repeated")
+    parser.add_argument('--output', help="the s3:// prefix to UNLOAD to, or the directory to stream into")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="with --method stream, also export into a directory that holds other files")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to export from: the Redshift cluster or the local DuckDB engine")
+    args = parser.parse_args()
+    method = args.method or ('unload' if args.backend == REDSHIFT else 'stream')
+    if method == 'unload' and args.backend != REDSHIFT:
+        parser.error("--method unload needs the redshift backend")
+    try:
+        query = export_query(args.source)
+    except ValueError as e:
+        parser.error(str(e))
+    instrumentation.configure(capture_query_ids=args.backend == REDSHIFT)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    export = config['EXPORT']
+    conn = connect(config, args.backend)
+    if method == 'unload':
+        destination = args.output or "{}/{}".format(export['PREFIX'].strip("'").rstrip('/'), args.source)
+        files = unload(conn, get_object_store(config, args.backend), query, destination, load_settings().role_arn,
+                       args.partition_by, export.getint('MAX_FILE_SIZE_MB'))
+        print("Unloaded {} Parquet files ({:,.1f} MB) to {}".format(
+            len(files), sum(size for _, size in files) / 1e6, destination))
+    else:
+        output_dir = args.output or os.path.join(export['LOCAL_DIRECTORY'], args.source)
+        try:
+            clear_export(output_dir, args.overwrite)
+        except ValueError as e:
+            conn.close()
+            parser.error(str(e))
+        rows = stream_export(conn, query, output_dir, args.backend, args.partition_by, export.getint('BATCH_ROWS'),
+                             export.getint('MAX_ROWS_PER_FILE'), args.overwrite)
+        print("Exported {:,} rows to {}".format(rows, output_dir))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,20 @@
-import boto3
+import argparse
 import configparser
 import json
-import time
-
-config = configparser.ConfigParser()
-config.read('aws_cred.cfg')
-
-# AWS Creds
-KEY = config.get('AWS', 'KEY')
-SECRET = config.get('AWS', 'SECRET')
-
-# Redshift Cluster Details
-DWH_CLUSTER_TYPE = config.get("DWH", "DWH_CLUSTER_TYPE")
-DWH_NUM_NODES = config.get("DWH", "DWH_NUM_NODES")
-DWH_NODE_TYPE = config.get("DWH", "DWH_NODE_TYPE")
-DWH_CLUSTER_IDENTIFIER = config.get("DWH", "DWH_CLUSTER_IDENTIFIER")
-DWH_DB = config.get("DWH", "DWH_DB")
-DWH_DB_USER = config.get("DWH", "DWH_DB_USER")
-DWH_DB_PASSWORD = config.get("DWH", "DWH_DB_PASSWORD")
-DWH_PORT = config.get("DWH", "DWH_PORT")
-DWH_IAM_ROLE_NAME = config.get("DWH", "DWH_IAM_ROLE_NAME")
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+from settings import load_aws_settings
 
 # S3 Read Only Policy ARN
 S3_READ_ONLY_POLICY_ARN = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
 
+# How often and how many times the boto3 waiters poll while the cluster comes up or goes away.
+WAITER_CONFIG = {'Delay': 15, 'MaxAttempts': 120}
+
 
 def create_ec2_resource():
     """Creates an EC2 resource on AWS using the Boto3 package and AWS KEY and Secret information.
@@ -31,11 +22,12 @@ def create_ec2_resource():
     Returns:
         boto3 resource: EC2 resource for given AWS instance.
     """
+    aws = load_aws_settings()
     try:
         ec2_resource = boto3.resource('ec2',
-                                      region_name="us-west-2",
-                                      aws_access_key_id=KEY,
-                                      aws_secret_access_key=SECRET
+                                      region_name=aws.region,
+                                      aws_access_key_id=aws.key,
+                                      aws_secret_access_key=aws.secret
                                       )
         return ec2_resource
     except Exception as e:
@@ -48,11 +40,12 @@ def create_iam_resource():
     Returns:
         boto3 resource: IAM resource for given AWS instance.
     """
+    aws = load_aws_settings()
     try:
         iam_resource = boto3.client('iam',
-                                    aws_access_key_id=KEY,
-                                    aws_secret_access_key=SECRET,
-                                    region_name='us-west-2'
+                                    aws_access_key_id=aws.key,
+                                    aws_secret_access_key=aws.secret,
+                                    region_name=aws.region
                                     )
         return iam_resource
     except Exception as e:
@@ -65,11 +58,12 @@ def create_redshift_resource():
     Returns:
         boto3 resource: Redshift resource for given AWS instance.
     """
+    aws = load_aws_settings()
     try:
         redshift_resource = boto3.client('redshift',
-                                         region_name="us-west-2",
-                                         aws_access_key_id=KEY,
-                                         aws_secret_access_key=SECRET
+                                         region_name=aws.region,
+                                         aws_access_key_id=aws.key,
+                                         aws_secret_access_key=aws.secret
                                          )
         return redshift_resource
     except Exception as e:
@@ -77,11 +71,14 @@ def create_redshift_resource():
 
 
 def create_dwh_iam_role(iam_resource, role_name):
-    """Creates an IAM Role with given role name.
+    """Creates an IAM Role with given role name, unless it already exists.
 
     Parameters:
         iam_resource(boto3 resource): Iam resource for AWS instance.
         role_name(str): Name of the role to create.
+
+    Returns:
+        bool: Whether the role was created.
     """
     assume_role_policy_doc = {
         "Version": "2012-10-17",
@@ -98,25 +95,23 @@ def create_dwh_iam_role(iam_resource, role_name):
             AssumeRolePolicyDocument=json.dumps(assume_role_policy_doc),
             Description="Allows Redshift to call AWS Services"
         )
-    except Exception as e:
-        print(e)
+        return True
+    except iam_resource.exceptions.EntityAlreadyExistsException:
+        return False
 
 
 def attach_policy_to_iam_role(policy_arn, iam_resource, role_name):
-    """Attaches an AWS policy to the named IAM role.
+    """Attaches an AWS policy to the named IAM role. Attaching a policy that is already attached does nothing.
 
     Parameters:
         policy_arn(str): The Amazon Resource Name for the policy to attach to the role.
         iam_resource(boto3 resource): The Iam Resource that contains the role to attach given policy.
         role_name(str): The name of the role to attach given policy.
     """
-    try:
-        iam_resource.attach_role_policy(
-            RoleName=role_name,
-            PolicyArn=policy_arn
-        )
-    except Exception as e:
-        print(e)
+    iam_resource.attach_role_policy(
+        RoleName=role_name,
+        PolicyArn=policy_arn
+    )
 
 
 def get_iam_role_arn(iam_resource, role_name):
@@ -135,37 +130,57 @@ def get_iam_role_arn(iam_resource, role_name):
 
 
 def create_redshift_cluster(redshift_resource, iam_roles):
-    """Creates Redshift Cluster with associated Roles and then prints to screen the Cluster Endpoint once available.
+    """Starts creating the Redshift Cluster with associated Roles, unless it already exists.
+
+    Does not wait for the cluster to become available, see wait_for_cluster.
 
     Parameters:
         redshift_resource(boto3 resource): The Redshift Resource to house the database cluster.
         iam_roles(list of strings): The IAM Roles to attach to the Redshift cluster.
+
+    Returns:
+        dict: The cluster details given by boto3 describe clusters method.
+
+    Raises:
+        RuntimeError: If a cluster with the same identifier is being deleted.
     """
-    myClusterProps = None
-    try:
-        redshift_resource.create_cluster(
-            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
-            ClusterType=DWH_CLUSTER_TYPE,
-            NodeType=DWH_NODE_TYPE,
-            NumberOfNodes=int(DWH_NUM_NODES),
-            DBName=DWH_DB,
-            MasterUsername=DWH_DB_USER,
-            MasterUserPassword=DWH_DB_PASSWORD,
-            IamRoles=iam_roles
-        )
-        myClusterProps = redshift_resource.describe_clusters(
-            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-    except Exception as e:
-        print(e)
+    aws = load_aws_settings()
+    cluster_props = get_redshift_cluster_props(
+        redshift_resource=redshift_resource, cluster_identifier=aws.cluster_identifier)
+    if cluster_props is not None:
+        if cluster_props['ClusterStatus'] == 'deleting':
+            raise RuntimeError("Cluster {} is being deleted, run iac.py again once it is gone".format(
+                aws.cluster_identifier))
+        print("Redshift Cluster {} already exists ({})".format(aws.cluster_identifier,
+                                                             cluster_props['ClusterStatus']))
+        return cluster_props
+
+    return redshift_resource.create_cluster(
+        ClusterIdentifier=aws.cluster_identifier,
+        ClusterType=aws.cluster_type,
+        NodeType=aws.node_type,
+        NumberOfNodes=aws.num_nodes,
+        DBName=aws.db,
+        MasterUsername=aws.db_user,
+        MasterUserPassword=aws.db_password,
+        Port=aws.port,
+        IamRoles=iam_roles
+    )['Cluster']
+
+
+def wait_for_cluster(redshift_resource, cluster_identifier):
+    """Blocks on the boto3 cluster_available waiter until the cluster accepts connections.
 
-    if myClusterProps is not None:
-        while(myClusterProps['ClusterStatus'] != 'available'):
-            time.sleep(10)
-            myClusterProps = get_redshift_cluster_props(
-                redshift_resource=redshift_resource, cluster_identifier=DWH_CLUSTER_IDENTIFIER)
+    Parameters:
+        redshift_resource(boto3 resource): The Redshift Resource that contains the DWH cluster.
+        cluster_identifier(str): The DWH identifier on Redshift to wait for.
 
-        DWH_ENDPOINT = myClusterProps['Endpoint']['Address']
-        print("DWH_ENDPOINT :: ", DWH_ENDPOINT)
+    Returns:
+        dict: The cluster details once it is available.
+    """
+    redshift_resource.get_waiter('cluster_available').wait(
+        ClusterIdentifier=cluster_identifier, WaiterConfig=WAITER_CONFIG)
+    return get_redshift_cluster_props(redshift_resource=redshift_resource, cluster_identifier=cluster_identifier)
 
 
 def get_redshift_cluster_props(redshift_resource, cluster_identifier):
@@ -176,28 +191,34 @@ def get_redshift_cluster_props(redshift_resource, cluster_identifier):
         cluster_identifier(str): The DWH identifier on Redshift that we need information on.
 
     Returns:
-        dict: Dictionary of cluster details given by boto3 describe clusters method.
+        dict: Dictionary of cluster details given by boto3 describe clusters method, None if there is no such
+        cluster.
     """
     try:
-        cluster_info = redshift_resource.describe_clusters(
+        return redshift_resource.describe_clusters(
             ClusterIdentifier=cluster_identifier
         )['Clusters'][0]
-    except Exception as e:
-        print(e)
-    return cluster_info
+    except redshift_resource.exceptions.ClusterNotFoundFault:
+        return None
 
 
 def open_tcp_port(ec2_resource, port, vpc_id):
-    """Opens a TCP Port to access the cluster endpoint.
+    """Opens a TCP Port to access the cluster endpoint, unless the default security group already allows it.
 
     Parameters:
         ec2_resource(boto3 resource): The EC2 Resource that will allow access to the DWH.
-        port(str): The port number to give access to Cluster.
-        vpc_id(str): The Virtual Private Cloud identifier that contains the DWH.
+        port(int): The port number to give access to Cluster.
+        vpc_id(str): The Virtual Private Cloud identifier that contains the DWH, None for the default VPC
+            that clusters without a subnet group are created in.
+
+    Returns:
+        bool: Whether the port was opened.
     """
+    if vpc_id is None:
+        vpc_id = list(ec2_resource.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]))[0].id
+    vpc = ec2_resource.Vpc(id=vpc_id)
+    defaultSg = list(vpc.security_groups.filter(Filters=[{'Name': 'group-name', 'Values': ['default']}]))[0]
     try:
-        vpc = ec2_resource.Vpc(id=vpc_id)
-        defaultSg = list(vpc.security_groups.all())[0]
         defaultSg.authorize_ingress(
             GroupName=defaultSg.group_name,
             CidrIp='0.0.0.0/0',
@@ -205,26 +226,38 @@ def open_tcp_port(ec2_resource, port, vpc_id):
             FromPort=int(port),
             ToPort=int(port)
         )
-    except Exception as e:
-        print(e)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
+        return False
 
 
 def delete_cluster(redshift_resource, cluster_id):
-    """Deletes identified cluster on the given Redshift resource.
+    """Deletes identified cluster on the given Redshift resource and waits until it is gone.
 
     Parameters:
         redshift_resource(boto3 resource): The Redshift resource that holds the DWH cluster to be deleted.
         cluster_id(str): The Cluster Identifier that needs to be deleted.
+
+    Returns:
+        bool: Whether there was a cluster to delete.
     """
     try:
         redshift_resource.delete_cluster(
             ClusterIdentifier=cluster_id,  SkipFinalClusterSnapshot=True)
-    except Exception as e:
-        print(e)
+        deleted = True
+    except redshift_resource.exceptions.ClusterNotFoundFault:
+        return False
+    except redshift_resource.exceptions.InvalidClusterStateFault:
+        # Already being deleted by an earlier run.
+        deleted = False
+    redshift_resource.get_waiter('cluster_deleted').wait(ClusterIdentifier=cluster_id, WaiterConfig=WAITER_CONFIG)
+    return deleted
 
 
 def detach_policy_from_role(iam_resource, policy_arn, role_name):
-    """Detaches Amazon Named Policy from given role.
+    """Detaches Amazon Named Policy from given role, if it is attached.
 
     Parameters:
         iam_resource(boto3 resource): The IAM Resource that holds the given role.
@@ -234,79 +267,156 @@ def detach_policy_from_role(iam_resource, policy_arn, role_name):
     try:
         iam_resource.detach_role_policy(
             RoleName=role_name, PolicyArn=policy_arn)
-    except Exception as e:
-        print(e)
+    except iam_resource.exceptions.NoSuchEntityException:
+        pass
+
+
+def delete_dwh_iam_role(iam_resource, role_name):
+    """Detaches the S3 read policy from the named role and deletes it, if it exists.
+
+    Parameters:
+        iam_resource(boto3 resource): The IAM Resource that holds the given role.
+        role_name(str): The name of the role to delete.
+
+    Returns:
+        bool: Whether there was a role to delete.
+    """
+    detach_policy_from_role(iam_resource=iam_resource, policy_arn=S3_READ_ONLY_POLICY_ARN, role_name=role_name)
+    try:
+        iam_resource.delete_role(RoleName=role_name)
+        return True
+    except iam_resource.exceptions.NoSuchEntityException:
+        return False
+
+
+def write_dwh_config(path, endpoint, role_arn):
+    """Writes the cluster endpoint, connection details and role ARN into dwh.cfg, keeping its other settings.
+
+    The file is replaced atomically, so an interrupted write never leaves a partial dwh.cfg.
+
+    Parameters:
+        path(str): The path of dwh.cfg.
+        endpoint(str): The address of the cluster endpoint.
+        role_arn(str): The Amazon Resource Name of the role the cluster reads S3 with.
+    """
+    aws = load_aws_settings()
+    dwh_config = configparser.ConfigParser(interpolation=None)
+    # Keep the upper case keys of dwh.cfg.
+    dwh_config.optionxform = str
+    dwh_config.read(path)
+    for section in ('CLUSTER', 'IAM_ROLE'):
+        if not dwh_config.has_section(section):
+            dwh_config.add_section(section)
+    dwh_config['CLUSTER']['HOST'] = endpoint
+    dwh_config['CLUSTER']['DB_NAME'] = aws.db
+    dwh_config['CLUSTER']['DB_USER'] = aws.db_user
+    dwh_config['CLUSTER']['DB_PASSWORD'] = aws.db_password
+    dwh_config['CLUSTER']['DB_PORT'] = str(aws.port)
+    dwh_config['IAM_ROLE']['ARN'] = role_arn
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        dwh_config.write(f, space_around_delimiters=False)
+    os.replace(temporary_path, path)
 
 
 def teardown_data_warehouse(redshift_resource, iam_resource):
     """Removes all resources from DataWarehouse to limit costs.
 
+    The cluster and the role are removed concurrently, and resources that are already gone are skipped.
+
     Parameters:
         redshift_resource(boto3 resource): The Redshift resource that contains the DataWarehouse.
         iam_resource(boto3 resource): The IAM Resource that contains the DWH Role.
     """
-    delete_cluster(redshift_resource=redshift_resource,
-                   cluster_id=DWH_CLUSTER_IDENTIFIER)
-    detach_policy_from_role(iam_resource=iam_resource,
-                            policy_arn=S3_READ_ONLY_POLICY_ARN, role_name=DWH_IAM_ROLE_NAME)
-    iam_resource.delete_role(RoleName=DWH_IAM_ROLE_NAME)
+    aws = load_aws_settings()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        cluster = pool.submit(delete_cluster, redshift_resource=redshift_resource, cluster_id=aws.cluster_identifier)
+        role = pool.submit(delete_dwh_iam_role, iam_resource=iam_resource, role_name=aws.iam_role_name)
+        print("Deleted Iam Role" if role.result() else "No Iam Role to delete")
+        print("Deleted Redshift Cluster" if cluster.result() else "No Redshift Cluster to delete")
 
 
 def setup_data_warehouse(iam_resource, redshift_resource, ec2_resource):
     """Creates the data warehouse cluster and role given IAM, Redshift, and EC2 resources.
 
+    Steps that do not depend on each other run concurrently: once the role exists, the S3 read policy is
+    attached while the cluster is created, and the TCP port is opened while the cluster comes up. Resources
+    that already exist are reused, so running it again after a failure picks up where it stopped.
+
     Parameters:
         iam_resource(boto3 resource): The IAM Resource to hold the DWH Role.
-        redshift_resource(boto3 resource): The Redshift Resource to house the DWH cluster. 
+        redshift_resource(boto3 resource): The Redshift Resource to house the DWH cluster.
         ec2_resource(boto3 resource): The EC2 Resource that will direct traffic to the DWH cluser.
+
+    Returns:
+        tuple: The cluster endpoint address and the role ARN.
     """
-    # Create Role to access S3 Bucket
-    print("Creating New Iam Role")
-    create_dwh_iam_role(iam_resource=iam_resource, role_name=DWH_IAM_ROLE_NAME)
+    aws = load_aws_settings()
 
-    # Attach Read S3 Read Only Policy to Created Role
-    print("Attaching S3 Read Policy to DWH IAM ROLE")
-    attach_policy_to_iam_role(
-        policy_arn=S3_READ_ONLY_POLICY_ARN,
-        iam_resource=iam_resource,
-        role_name=DWH_IAM_ROLE_NAME)
+    # Create Role to access S3 Bucket
+    created = create_dwh_iam_role(iam_resource=iam_resource, role_name=aws.iam_role_name)
+    print("Created New Iam Role" if created else "Iam Role {} already exists".format(aws.iam_role_name))
 
     # Get IAM Role ARN to Add to Redshift Cluster
     DWH_IAM_ROLE_ARN = get_iam_role_arn(
-        iam_resource=iam_resource, role_name=DWH_IAM_ROLE_NAME)
+        iam_resource=iam_resource, role_name=aws.iam_role_name)
     print("DWH_IAM_ROLE_ARN :: ", DWH_IAM_ROLE_ARN)
 
-    # Create Redshift Cluster for DWH
-    print("Creating Redshift Cluster")
-    create_redshift_cluster(
-        redshift_resource=redshift_resource, iam_roles=[DWH_IAM_ROLE_ARN])
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        # Attach Read S3 Read Only Policy to Created Role
+        policy = pool.submit(attach_policy_to_iam_role, policy_arn=S3_READ_ONLY_POLICY_ARN,
+                             iam_resource=iam_resource, role_name=aws.iam_role_name)
 
-    # Get Redshift VPC ID to add TCP Port
-    redshift_cluster_props = get_redshift_cluster_props(
-        redshift_resource=redshift_resource, cluster_identifier=DWH_CLUSTER_IDENTIFIER)
-    vpc_id = redshift_cluster_props['VpcId']
+        # Create Redshift Cluster for DWH
+        print("Creating Redshift Cluster")
+        redshift_cluster_props = create_redshift_cluster(
+            redshift_resource=redshift_resource, iam_roles=[DWH_IAM_ROLE_ARN])
 
-    # Open Incoming TCP port to access Cluster Endpoint
-    print("Opening TCP Port")
-    open_tcp_port(ec2_resource=ec2_resource, port=DWH_PORT,
-                  vpc_id=vpc_id)
+        # Open Incoming TCP port to access Cluster Endpoint while the cluster comes up
+        port = pool.submit(open_tcp_port, ec2_resource=ec2_resource, port=aws.port,
+                           vpc_id=redshift_cluster_props.get('VpcId'))
+        available = pool.submit(wait_for_cluster, redshift_resource=redshift_resource,
+                                cluster_identifier=aws.cluster_identifier)
+
+        policy.result()
+        print("Attached S3 Read Policy to DWH IAM ROLE")
+        print("Opened TCP Port" if port.result() else "TCP Port {} is already open".format(aws.port))
+        DWH_ENDPOINT = available.result()['Endpoint']['Address']
+    print("DWH_ENDPOINT :: ", DWH_ENDPOINT)
+    return DWH_ENDPOINT, DWH_IAM_ROLE_ARN
 
 
 def main():
+    """The main function for iac.py.
+
+    Sets up the data warehouse described by aws_cred.cfg and writes its endpoint and role ARN into dwh.cfg,
+    or tears it down with --teardown.
+    """
+    parser = argparse.ArgumentParser(description="Provision or tear down the Redshift cluster and its IAM role.")
+    parser.add_argument('--teardown', action='store_true', help="delete the cluster and the role instead")
+    parser.add_argument('--config', default='dwh.cfg',
+                        help="the config file to write the endpoint and role ARN into")
+    args = parser.parse_args()
+
     # Create Iam Resource
     iam_resource = create_iam_resource()
 
     # Create Redshift Resource
     redshift_resource = create_redshift_resource()
 
+    if args.teardown:
+        # Tear down Data Warehouse
+        teardown_data_warehouse(redshift_resource=redshift_resource, iam_resource=iam_resource)
+        return
+
     # Create EC2 Resource
     ec2_resource = create_ec2_resource()
 
     # Set up Data Warehouse
-    setup_data_warehouse(iam_resource, redshift_resource, ec2_resource)
-
-    # Tear down Data Warehouse
-    # teardown_data_warehouse(redshift_resource=redshift_resource, iam_resource=iam_resource)
+    endpoint, role_arn = setup_data_warehouse(iam_resource, redshift_resource, ec2_resource)
+    write_dwh_config(args.config, endpoint, role_arn)
+    print("Wrote the endpoint and role ARN to {}".format(args.config))
 
 
 if __name__ == "__main__":
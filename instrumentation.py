@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import sql_queries
+
+logger = logging.getLogger('dwh.statements')
+
+# Statements are named after the sql_queries variable that holds them, e.g. 'staging_events_copy'.
+STATEMENT_NAMES = {value: name for name, value in vars(sql_queries).items()
+                   if isinstance(value, str) and not name.startswith('_')}
+
+
+def statement_name(query):
+    """Names a statement after its sql_queries variable, or after its first line if it is not one.
+
+    Parameters:
+        query(str): The statement.
+
+    Returns:
+        str: The statement name.
+    """
+    if query in STATEMENT_NAMES:
+        return STATEMENT_NAMES[query]
+    # The COPY statements are rendered from dwh.cfg on first use, so they are not module variables.
+    for queries in sql_queries.rendered_copy_queries.values():
+        for name, value in queries._asdict().items():
+            if value == query:
+                return name
+    first_line = next((line.strip() for line in query.splitlines() if line.strip()), '')
+    return first_line[:60]
+
+
+class StatementRecorder:
+    """Times every statement executed through it and keeps a record of each one.
+
+    Every record is logged as a JSON line on the dwh.statements logger. On Redshift the query id of each
+    statement is captured too, so it can be looked up in STL_LOAD_COMMITS or SVL_QUERY_SUMMARY.
+    """
+
+    def __init__(self, capture_query_ids=False):
+        self.capture_query_ids = capture_query_ids
+        self.records = []
+        self.lock = threading.Lock()
+
+    def execute(self, cur, query, params=None, name=None):
+        """Executes a statement on the cursor and records its duration, rowcount and query id.
+
+        Parameters:
+            cur(psycopg2 cursor): The cursor to execute the statement with.
+            query(str): The statement to execute.
+            params(tuple): Optional statement parameters.
+            name(str): The statement name, defaults to its sql_queries variable name.
+
+        Returns:
+            dict: The record of the statement.
+        """
+        start = time.perf_counter()
+        cur.execute(query, params)
+        duration = time.perf_counter() - start
+        record = {
+            "statement": name or statement_name(query),
+            "duration_seconds": round(duration, 6),
+            "rowcount": cur.rowcount,
+            "query_id": None,
+        }
+        if self.capture_query_ids:
+            # A separate cursor on the same session, so the caller can still fetch the statement's results.
+            id_cursor = cur.connection.cursor()
+            id_cursor.execute("SELECT pg_last_query_id()")
+            record["query_id"] = id_cursor.fetchone()[0]
+            id_cursor.close()
+
+        with self.lock:
+            self.records.append(record)
+        logger.info(json.dumps(record))
+        return record
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+
+
+recorder = StatementRecorder()
+
+
+def configure(capture_query_ids=False):
+    """Sets up the shared recorder and JSON line logging for a run.
+
+    Parameters:
+        capture_query_ids(bool): Whether to look up the Redshift query id of every statement.
+    """
+    recorder.capture_query_ids = capture_query_ids
+    recorder.clear()
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+def execute(cur, query, params=None, name=None):
+    """Executes a statement through the shared recorder.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the statement with.
+        query(str): The statement to execute.
+        params(tuple): Optional statement parameters.
+        name(str): The statement name, defaults to its sql_queries variable name.
+
+    Returns:
+        dict: The record of the statement.
+    """
+    return recorder.execute(cur, query, params, name)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus_textfile(path, records):
+    """Writes statement metrics in the Prometheus text format for the node_exporter textfile collector.
+
+    The file is written next to its destination and renamed into place so it is never read half written.
+    Statements executed more than once in a run are summed.
+
+    Parameters:
+        path(str): The .prom file to write.
+        records(list of dict): The statement records.
+    """
+    durations = {}
+    rows = {}
+    for record in records:
+        name = record["statement"]
+        durations[name] = durations.get(name, 0) + record["duration_seconds"]
+        if record["rowcount"] is not None and record["rowcount"] >= 0:
+            rows[name] = rows.get(name, 0) + record["rowcount"]
+
+    lines = ["# HELP dwh_statement_duration_seconds Wall time of each ETL statement in the last run.",
+             "# TYPE dwh_statement_duration_seconds gauge"]
+    lines += ['dwh_statement_duration_seconds{{statement="{}"}} {}'.format(escape_label(name), seconds)
+              for name, seconds in durations.items()]
+    lines += ["# HELP dwh_statement_rows Rows affected by each ETL statement in the last run.",
+              "# TYPE dwh_statement_rows gauge"]
+    lines += ['dwh_statement_rows{{statement="{}"}} {}'.format(escape_label(name), count)
+              for name, count in rows.items()]
+    lines += ["# HELP dwh_last_run_timestamp_seconds Unix time the last run finished.",
+              "# TYPE dwh_last_run_timestamp_seconds gauge",
+              "dwh_last_run_timestamp_seconds {}".format(int(time.time()))]
+
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary_path, path)
@@ -0,0 +1,464 @@
+import argparse
+import itertools
+import json
+import re
+
+import sql_queries
+from ddl import Column, parse_create_table, render_create_table, strip_key_attributes, table_keys
+from sql_queries import create_table_queries
+
+# Rough row counts used by the cost model when no table statistics are supplied.
+DEFAULT_ROWS = 1000000
+DEFAULT_TABLE_ROWS = {
+    'fact_songplays': 100000000,
+    'dim_users': 100000,
+    'dim_songs': 1000000,
+    'dim_artists': 500000,
+    'dim_times': 10000000,
+}
+# Tables larger than this are never considered for DISTSTYLE ALL.
+ALL_MAX_ROWS = 5000000
+# Relative cost of storing and loading one extra copy of a row on every node, against moving it once.
+ALL_COPY_WEIGHT = 0.1
+# A distribution key with fewer distinct values than this is too skewed to consider.
+MIN_DISTINCT_VALUES = 1000
+# Sort key scores per weighted use of a column.
+RANGE_FILTER_SCORE = 3
+EQUALITY_FILTER_SCORE = 1
+JOIN_SCORE = 0.5
+# Above this many combinations the distribution search is done greedily per table.
+MAX_COMBINATIONS = 200000
+
+TABLE_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+JOIN_PATTERN = re.compile(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)\b')
+RANGE_PATTERN = re.compile(r'(?:\b(\w+)\.)?\b(\w+)\s*(?:>=|<=|>|<|\bBETWEEN\b)', re.IGNORECASE)
+EQUALITY_PATTERN = re.compile(r"(?:\b(\w+)\.)?\b(\w+)\s*=\s*(?:'[^']*'|-?\d+(?:\.\d+)?\b|%s)", re.IGNORECASE)
+NOT_ALIASES = {'where', 'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'on', 'group', 'order',
+               'limit', 'having', 'union', 'using', 'natural', 'as'}
+
+
+class Workload:
+    """The joins, filters and table usage found in a weighted set of queries."""
+
+    def __init__(self):
+        self.joins = {}
+        self.range_filters = {}
+        self.equality_filters = {}
+        self.table_uses = {}
+        self.queries = 0
+
+
+def add_weight(counter, key, weight):
+    counter[key] = counter.get(key, 0) + weight
+
+
+def load_schema():
+    """Parses the CREATE TABLE statements in sql_queries.
+
+    Returns:
+        dict: The columns, keys, table attributes and sql_queries variable name of each table, keyed by table name.
+    """
+    names = {value: name for name, value in vars(sql_queries).items() if isinstance(value, str)}
+    schema = {}
+    for statement in create_table_queries:
+        table, columns, attributes = parse_create_table(statement)
+        diststyle, distkey, sortkeys = table_keys(columns, attributes)
+        schema[table] = {
+            'columns': columns,
+            'diststyle': diststyle,
+            'distkey': distkey,
+            'sortkeys': sortkeys,
+            'attributes': attributes,
+            'variable': names.get(statement),
+        }
+    return schema
+
+
+def load_workload_file(path):
+    """Reads a workload as (query, weight) pairs.
+
+    A .json or .jsonl file holds a captured query log, one object per query with a 'query' (or 'querytxt'
+    as exported from STL_QUERY) and an optional 'count'. Any other file is read as SQL statements separated
+    by semicolons, each with weight 1 unless preceded by a '-- weight: N' comment.
+
+    Parameters:
+        path(str): The workload file.
+
+    Returns:
+        list of tuple: The (query, weight) pairs.
+    """
+    with open(path) as f:
+        text = f.read()
+
+    if path.endswith(('.json', '.jsonl')):
+        stripped = text.strip()
+        records = json.loads(stripped) if stripped.startswith('[') else \
+            [json.loads(line) for line in stripped.splitlines() if line.strip()]
+        return [(record.get('query') or record['querytxt'], float(record.get('count', 1))) for record in records]
+
+    workload = []
+    for statement in text.split(';'):
+        weight = re.search(r'--\s*weight:\s*([\d.]+)', statement, re.IGNORECASE)
+        query = re.sub(r'--[^\n]*', '', statement).strip()
+        if query:
+            workload.append((query, float(weight.group(1)) if weight else 1.0))
+    return workload
+
+
+def resolve_column(alias, column, aliases, schema):
+    """Resolves a possibly qualified column reference to its (table, column).
+
+    Parameters:
+        alias(str): The qualifier, or None for an unqualified column.
+        column(str): The column name.
+        aliases(dict): The tables of the query keyed by alias and by name.
+        schema(dict): The parsed schema.
+
+    Returns:
+        tuple: The (table, column) the reference resolves to, or None if it is not a known column.
+    """
+    column = column.lower()
+    if alias is not None:
+        table = aliases.get(alias.lower())
+        candidates = [table] if table else []
+    else:
+        candidates = sorted(set(aliases.values()))
+    for table in candidates:
+        if any(c.name.lower() == column for c in schema[table]['columns']):
+            return table, column
+    return None
+
+
+def analyze_workload(queries, schema):
+    """Collects the weighted joins and filters of a workload.
+
+    Parameters:
+        queries(list of tuple): The (query, weight) pairs.
+        schema(dict): The parsed schema.
+
+    Returns:
+        Workload: The analysis.
+    """
+    workload = Workload()
+    for query, weight in queries:
+        aliases = {}
+        for table, alias in TABLE_PATTERN.findall(query):
+            if table.lower() not in schema:
+                continue
+            aliases[table.lower()] = table.lower()
+            if alias and alias.lower() not in NOT_ALIASES:
+                aliases[alias.lower()] = table.lower()
+        if not aliases:
+            continue
+        workload.queries += 1
+        for table in set(aliases.values()):
+            add_weight(workload.table_uses, table, weight)
+
+        joined = set()
+        for left_alias, left_column, right_alias, right_column in JOIN_PATTERN.findall(query):
+            left = resolve_column(left_alias, left_column, aliases, schema)
+            right = resolve_column(right_alias, right_column, aliases, schema)
+            if left and right and left[0] != right[0]:
+                add_weight(workload.joins, tuple(sorted([left, right])), weight)
+                joined.update([left, right])
+
+        for alias, column in RANGE_PATTERN.findall(query):
+            resolved = resolve_column(alias or None, column, aliases, schema)
+            if resolved:
+                add_weight(workload.range_filters, resolved, weight)
+        for alias, column in EQUALITY_PATTERN.findall(query):
+            resolved = resolve_column(alias or None, column, aliases, schema)
+            if resolved and resolved not in joined:
+                add_weight(workload.equality_filters, resolved, weight)
+    return workload
+
+
+def join_cost(join, weight, left_choice, right_choice, rows, nodes):
+    """Estimates the rows moved between nodes to run a join, given both tables' distribution.
+
+    Parameters:
+        join(tuple): The ((table, column), (table, column)) join.
+        weight(float): How often the join runs.
+        left_choice(tuple): The (diststyle, distkey) of the left table.
+        right_choice(tuple): The (diststyle, distkey) of the right table.
+        rows(dict): The row count of each table.
+        nodes(int): The number of compute nodes.
+
+    Returns:
+        float: The estimated cost.
+    """
+    (left_table, left_column), (right_table, right_column) = join
+    if left_choice[0] == 'ALL' or right_choice[0] == 'ALL':
+        return 0
+    left_keyed = left_choice == ('KEY', left_column)
+    right_keyed = right_choice == ('KEY', right_column)
+    if left_keyed and right_keyed:
+        return 0
+    if left_keyed:
+        return weight * rows[right_table]
+    if right_keyed:
+        return weight * rows[left_table]
+    return weight * min(min(rows[left_table], rows[right_table]) * nodes, rows[left_table] + rows[right_table])
+
+
+def distribution_cost(choices, workload, rows, nodes):
+    """Estimates the total cost of a distribution choice for every table.
+
+    Parameters:
+        choices(dict): The (diststyle, distkey) of each table.
+        workload(Workload): The analysed workload.
+        rows(dict): The row count of each table.
+        nodes(int): The number of compute nodes.
+
+    Returns:
+        float: The estimated cost of the workload's joins plus the cost of keeping copies of ALL tables.
+    """
+    cost = 0
+    for join, weight in workload.joins.items():
+        cost += join_cost(join, weight, choices[join[0][0]], choices[join[1][0]], rows, nodes)
+    for table, choice in choices.items():
+        if choice[0] == 'ALL':
+            cost += rows[table] * (nodes - 1) * ALL_COPY_WEIGHT
+    return cost
+
+
+def distribution_candidates(table, workload, rows, distinct):
+    """Lists the distribution choices worth considering for a table.
+
+    Parameters:
+        table(str): The table name.
+        workload(Workload): The analysed workload.
+        rows(dict): The row count of each table.
+        distinct(dict): Known distinct value counts keyed by (table, column).
+
+    Returns:
+        list of tuple: The (diststyle, distkey) candidates.
+    """
+    candidates = [('EVEN', None)]
+    join_columns = sorted({column for join in workload.joins for joined_table, column in join
+                           if joined_table == table})
+    for column in join_columns:
+        if distinct.get((table, column), MIN_DISTINCT_VALUES) >= MIN_DISTINCT_VALUES:
+            candidates.append(('KEY', column))
+    if rows[table] <= ALL_MAX_ROWS:
+        candidates.append(('ALL', None))
+    return candidates
+
+
+def choose_distribution(tables, workload, rows, distinct, nodes):
+    """Finds the distribution of each table that minimizes the estimated cost of the workload.
+
+    Parameters:
+        tables(list of str): The tables to advise on.
+        workload(Workload): The analysed workload.
+        rows(dict): The row count of each table.
+        distinct(dict): Known distinct value counts keyed by (table, column).
+        nodes(int): The number of compute nodes.
+
+    Returns:
+        dict: The (diststyle, distkey) of each table.
+    """
+    candidates = {table: distribution_candidates(table, workload, rows, distinct) for table in tables}
+    combinations = 1
+    for options in candidates.values():
+        combinations *= len(options)
+
+    if combinations <= MAX_COMBINATIONS:
+        best = None
+        for combination in itertools.product(*(candidates[table] for table in tables)):
+            choices = dict(zip(tables, combination))
+            cost = distribution_cost(choices, workload, rows, nodes)
+            if best is None or cost < best[0]:
+                best = (cost, choices)
+        return best[1]
+
+    # Greedy: settle the largest tables first, each against the choices made so far.
+    choices = {table: ('EVEN', None) for table in tables}
+    for table in sorted(tables, key=lambda name: -rows[name]):
+        choices[table] = min(candidates[table],
+                             key=lambda choice: distribution_cost(dict(choices, **{table: choice}),
+                                                                  workload, rows, nodes))
+    return choices
+
+
+def sortkey_scores(table, workload):
+    """Scores each column of a table as a sort key by how often it restricts scans or joins.
+
+    Parameters:
+        table(str): The table name.
+        workload(Workload): The analysed workload.
+
+    Returns:
+        dict: The score of each column.
+    """
+    scores = {}
+    for (filter_table, column), weight in workload.range_filters.items():
+        if filter_table == table:
+            add_weight(scores, column, weight * RANGE_FILTER_SCORE)
+    for (filter_table, column), weight in workload.equality_filters.items():
+        if filter_table == table:
+            add_weight(scores, column, weight * EQUALITY_FILTER_SCORE)
+    for join, weight in workload.joins.items():
+        for join_table, column in join:
+            if join_table == table:
+                add_weight(scores, column, weight * JOIN_SCORE)
+    return scores
+
+
+def choose_sortkey(table, workload, distkey):
+    """Picks the best scoring sort key, preferring the distribution key on ties so merge joins are possible.
+
+    Parameters:
+        table(str): The table name.
+        workload(Workload): The analysed workload.
+        distkey(str): The chosen distribution key, or None.
+
+    Returns:
+        str: The sort key column, or None if no column is used to restrict the table.
+    """
+    scores = sortkey_scores(table, workload)
+    if not scores:
+        return None
+    return max(sorted(scores), key=lambda column: (scores[column], column == distkey))
+
+
+def render_table_attributes(choice, sortkey):
+    """Renders the table attributes for a distribution and sort key choice.
+
+    Parameters:
+        choice(tuple): The (diststyle, distkey).
+        sortkey(str): The sort key column, or None.
+
+    Returns:
+        str: The attributes, one per line.
+    """
+    attributes = ["DISTSTYLE {}".format(choice[0])]
+    if choice[0] == 'KEY':
+        attributes.append("DISTKEY ({})".format(choice[1]))
+    if sortkey:
+        attributes.append("SORTKEY ({})".format(sortkey))
+    return "\n".join(attributes)
+
+
+def advise(queries, table_stats=None, nodes=4):
+    """Recommends a distribution style, distribution key and sort key for every table the workload uses.
+
+    Parameters:
+        queries(list of tuple): The (query, weight) pairs of the workload.
+        table_stats(dict): Optional statistics per table: {"rows": n, "distinct": {"column": n}}.
+        nodes(int): The number of compute nodes.
+
+    Returns:
+        list of dict: One recommendation per table, with the current and recommended keys, estimated costs
+        and the alternative CREATE TABLE statement.
+    """
+    schema = load_schema()
+    workload = analyze_workload(queries, schema)
+    tables = sorted(workload.table_uses)
+    table_stats = table_stats or {}
+    rows = {table: table_stats.get(table, {}).get('rows', DEFAULT_TABLE_ROWS.get(table, DEFAULT_ROWS))
+            for table in schema}
+    distinct = {(table, column.lower()): count for table, stats in table_stats.items()
+                for column, count in stats.get('distinct', {}).items()}
+
+    current = {table: (schema[table]['diststyle'] if schema[table]['diststyle'] != 'AUTO' else 'EVEN',
+                       schema[table]['distkey'].lower() if schema[table]['distkey'] else None)
+               for table in tables}
+    chosen = choose_distribution(tables, workload, rows, distinct, nodes)
+    current_cost = distribution_cost(current, workload, rows, nodes)
+    chosen_cost = distribution_cost(chosen, workload, rows, nodes)
+
+    recommendations = []
+    for table in tables:
+        sortkey = choose_sortkey(table, workload, chosen[table][1])
+        columns = [Column(column.name, column.data_type, strip_key_attributes(column.attributes))
+                   for column in schema[table]['columns']]
+        recommendations.append({
+            'table': table,
+            'variable': schema[table]['variable'],
+            'rows': rows[table],
+            'current': {'diststyle': current[table][0], 'distkey': current[table][1],
+                        'sortkey': [key.lower() for key in schema[table]['sortkeys']]},
+            'recommended': {'diststyle': chosen[table][0], 'distkey': chosen[table][1],
+                            'sortkey': [sortkey] if sortkey else []},
+            'sortkey_scores': sortkey_scores(table, workload),
+            'workload_cost': {'current': current_cost, 'recommended': chosen_cost},
+            'ddl': render_create_table(table, columns, render_table_attributes(chosen[table], sortkey)),
+        })
+    return recommendations
+
+
+def format_report(recommendations, workload_size):
+    """Formats the recommendations as a plain text report.
+
+    Parameters:
+        recommendations(list of dict): The output of advise.
+        workload_size(int): The number of queries analysed.
+
+    Returns:
+        str: The report.
+    """
+    lines = ["Analysed {} queries".format(workload_size)]
+    if recommendations:
+        costs = recommendations[0]['workload_cost']
+        lines.append("Estimated rows redistributed per workload run: {:,.0f} now, {:,.0f} recommended".format(
+            costs['current'], costs['recommended']))
+    for recommendation in recommendations:
+        current = recommendation['current']
+        recommended = recommendation['recommended']
+        lines.append("")
+        lines.append("{} ({:,} rows)".format(recommendation['table'], recommendation['rows']))
+        lines.append("  current:     DISTSTYLE {} DISTKEY {} SORTKEY {}".format(
+            current['diststyle'], current['distkey'] or '-', ', '.join(current['sortkey']) or '-'))
+        lines.append("  recommended: DISTSTYLE {} DISTKEY {} SORTKEY {}".format(
+            recommended['diststyle'], recommended['distkey'] or '-', ', '.join(recommended['sortkey']) or '-'))
+        scores = sorted(recommendation['sortkey_scores'].items(), key=lambda item: -item[1])
+        if scores:
+            lines.append("  sort key scores: " + ", ".join("{} {:g}".format(column, score)
+                                                             for column, score in scores))
+    return "\n".join(lines)
+
+
+def format_ddl(recommendations):
+    """Formats the alternative CREATE TABLE statements as sql_queries assignments.
+
+    Parameters:
+        recommendations(list of dict): The output of advise.
+
+    Returns:
+        str: Python source defining each *_table_create statement.
+    """
+    return "\n".join('{} = ("""{}""")\n'.format(recommendation['variable'] or recommendation['table'] + '_create',
+                                               recommendation['ddl'])
+                     for recommendation in recommendations)
+
+
+def main():
+    """The main function for key_advisor.py.
+
+    Reads a workload file, recommends distribution and sort keys for the tables it uses, prints a report and
+    writes the alternative DDL.
+    """
+    parser = argparse.ArgumentParser(description="Recommend DISTKEY/SORTKEY choices from a query workload.")
+    parser.add_argument('workload', help="a .sql file of statements, or a .json/.jsonl captured query log")
+    parser.add_argument('--table-stats', help='JSON file of {"table": {"rows": n, "distinct": {"column": n}}}')
+    parser.add_argument('--nodes', type=int, default=4, help="the number of compute nodes to cost for")
+    parser.add_argument('--ddl-output', default='recommended_tables.py',
+                        help="where to write the alternative *_table_create statements")
+    args = parser.parse_args()
+
+    queries = load_workload_file(args.workload)
+    table_stats = None
+    if args.table_stats:
+        with open(args.table_stats) as f:
+            table_stats = json.load(f)
+
+    recommendations = advise(queries, table_stats, args.nodes)
+    print(format_report(recommendations, len(queries)))
+    with open(args.ddl_output, 'w') as f:
+        f.write(format_ddl(recommendations))
+    print("\nWrote {}".format(args.ddl_output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import argparse
+import collections
+import configparser
+import decimal
+import gzip
+import io
+import json
+import re
+
+from backends import BACKENDS, REDSHIFT, get_object_store, parse_jsonpath
+from ddl import normalize_type, parse_create_table
+from parquet_stage import DERIVED_COLUMNS, clear_prefix
+from sql_queries import staging_events_table_create
+
+# Redshift stores TEXT as VARCHAR(256), and VARCHAR lengths count bytes, not characters.
+DEFAULT_VARCHAR_BYTES = 256
+INTEGER_LIMITS = {'SMALLINT': 2 ** 15, 'INTEGER': 2 ** 31, 'BIGINT': 2 ** 63}
+INTEGER_PATTERN = re.compile(r'^\s*[-+]?\d+\s*$')
+# Distinct (sessionId, itemInSession, ts) keys remembered for deduplication. Duplicates further apart than
+# this many events are not caught.
+MAX_KEYS = 2000000
+SONG_PLAY_PAGES = ('NextSong',)
+
+
+def check_value(value, column):
+    """Checks that a JSON value loads into a staging column the way Redshift's JSON COPY would load it.
+
+    Parameters:
+        value(object): The JSON value, None when the key is missing.
+        column(Column): The staging column.
+
+    Returns:
+        str: Why the value would fail the COPY or violate the column, or None if it is valid.
+    """
+    family, params = normalize_type(column.data_type)
+    text = family in ('VARCHAR', 'CHAR')
+    if value is None or (value == '' and not text):
+        return "{} is NULL".format(column.name) if column.not_null else None
+
+    if text:
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        limit = params[0] if params else DEFAULT_VARCHAR_BYTES
+        if len(value.encode('utf-8')) > limit:
+            return "{} is longer than {} bytes".format(column.name, limit)
+        return None
+
+    if isinstance(value, bool) or isinstance(value, (dict, list)):
+        return "{} is not a valid {}".format(column.name, family)
+    if family in INTEGER_LIMITS:
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        elif isinstance(value, str) and INTEGER_PATTERN.match(value):
+            value = int(value)
+        if not isinstance(value, int):
+            return "{} is not a valid {}".format(column.name, family)
+        if not -INTEGER_LIMITS[family] <= value < INTEGER_LIMITS[family]:
+            return "{} is out of range for {}".format(column.name, family)
+        return None
+    if family == 'NUMERIC':
+        # DECIMAL without a precision is Redshift's DECIMAL(18,0).
+        precision = params[0] if params else 18
+        scale = params[1] if len(params) > 1 else 0
+        try:
+            number = decimal.Decimal(str(value)).quantize(decimal.Decimal(1).scaleb(-scale),
+                                                          rounding=decimal.ROUND_HALF_UP)
+        except (decimal.InvalidOperation, ValueError):
+            return "{} is not a valid {}".format(column.name, family)
+        if abs(number) >= decimal.Decimal(10) ** (precision - scale):
+            return "{} is out of range for {}".format(column.name, column.data_type)
+    return None
+
+
+def dedup_key(record):
+    """Packs the (sessionId, itemInSession, ts) of a validated event into one integer.
+
+    Parameters:
+        record(dict): The event.
+
+    Returns:
+        int: The key, exact for every SMALLINT session, INTEGER item and BIGINT ts.
+    """
+    session, item, ts = (int(float(record[key])) for key in ('sessionId', 'itemInSession', 'ts'))
+    return (ts << 48) | ((session & 0xFFFF) << 32) | (item & 0xFFFFFFFF)
+
+
+class RecentKeys:
+    """Remembers the most recent max_keys keys, so deduplication runs in bounded memory.
+
+    Log records are written in time order, so retried or replayed events land close to their original and
+    an exact memory of the most recent keys catches them without keeping every key ever seen.
+    """
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.keys = collections.OrderedDict()
+
+    def seen(self, key):
+        """Checks whether a key was seen recently, and remembers it.
+
+        Parameters:
+            key(int): The key.
+
+        Returns:
+            bool: Whether the key is a duplicate.
+        """
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            return True
+        self.keys[key] = None
+        if len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+        return False
+
+
+class LogCleaner:
+    """Validates, filters and deduplicates log events before they are COPYd into staging_events.
+
+    Each event is checked against the types, VARCHAR byte lengths and NOT NULL constraints of staging_events
+    through the jsonpaths mapping. Events of pages other than the given pages are skipped, since only song plays reach
+    fact_songplays, and repeated (sessionId, itemInSession, ts) keys are dropped. Invalid events and
+    duplicates are written to a rejects object with the reason.
+    """
+
+    def __init__(self, store, log_jsonpath, pages=SONG_PLAY_PAGES, max_keys=MAX_KEYS):
+        self.store = store
+        self.pages = pages
+        self.keys = [parse_jsonpath(path) for path in json.loads(store.get_object(log_jsonpath))['jsonpaths']]
+        _, columns, _ = parse_create_table(staging_events_table_create)
+        self.columns = [column for column in columns if column.name not in DERIVED_COLUMNS]
+        self.recent = RecentKeys(max_keys)
+        self.counts = collections.Counter()
+        self.rejects = []
+
+    def reject(self, uri, line_number, reason, line):
+        self.counts['rejected'] += 1
+        self.rejects.append(json.dumps({'source': uri, 'line': line_number, 'reason': reason, 'record': line}))
+
+    def clean_line(self, uri, line_number, line):
+        """Cleans one log line.
+
+        Parameters:
+            uri(str): The uri of the log object, for the rejects.
+            line_number(int): The line number in the object, for the rejects.
+            line(str): The JSON event.
+
+        Returns:
+            str: The compact JSON event to load, or None if it is skipped or rejected.
+        """
+        self.counts['read'] += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            self.reject(uri, line_number, "invalid JSON", line)
+            return None
+        if not isinstance(record, dict):
+            self.reject(uri, line_number, "not a JSON object", line)
+            return None
+        if self.pages and record.get('page') not in self.pages:
+            self.counts['skipped'] += 1
+            return None
+
+        errors = [error for error in (check_value(record.get(key), column)
+                                      for key, column in zip(self.keys, self.columns)) if error]
+        if errors:
+            self.reject(uri, line_number, "; ".join(errors), line)
+            return None
+        if self.recent.seen(dedup_key(record)):
+            self.reject(uri, line_number, "duplicate sessionId, itemInSession and ts", line)
+            self.counts['duplicates'] += 1
+            return None
+
+        self.counts['written'] += 1
+        return json.dumps({key: record.get(key) for key in self.keys}, separators=(',', ':'))
+
+    def clean_object(self, uri, output_uri):
+        """Cleans one log object into a gzipped object of valid, unique events.
+
+        Parameters:
+            uri(str): The uri of the log object.
+            output_uri(str): The uri to write the cleaned events to.
+
+        Returns:
+            bool: Whether any event was written.
+        """
+        buffer = io.BytesIO()
+        written = 0
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+            for line_number, line in enumerate(self.store.get_object(uri).decode('utf-8').splitlines(), 1):
+                if not line.strip():
+                    continue
+                cleaned = self.clean_line(uri, line_number, line)
+                if cleaned is not None:
+                    f.write((cleaned + '\n').encode('utf-8'))
+                    written += 1
+        if written:
+            self.store.put_object(output_uri, buffer.getvalue())
+        return bool(written)
+
+    def clean_prefix(self, log_data, output_prefix, rejects_uri):
+        """Cleans every log object under a prefix, keeping their relative paths under the output prefix.
+
+        Parameters:
+            log_data(str): The s3:// prefix of the song play logs.
+            output_prefix(str): The s3:// prefix to write the gzipped cleaned logs under.
+            rejects_uri(str): The uri of the rejects object, written when any event is rejected.
+
+        Returns:
+            Counter: The number of events read, written, skipped, rejected and duplicated.
+        """
+        clear_prefix(self.store, output_prefix)
+        log_data = log_data.rstrip('/')
+        for uri, _ in self.store.list_objects(log_data):
+            self.clean_object(uri, output_prefix.rstrip('/') + uri[len(log_data):] + '.gz')
+        if self.rejects:
+            self.store.put_object(rejects_uri, ("\n".join(self.rejects) + "\n").encode('utf-8'))
+        return self.counts
+
+
+def get_clean_prefixes(config):
+    """Returns where the cleaned logs and their rejects live, under CLEAN_PREFIX in [ETL].
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        tuple: The s3:// prefix of the cleaned logs and the uri of the rejects object.
+    """
+    prefix = config['ETL']['CLEAN_PREFIX'].strip("'").rstrip('/')
+    return prefix + '/log_data', prefix + '/rejects/log_data.json'
+
+
+def clean_logs(store, config, pages=SONG_PLAY_PAGES, max_keys=MAX_KEYS):
+    """Cleans the log data configured in the [S3] section of dwh.cfg.
+
+    Parameters:
+        store(object store): The object store holding the logs and the cleaned output.
+        config(ConfigParser): The parsed dwh.cfg.
+        pages(tuple of str): The pages to keep, or empty to keep every page.
+        max_keys(int): The number of recent keys remembered for deduplication.
+
+    Returns:
+        str: The s3:// prefix of the cleaned logs.
+    """
+    output_prefix, rejects_uri = get_clean_prefixes(config)
+    cleaner = LogCleaner(store, config['S3']['LOG_JSONPATH'].strip("'"), pages, max_keys)
+    counts = cleaner.clean_prefix(config['S3']['LOG_DATA'].strip("'"), output_prefix, rejects_uri)
+    print("Read {read} events: wrote {written}, skipped {skipped} of other pages, rejected {rejected} "
+          "({duplicates} duplicates)".format(**{key: counts[key] for key in
+                                                 ('read', 'written', 'skipped', 'rejected', 'duplicates')}))
+    if counts['rejected']:
+        print("Rejected events are in {}".format(rejects_uri))
+    return output_prefix
+
+
+def main():
+    """The main function for log_cleaner.py.
+
+    Writes validated, deduplicated song play events as gzipped JSON under CLEAN_PREFIX, either in S3 or in
+    the local object store used by the duckdb backend.
+    """
+    parser = argparse.ArgumentParser(description="Validate and deduplicate the log JSON before it is staged.")
+    parser.add_argument('--all-pages', action='store_true',
+                        help="keep events of every page instead of only song plays")
+    parser.add_argument('--max-keys', type=int, default=MAX_KEYS,
+                        help="the number of recent events remembered for deduplication")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="read and write S3, or the local object store of the duckdb backend")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    clean_logs(get_object_store(config, args.backend), config, () if args.all_pages else SONG_PLAY_PAGES,
+               args.max_keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import collections
+import configparser
+import time
+
+import instrumentation
+from backends import REDSHIFT, connect
+from sql_queries import table_health_select
+
+# Staging tables are truncated and reloaded every run, so sorting or analyzing them is wasted work.
+SKIPPED_PREFIXES = ('staging_',)
+
+# One row of table_health_select. unsorted is None for tables without a sort key.
+TableHealth = collections.namedtuple('TableHealth', ['table', 'size_mb', 'rows', 'visible_rows', 'unsorted',
+                                                     'stats_off', 'has_sortkey'])
+# The percentages above which a table is vacuumed or analyzed, from the [MAINTENANCE] section of dwh.cfg.
+Thresholds = collections.namedtuple('Thresholds', ['unsorted_percent', 'deleted_percent', 'stats_off_percent'])
+# A maintenance statement, why it is needed and the megabytes of the table it rewrites.
+Action = collections.namedtuple('Action', ['table', 'statement', 'reason', 'cost_mb'])
+
+
+def load_thresholds(section):
+    """Reads the thresholds from the [MAINTENANCE] section of dwh.cfg.
+
+    Parameters:
+        section(SectionProxy): The [MAINTENANCE] section.
+
+    Returns:
+        Thresholds: The thresholds.
+    """
+    return Thresholds(unsorted_percent=section.getfloat('UNSORTED_PERCENT'),
+                      deleted_percent=section.getfloat('DELETED_PERCENT'),
+                      stats_off_percent=section.getfloat('STATS_OFF_PERCENT'))
+
+
+def parse_health(rows):
+    """Turns the rows of table_health_select into TableHealth tuples.
+
+    Parameters:
+        rows(list of tuple): The rows, as fetched from SVV_TABLE_INFO or canned.
+
+    Returns:
+        list of TableHealth: The health of each table.
+    """
+    return [TableHealth(table=table, size_mb=int(size or 0), rows=int(rows or 0),
+                        visible_rows=int(visible_rows if visible_rows is not None else rows or 0),
+                        unsorted=None if unsorted is None else float(unsorted), stats_off=float(stats_off or 0),
+                        has_sortkey=sortkey is not None)
+            for table, size, rows, visible_rows, unsorted, stats_off, sortkey in rows]
+
+
+def deleted_percent(health):
+    """Returns the percentage of the rows of a table that are deleted but not yet vacuumed away."""
+    if not health.rows:
+        return 0.0
+    return max(health.rows - health.visible_rows, 0) * 100.0 / health.rows
+
+
+def plan_maintenance(tables, thresholds):
+    """Decides which tables to vacuum and analyze, and in which order.
+
+    A table whose deleted rows exceed DELETED_PERCENT gets VACUUM DELETE ONLY, a table with a sort key whose
+    unsorted region exceeds UNSORTED_PERCENT gets VACUUM SORT ONLY, and one that needs both gets a single
+    VACUUM FULL. A table whose statistics are off by more than STATS_OFF_PERCENT gets ANALYZE PREDICATE
+    COLUMNS, which only refreshes the columns queries filter, join or group on.
+
+    The ANALYZEs come first, as they are cheap and have the most effect on query plans, stalest first. The
+    VACUUMs follow by the megabytes they rewrite, largest first, so a time budget spends itself on the tables
+    that gain the most.
+
+    Parameters:
+        tables(list of TableHealth): The health of each table.
+        thresholds(Thresholds): The thresholds.
+
+    Returns:
+        list of Action: The statements to run, in order.
+    """
+    analyzes = []
+    vacuums = []
+    for health in tables:
+        if health.table.startswith(SKIPPED_PREFIXES) or not health.rows:
+            continue
+        if health.stats_off > thresholds.stats_off_percent:
+            analyzes.append((health.stats_off, Action(
+                health.table, "ANALYZE {} PREDICATE COLUMNS".format(health.table),
+                "stats off {:.1f}%".format(health.stats_off), 0)))
+
+        deleted = deleted_percent(health)
+        needs_delete = deleted > thresholds.deleted_percent
+        needs_sort = health.has_sortkey and (health.unsorted or 0) > thresholds.unsorted_percent
+        if needs_delete and needs_sort:
+            mode, reason = 'FULL', "{:.1f}% deleted, {:.1f}% unsorted".format(deleted, health.unsorted)
+        elif needs_delete:
+            mode, reason = 'DELETE ONLY', "{:.1f}% deleted".format(deleted)
+        elif needs_sort:
+            mode, reason = 'SORT ONLY', "{:.1f}% unsorted".format(health.unsorted)
+        else:
+            continue
+        cost_mb = health.size_mb * max(deleted if needs_delete else 0, health.unsorted if needs_sort else 0) / 100
+        vacuums.append((cost_mb, Action(health.table, "VACUUM {} {}".format(mode, health.table), reason,
+                                        round(cost_mb))))
+
+    return ([action for _, action in sorted(analyzes, key=lambda item: (-item[0], item[1].table))] +
+            [action for _, action in sorted(vacuums, key=lambda item: (-item[0], item[1].table))])
+
+
+def read_health(cur):
+    """Reads the health of the tables in the current schema from SVV_TABLE_INFO.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to the cluster.
+
+    Returns:
+        list of TableHealth: The health of each table.
+    """
+    instrumentation.execute(cur, table_health_select)
+    return parse_health(cur.fetchall())
+
+
+def run_maintenance(conn, actions, time_budget_seconds, clock=time.monotonic):
+    """Runs maintenance statements in order until the time budget is spent.
+
+    VACUUM cannot run inside a transaction, so the statements run in autocommit mode. A statement that has
+    started always runs to completion; the budget only decides whether the next one starts.
+
+    Parameters:
+        conn(psycopg2 connection): The connection to the cluster.
+        actions(list of Action): The statements to run, as planned by plan_maintenance.
+        time_budget_seconds(float): The seconds after which no further statement starts.
+        clock(callable): Returns the current time in seconds.
+
+    Returns:
+        tuple: The (action, seconds) of every statement that ran, and the actions skipped for lack of time.
+    """
+    completed = []
+    skipped = []
+    start = clock()
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        for action in actions:
+            if clock() - start >= time_budget_seconds:
+                skipped.append(action)
+                continue
+            statement_start = clock()
+            instrumentation.execute(cur, action.statement, name="{}_{}".format(
+                action.statement.split()[0].lower(), action.table))
+            completed.append((action, clock() - statement_start))
+    finally:
+        conn.autocommit = False
+    return completed, skipped
+
+
+def format_plan(actions):
+    """Formats the planned statements with their reasons, one per line."""
+    if not actions:
+        return "Every table is within the maintenance thresholds"
+    return '\n'.join("{:<45} {}".format(action.statement, action.reason) for action in actions)
+
+
+def maintain(conn, config, time_budget_seconds=None):
+    """Vacuums and analyzes the tables that exceed the thresholds in the [MAINTENANCE] section of dwh.cfg.
+
+    Parameters:
+        conn(psycopg2 connection): The connection to the cluster.
+        config(ConfigParser): The parsed dwh.cfg.
+        time_budget_seconds(float): The budget to use instead of TIME_BUDGET_SECONDS.
+
+    Returns:
+        tuple: The (action, seconds) of every statement that ran, and the actions skipped for lack of time.
+    """
+    section = config['MAINTENANCE']
+    if time_budget_seconds is None:
+        time_budget_seconds = section.getfloat('TIME_BUDGET_SECONDS')
+    actions = plan_maintenance(read_health(conn.cursor()), load_thresholds(section))
+    print(format_plan(actions))
+    completed, skipped = run_maintenance(conn, actions, time_budget_seconds)
+    for action, seconds in completed:
+        print("{:.1f}s {}".format(seconds, action.statement))
+    if skipped:
+        print("Out of time budget, skipped: {}".format('; '.join(action.statement for action in skipped)))
+    return completed, skipped
+
+
+def main():
+    """The main function for maintenance.py.
+
+    Reads the sort, delete and statistics health of the tables from SVV_TABLE_INFO and runs VACUUM and ANALYZE
+    only on the tables that exceed the thresholds in the [MAINTENANCE] section of dwh.cfg, within its time
+    budget. With --dry-run the plan is only printed.
+    """
+    parser = argparse.ArgumentParser(description="Vacuum and analyze the tables whose sort order or statistics "
+                                                 "have degraded.")
+    parser.add_argument('--dry-run', action='store_true', help="print the planned statements without running them")
+    parser.add_argument('--time-budget', type=float,
+                        help="seconds after which no further statement starts (TIME_BUDGET_SECONDS by default)")
+    args = parser.parse_args()
+    instrumentation.configure(capture_query_ids=True)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = connect(config, REDSHIFT)
+    if args.dry_run:
+        print(format_plan(plan_maintenance(read_health(conn.cursor()), load_thresholds(config['MAINTENANCE']))))
+    else:
+        maintain(conn, config, args.time_budget)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
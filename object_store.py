@@ -0,0 +1,204 @@
+import json
+import os
+import shutil
+from urllib.parse import urlparse
+
+
+def split_s3_uri(uri):
+    """Splits an s3:// uri into its bucket and key.
+
+    Parameters:
+        uri(str): The uri to split, e.g. s3://udacity-dend/log_data.
+
+    Returns:
+        tuple: The bucket name and the key (without a leading slash).
+    """
+    parsed = urlparse(uri.strip().strip("'\""))
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def build_manifest(uris):
+    """Builds a Redshift COPY manifest that lists each of the given object uris.
+
+    Parameters:
+        uris(list of str): The s3:// uris of the objects to load.
+
+    Returns:
+        str: The manifest document as JSON.
+    """
+    return json.dumps({"entries": [{"url": uri, "mandatory": True} for uri in uris]})
+
+
+def partition_key(uri, prefix_uri, depth):
+    """Returns the first depth directory levels of an object below a prefix, e.g. '2018/11' for log_data.
+
+    Parameters:
+        uri(str): The s3:// uri of the object.
+        prefix_uri(str): The s3:// prefix the object was listed under.
+        depth(int): The number of directory levels that make up the partition.
+
+    Returns:
+        str: The partition the object belongs to.
+    """
+    relative = uri[len(prefix_uri.strip("'\"").rstrip('/')):].lstrip('/')
+    return '/'.join(relative.split('/')[:-1][:depth])
+
+
+def shard_objects(objects, prefix_uri, num_shards, depth):
+    """Splits objects into at most num_shards shards of roughly equal size without splitting a partition.
+
+    Partitions are assigned largest first to whichever shard is currently smallest.
+
+    Parameters:
+        objects(list of tuple): The (uri, size in bytes) of each object, as returned by list_objects.
+        prefix_uri(str): The s3:// prefix the objects were listed under.
+        num_shards(int): The maximum number of shards to produce.
+        depth(int): The number of directory levels below the prefix that make up a partition.
+
+    Returns:
+        list of list of str: The sorted object uris of each non-empty shard.
+    """
+    partitions = {}
+    for uri, size in objects:
+        partition = partitions.setdefault(partition_key(uri, prefix_uri, depth), [0, []])
+        partition[0] += size
+        partition[1].append(uri)
+
+    shards = [[0, []] for _ in range(max(num_shards, 1))]
+    for key, (size, uris) in sorted(partitions.items(), key=lambda item: (-item[1][0], item[0])):
+        smallest = min(shards, key=lambda shard: shard[0])
+        smallest[0] += size
+        smallest[1].extend(uris)
+    return [sorted(uris) for _, uris in shards if uris]
+
+
+class S3ObjectStore:
+    """Object store backed by a boto3 S3 client."""
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def list_objects(self, prefix_uri):
+        """Lists every object under the given prefix.
+
+        Parameters:
+            prefix_uri(str): The s3:// prefix to list.
+
+        Returns:
+            list of tuple: The (uri, size in bytes) of each object, sorted by uri.
+        """
+        bucket, prefix = split_s3_uri(prefix_uri)
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if not item['Key'].endswith('/'):
+                    objects.append(("s3://{}/{}".format(bucket, item['Key']), item['Size']))
+        return sorted(objects)
+
+    def get_object(self, uri):
+        """Reads the full body of an object.
+
+        Parameters:
+            uri(str): The s3:// uri of the object.
+
+        Returns:
+            bytes: The object body.
+        """
+        bucket, key = split_s3_uri(uri)
+        return self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def put_object(self, uri, body):
+        """Writes an object, replacing it if it already exists.
+
+        Parameters:
+            uri(str): The s3:// uri to write to.
+            body(bytes, str or binary file): The object body, or a seekable file positioned at its start.
+        """
+        bucket, key = split_s3_uri(uri)
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+
+    def delete_object(self, uri):
+        """Deletes an object.
+
+        Parameters:
+            uri(str): The s3:// uri of the object.
+        """
+        bucket, key = split_s3_uri(uri)
+        self.s3_client.delete_object(Bucket=bucket, Key=key)
+
+
+class LocalObjectStore:
+    """Filesystem stand-in for S3 where s3://bucket/key maps to <root>/bucket/key."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, uri):
+        """Maps an s3:// uri to its path under the store root.
+
+        Parameters:
+            uri(str): The s3:// uri to map.
+
+        Returns:
+            str: The local filesystem path.
+        """
+        bucket, key = split_s3_uri(uri)
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def list_objects(self, prefix_uri):
+        """Lists every file under the given prefix, matching S3 key-prefix semantics.
+
+        Parameters:
+            prefix_uri(str): The s3:// prefix to list.
+
+        Returns:
+            list of tuple: The (uri, size in bytes) of each object, sorted by uri.
+        """
+        bucket, prefix = split_s3_uri(prefix_uri)
+        bucket_root = os.path.join(self.root, bucket)
+        objects = []
+        for dirpath, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, bucket_root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    objects.append(("s3://{}/{}".format(bucket, key), os.path.getsize(path)))
+        return sorted(objects)
+
+    def get_object(self, uri):
+        """Reads the full body of a file in the store.
+
+        Parameters:
+            uri(str): The s3:// uri of the object.
+
+        Returns:
+            bytes: The object body.
+        """
+        with open(self.local_path(uri), 'rb') as f:
+            return f.read()
+
+    def put_object(self, uri, body):
+        """Writes a file into the store, creating parent directories as needed.
+
+        Parameters:
+            uri(str): The s3:// uri to write to.
+            body(bytes, str or binary file): The object body, or a file positioned at its start.
+        """
+        path = self.local_path(uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with open(path, 'wb') as f:
+            if hasattr(body, 'read'):
+                shutil.copyfileobj(body, f)
+            else:
+                f.write(body)
+
+    def delete_object(self, uri):
+        """Deletes a file from the store.
+
+        Parameters:
+            uri(str): The s3:// uri of the object.
+        """
+        os.remove(self.local_path(uri))
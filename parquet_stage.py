@@ -0,0 +1,379 @@
+import argparse
+import configparser
+import datetime
+import decimal
+import json
+import os
+import shutil
+import tempfile
+
+from backends import BACKENDS, REDSHIFT, get_object_store, parse_jsonpath
+from ddl import parse_create_table
+from sql_queries import staging_events_table_create, staging_songs_table_create
+
+# Row group size, and so the number of rows held in memory per open partition.
+BATCH_SIZE = 50000
+MAX_ROWS_PER_FILE = 1000000
+# Staging columns that are derived after the load rather than copied, and so are not in the Parquet files.
+DERIVED_COLUMNS = ('song_key',)
+
+
+def arrow_schema(create_statement):
+    """Builds the Arrow schema that COPY ... FORMAT AS PARQUET needs for a staging table.
+
+    Parquet COPY maps columns by position and requires matching types, so the schema follows the
+    CREATE TABLE statement exactly, without the DERIVED_COLUMNS. DECIMAL without a precision is Redshift's
+    DECIMAL(18,0).
+
+    Parameters:
+        create_statement(str): The CREATE TABLE statement of the staging table.
+
+    Returns:
+        pyarrow.Schema: The schema of the Parquet files for the table.
+    """
+    import pyarrow as pa
+
+    types = {
+        'SMALLINT': pa.int16(),
+        'INTEGER': pa.int32(),
+        'BIGINT': pa.int64(),
+        'DECIMAL': pa.decimal128(18, 0),
+        'TEXT': pa.string(),
+        'VARCHAR': pa.string(),
+    }
+    _, columns, _ = parse_create_table(create_statement)
+    return pa.schema([pa.field(column.name, types[column.base_type], nullable=not column.not_null)
+                      for column in columns if column.name not in DERIVED_COLUMNS])
+
+
+def convert_value(value, data_type):
+    """Converts a JSON value to the python value Arrow expects for a column, mirroring Redshift's JSON COPY.
+
+    Parameters:
+        value(object): The JSON value.
+        data_type(pyarrow.DataType): The type of the column.
+
+    Returns:
+        object: The converted value, None for missing or blank non-text values.
+    """
+    import pyarrow as pa
+
+    if value is None:
+        return None
+    if pa.types.is_string(data_type):
+        return value if isinstance(value, str) else json.dumps(value)
+    if value == '':
+        return None
+    if pa.types.is_decimal(data_type):
+        return decimal.Decimal(str(value)).quantize(decimal.Decimal(1).scaleb(-data_type.scale),
+                                                    rounding=decimal.ROUND_HALF_UP)
+    return int(value)
+
+
+class PartitionedParquetWriter:
+    """Streams rows into Parquet files under a prefix, one directory per partition.
+
+    At most batch_size rows per partition are buffered before they are written as a row group, and files
+    roll over after max_rows_per_file rows, so memory stays bounded regardless of input size. Files are
+    written locally and then uploaded to the object store. Files are named <basename>-<number>.parquet.
+    """
+
+    def __init__(self, store, output_prefix, schema, batch_size=BATCH_SIZE, max_rows_per_file=MAX_ROWS_PER_FILE,
+                 basename='part'):
+        self.store = store
+        self.basename = basename
+        self.output_prefix = output_prefix.rstrip('/')
+        self.schema = schema
+        self.batch_size = batch_size
+        self.max_rows_per_file = max_rows_per_file
+        self.temporary_dir = tempfile.mkdtemp()
+        self.partitions = {}
+        self.file_count = 0
+        self.written = []
+
+    def write(self, partition, row):
+        """Buffers a row for a partition, flushing a row group once the batch is full.
+
+        Parameters:
+            partition(str): The partition path, e.g. 'year=2018/month=11', or '' for none.
+            row(list): The converted column values in schema order.
+        """
+        state = self.partitions.setdefault(partition, {'rows': [], 'writer': None, 'path': None, 'count': 0})
+        state['rows'].append(row)
+        if len(state['rows']) >= self.batch_size:
+            self.flush(partition)
+
+    def flush(self, partition):
+        """Writes the buffered rows of a partition as a row group.
+
+        Parameters:
+            partition(str): The partition to flush.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        state = self.partitions[partition]
+        if not state['rows']:
+            return
+        if state['writer'] is None:
+            state['path'] = os.path.join(self.temporary_dir, "{}-{:05d}.parquet".format(self.basename,
+                                                                                       self.file_count))
+            state['uri'] = "{}/{}{}-{:05d}.parquet".format(
+                self.output_prefix, partition + '/' if partition else '', self.basename, self.file_count)
+            state['writer'] = pq.ParquetWriter(state['path'], self.schema, compression='snappy')
+            self.file_count += 1
+
+        columns = list(zip(*state['rows']))
+        state['writer'].write_table(pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, self.schema)], schema=self.schema))
+        state['count'] += len(state['rows'])
+        state['rows'] = []
+        if state['count'] >= self.max_rows_per_file:
+            self.close_file(partition)
+
+    def close_file(self, partition):
+        """Closes the open file of a partition and uploads it to the object store.
+
+        Parameters:
+            partition(str): The partition whose file to close.
+        """
+        state = self.partitions[partition]
+        state['writer'].close()
+        with open(state['path'], 'rb') as f:
+            self.store.put_object(state['uri'], f.read())
+        os.remove(state['path'])
+        self.written.append(state['uri'])
+        state.update({'writer': None, 'path': None, 'count': 0})
+
+    def close(self):
+        """Flushes and uploads every partition.
+
+        Returns:
+            list of str: The uris of the Parquet files written.
+        """
+        for partition in list(self.partitions):
+            self.flush(partition)
+            if self.partitions[partition]['writer'] is not None:
+                self.close_file(partition)
+        os.rmdir(self.temporary_dir)
+        return sorted(self.written)
+
+    def abort(self):
+        """Discards the open files and deletes the files already uploaded."""
+        for state in self.partitions.values():
+            if state['writer'] is not None:
+                state['writer'].close()
+        shutil.rmtree(self.temporary_dir, ignore_errors=True)
+        for uri in self.written:
+            self.store.delete_object(uri)
+
+
+def clear_prefix(store, prefix_uri):
+    """Deletes the output of a previous conversion so that a COPY of the prefix only sees the new files.
+
+    Parameters:
+        store(object store): The object store holding the Parquet output.
+        prefix_uri(str): The s3:// prefix to clear.
+    """
+    for uri, _ in store.list_objects(prefix_uri):
+        store.delete_object(uri)
+
+
+def run_basename(basename):
+    """Names the Parquet files of a full conversion after the time it started, so they never overwrite the files
+    of the previous conversion while it is still the output.
+
+    Parameters:
+        basename(str): The name of the Parquet files before the time.
+
+    Returns:
+        str: The file basename.
+    """
+    return "{}-{}".format(basename, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'))
+
+
+def write_output(store, writer, rows, previous=None):
+    """Writes rows with a writer, then deletes the previous output that the new files replace.
+
+    The previous output is only deleted once every new file is uploaded. If writing fails, the new files are
+    deleted instead, so the prefix keeps the complete previous output.
+
+    Parameters:
+        store(object store): The object store holding the Parquet output.
+        writer(PartitionedParquetWriter): The writer of the new files.
+        rows(iterable): The (partition, row) pairs to write.
+        previous(list of str): The uris of the previous output, or None to keep it.
+
+    Returns:
+        list of str: The uris of the Parquet files written.
+    """
+    try:
+        for partition, row in rows:
+            writer.write(partition, row)
+        written = writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    for uri in set(previous or ()) - set(written):
+        store.delete_object(uri)
+    return written
+
+
+def iter_json_records(body):
+    """Yields the records of a JSON object, either a single document or newline-delimited documents.
+
+    Parameters:
+        body(bytes): The object body.
+
+    Yields:
+        dict: Each JSON record.
+    """
+    text = body.decode('utf-8')
+    try:
+        yield json.loads(text)
+    except ValueError:
+        for line in text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def event_partition(ts):
+    """Returns the year/month partition of a log event, e.g. 'year=2018/month=11'.
+
+    Parameters:
+        ts(int): The event timestamp in epoch milliseconds.
+
+    Returns:
+        str: The partition path.
+    """
+    moment = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=ts)
+    return "year={}/month={:02d}".format(moment.year, moment.month)
+
+
+def convert_events(store, log_data, log_jsonpath, output_prefix, batch_size=BATCH_SIZE, uris=None,
+                   basename='part'):
+    """Converts the newline-delimited log JSON under a prefix to Parquet partitioned by year and month.
+
+    By default every log object is converted and the previous output is deleted once the new files are written.
+    Given uris, only those objects are converted, into files named after basename next to the existing ones.
+    Events without a ts cannot be partitioned and are skipped and counted.
+
+    Parameters:
+        store(object store): The object store holding the logs and the Parquet output.
+        log_data(str): The s3:// prefix of the song play logs.
+        log_jsonpath(str): The s3:// uri of the jsonpaths file mapping log keys to staging_events columns.
+        output_prefix(str): The s3:// prefix to write the Parquet files under.
+        batch_size(int): The number of rows per row group.
+        uris(list of str): The log objects to convert, or None for all of them.
+        basename(str): The name of the Parquet files before their number.
+
+    Returns:
+        list of str: The uris of the Parquet files written.
+    """
+    schema = arrow_schema(staging_events_table_create)
+    keys = [parse_jsonpath(path) for path in json.loads(store.get_object(log_jsonpath))['jsonpaths']]
+    types = [field.type for field in schema]
+    ts_index = [field.name for field in schema].index('ts')
+    skipped = []
+
+    def rows():
+        for uri in uris:
+            for record in iter_json_records(store.get_object(uri)):
+                row = [convert_value(record.get(key), data_type) for key, data_type in zip(keys, types)]
+                if row[ts_index] is None:
+                    skipped.append(uri)
+                    continue
+                yield event_partition(row[ts_index]), row
+
+    previous = None
+    if uris is None:
+        previous = [uri for uri, _ in store.list_objects(output_prefix)]
+        uris = [uri for uri, _ in store.list_objects(log_data)]
+        basename = run_basename(basename)
+    writer = PartitionedParquetWriter(store, output_prefix, schema, batch_size, basename=basename)
+    written = write_output(store, writer, rows(), previous)
+    if skipped:
+        print("Skipped {} events without a ts, first in {}".format(len(skipped), skipped[0]))
+    return written
+
+
+def convert_songs(store, song_data, output_prefix, batch_size=BATCH_SIZE, uris=None, basename='part'):
+    """Converts the song JSON objects under a prefix, one or more songs per object, to Parquet.
+
+    Parameters:
+        store(object store): The object store holding the songs and the Parquet output.
+        song_data(str): The s3:// prefix of the song metadata.
+        output_prefix(str): The s3:// prefix to write the Parquet files under.
+        batch_size(int): The number of rows per row group.
+        uris(list of str): The song objects to convert, or None for all of them, replacing the previous output.
+        basename(str): The name of the Parquet files before their number.
+
+    Returns:
+        list of str: The uris of the Parquet files written.
+    """
+    schema = arrow_schema(staging_songs_table_create)
+    fields = [(field.name.lower(), field.type) for field in schema]
+
+    def rows():
+        for uri in uris:
+            for record in iter_json_records(store.get_object(uri)):
+                yield '', [convert_value(record.get(name), data_type) for name, data_type in fields]
+
+    previous = None
+    if uris is None:
+        previous = [uri for uri, _ in store.list_objects(output_prefix)]
+        uris = [uri for uri, _ in store.list_objects(song_data)]
+        basename = run_basename(basename)
+    writer = PartitionedParquetWriter(store, output_prefix, schema, batch_size, basename=basename)
+    return write_output(store, writer, rows(), previous)
+
+
+def get_parquet_prefixes(config):
+    """Returns where the Parquet copies of the log and song data live, under PARQUET_PREFIX in [ETL].
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        tuple: The s3:// prefixes of the log and song Parquet files.
+    """
+    prefix = config['ETL']['PARQUET_PREFIX'].strip("'").rstrip('/')
+    return prefix + '/log_data', prefix + '/song_data'
+
+
+def convert_all(store, config):
+    """Converts both the log and song data configured in the [S3] section of dwh.cfg to Parquet.
+
+    Parameters:
+        store(object store): The object store holding the source data and the Parquet output.
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        tuple: The s3:// prefixes of the log and song Parquet files.
+    """
+    log_prefix, song_prefix = get_parquet_prefixes(config)
+    events = convert_events(store, config['S3']['LOG_DATA'].strip("'"), config['S3']['LOG_JSONPATH'].strip("'"),
+                            log_prefix)
+    songs = convert_songs(store, config['S3']['SONG_DATA'].strip("'"), song_prefix)
+    print("Wrote {} event and {} song Parquet files".format(len(events), len(songs)))
+    return log_prefix, song_prefix
+
+
+def main():
+    """The main function for parquet_stage.py.
+
+    Converts the raw log and song JSON to Parquet under PARQUET_PREFIX, either in S3 or in the local object
+    store used by the duckdb backend.
+    """
+    parser = argparse.ArgumentParser(description="Convert the raw song and log JSON to Parquet for staging.")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="read and write S3, or the local object store of the duckdb backend")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    convert_all(get_object_store(config, args.backend), config)
+
+
+if __name__ == "__main__":
+    main()
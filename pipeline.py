@@ -0,0 +1,271 @@
+import argparse
+import configparser
+import datetime
+import json
+import os
+import threading
+
+import iac
+import instrumentation
+import query_cache
+import sql_queries
+from backends import BACKENDS, REDSHIFT, connect, create_pool, get_object_store
+from create_tables import create_tables, drop_tables
+from etl import COPY_GROUP, COPY_SHARDING, build_staging_steps, build_steps, refresh_rollups
+from maintenance import maintain
+from scheduler import Step, expand_dependencies, print_timings, run_step, run_steps
+from sql_queries import insert_table_queries, insert_table_steps, song_key_steps
+
+STAGES = ('provision', 'create_tables', 'load', 'rollups', 'maintenance')
+DEFAULT_CHECKPOINT_FILE = '.pipeline_checkpoints.json'
+
+
+class Checkpoints:
+    """The completed stages, and the committed steps of the load stage, persisted in a JSON file.
+
+    Every change is written next to the file and renamed into place, so a crash never leaves it half written.
+    Steps are recorded as soon as they commit, so a rerun after a failure only runs the remaining ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {'stages': {}, 'steps': {}, 'plans': {}}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+    def reset(self, stages):
+        """Forgets the completed work of stages, so they run from scratch.
+
+        Parameters:
+            stages(list of str): The stage names.
+        """
+        with self.lock:
+            for stage in stages:
+                for key in ('stages', 'steps', 'plans'):
+                    self.state[key].pop(stage, None)
+            self.save()
+
+    def is_done(self, stage):
+        return stage in self.state['stages']
+
+    def mark_done(self, stage):
+        with self.lock:
+            self.state['stages'][stage] = datetime.datetime.utcnow().isoformat()
+            self.save()
+
+    def completed_steps(self, stage):
+        return set(self.state['steps'].get(stage, []))
+
+    def mark_step(self, stage, name):
+        with self.lock:
+            self.state['steps'].setdefault(stage, []).append(name)
+            self.save()
+
+    def plan(self, stage):
+        return self.state['plans'].get(stage)
+
+    def set_plan(self, stage, plan):
+        with self.lock:
+            self.state['plans'][stage] = plan
+            self.save()
+
+
+def run_provision(config, backend, checkpoints):
+    """Creates the role and the cluster with iac.py and writes their endpoint and ARN into dwh.cfg.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg, reread once it has been rewritten.
+        backend(str): 'redshift' or 'duckdb'. The duckdb backend has nothing to provision.
+        checkpoints(Checkpoints): The checkpoints of the run.
+    """
+    if backend != REDSHIFT:
+        print("Nothing to provision for the {} backend".format(backend))
+        return
+    endpoint, role_arn = iac.setup_data_warehouse(iac.create_iam_resource(), iac.create_redshift_resource(),
+                                                  iac.create_ec2_resource())
+    iac.write_dwh_config('dwh.cfg', endpoint, role_arn)
+    config.read('dwh.cfg')
+
+
+def run_create_tables(config, backend, checkpoints):
+    """Drops and recreates the tables.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' or 'duckdb'.
+        checkpoints(Checkpoints): The checkpoints of the run.
+    """
+    conn = connect(config, backend)
+    cur = conn.cursor()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    conn.close()
+
+
+def build_load_steps(config, backend, checkpoints):
+    """Builds the COPY and insert steps of the load stage, reusing the COPY shards planned by an earlier attempt.
+
+    The shards are planned once per run and kept in the checkpoints, so a resumed run loads exactly the
+    objects the committed shards did not, even if objects were added to the source since.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' or 'duckdb'.
+        checkpoints(Checkpoints): The checkpoints of the run.
+
+    Returns:
+        list of Step: Every step of the load stage.
+    """
+    plan = checkpoints.plan('load')
+    if plan is None:
+        staging_steps, replacements = build_staging_steps(get_object_store(config, backend), config)
+        copies = {}
+        for name, shards in replacements.items():
+            copies.update({shard: name for shard in shards})
+        plan = {'copies': [[step.name, copies.get(step.name, step.name), step.params and step.params[0]]
+                           for step in staging_steps],
+                'replacements': replacements}
+        checkpoints.set_plan('load', plan)
+
+    copy_queries = {name: query for name, query, _ in sql_queries.staging_table_steps}
+    staging_steps = []
+    for name, copy, manifest_uri in plan['copies']:
+        if manifest_uri:
+            staging_steps.append(Step(name, getattr(sql_queries, COPY_SHARDING[copy][1]), params=(manifest_uri,),
+                                      group=COPY_GROUP))
+        else:
+            staging_steps.append(Step(name, copy_queries[copy], group=COPY_GROUP))
+    return staging_steps + expand_dependencies(build_steps(song_key_steps + insert_table_steps),
+                                               plan['replacements'])
+
+
+def run_load(config, backend, checkpoints):
+    """Runs the staging COPYs and the inserts as a dependency DAG, skipping the steps that already committed.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' or 'duckdb'.
+        checkpoints(Checkpoints): The checkpoints of the run, updated as each step commits.
+    """
+    completed = checkpoints.completed_steps('load')
+    steps = [step for step in build_load_steps(config, backend, checkpoints) if step.name not in completed]
+    for step in steps:
+        step.depends_on = tuple(name for name in step.depends_on if name not in completed)
+    if completed:
+        print("Skipping {} steps that already committed: {}".format(len(completed), ', '.join(sorted(completed))))
+
+    def run_and_record(pool, step):
+        seconds = run_step(pool, step)
+        checkpoints.mark_step('load', step.name)
+        return seconds
+
+    max_connections = config.getint('ETL', 'MAX_CONNECTIONS')
+    pool = create_pool(config, max_connections, backend)
+    try:
+        print_timings(run_steps(steps, pool, max_connections, step_runner=run_and_record,
+                                group_limits={COPY_GROUP: config.getint('ETL', 'COPY_CONCURRENCY')}))
+    finally:
+        pool.closeall()
+    query_cache.invalidate_written(insert_table_queries)
+
+
+def run_rollups(config, backend, checkpoints):
+    """Refreshes the rollup tables.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' or 'duckdb'.
+        checkpoints(Checkpoints): The checkpoints of the run.
+    """
+    conn = connect(config, backend)
+    refresh_rollups(conn.cursor(), conn)
+    conn.close()
+
+
+def run_maintenance(config, backend, checkpoints):
+    """Vacuums and analyzes the tables whose sort order or statistics degraded during the load.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' or 'duckdb'. The duckdb backend has no SVV_TABLE_INFO to decide from.
+        checkpoints(Checkpoints): The checkpoints of the run.
+    """
+    if backend != REDSHIFT:
+        print("No maintenance for the {} backend".format(backend))
+        return
+    conn = connect(config, backend)
+    maintain(conn, config)
+    conn.close()
+
+
+STAGE_RUNNERS = {'provision': run_provision, 'create_tables': run_create_tables, 'load': run_load,
+                 'rollups': run_rollups, 'maintenance': run_maintenance}
+
+
+def run_pipeline(config, backend, checkpoints, stages, resume=False):
+    """Runs stages in order, skipping the ones the checkpoints record as completed.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' or 'duckdb'.
+        checkpoints(Checkpoints): The checkpoints of the run.
+        stages(list of str): The stages to run, in order.
+        resume(bool): Whether to keep the completed work of the stages, rather than running them from scratch.
+    """
+    if not resume:
+        checkpoints.reset(stages)
+    for stage in stages:
+        if checkpoints.is_done(stage):
+            print("== {}: already completed".format(stage))
+            continue
+        print("== {}".format(stage))
+        STAGE_RUNNERS[stage](config, backend, checkpoints)
+        checkpoints.mark_done(stage)
+
+
+def main():
+    """The main function for pipeline.py.
+
+    Runs provisioning, table creation, the load, the rollup refresh and table maintenance as named stages,
+    checkpointing every completed stage and every committed COPY shard and insert in CHECKPOINT_FILE in the
+    [ETL] section of dwh.cfg. With --resume a failed run continues where it stopped.
+    """
+    parser = argparse.ArgumentParser(description="Provision, create the tables and load the data warehouse.")
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('--from-stage', choices=STAGES, help="start at this stage instead of the first")
+    selection.add_argument('--only', choices=STAGES, help="run only this stage")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the stages and steps the previous run completed")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to run against: the Redshift cluster or the local DuckDB engine")
+    parser.add_argument('--metrics-file', help="write per-statement metrics to this Prometheus textfile")
+    args = parser.parse_args()
+    instrumentation.configure(capture_query_ids=args.backend == REDSHIFT)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    query_cache.configure(config.get('CACHE', 'DIRECTORY', fallback=None))
+    checkpoints = Checkpoints(config.get('ETL', 'CHECKPOINT_FILE', fallback=DEFAULT_CHECKPOINT_FILE))
+
+    if args.only:
+        stages = [args.only]
+    elif args.from_stage:
+        stages = list(STAGES[STAGES.index(args.from_stage):])
+    else:
+        stages = list(STAGES)
+    run_pipeline(config, args.backend, checkpoints, stages, args.resume)
+
+    if args.metrics_file:
+        instrumentation.write_prometheus_textfile(args.metrics_file, instrumentation.recorder.records)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,470 @@
+import argparse
+import collections
+import configparser
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import instrumentation
+from backends import BACKENDS, REDSHIFT, connect
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 900
+VERSIONS_FILE = 'table_versions.json'
+# Held around every read and read-modify-write of the versions file, across processes.
+VERSIONS_LOCK_FILE = 'table_versions.lock'
+# How often at most a QueryCache scans its spill directory for expired files.
+PRUNE_INTERVAL_SECONDS = 60
+
+TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|--[^\n]*|/\*.*?\*/|\s+|[^'\"\s/-]+|.", re.DOTALL)
+READ_PATTERN = re.compile(r'\b(?:from|join)\s+(?:\w+\.)?(\w+)', re.IGNORECASE)
+WRITE_PATTERN = re.compile(r'\b(?:insert\s+into|delete\s+from|update|truncate(?:\s+table)?|copy)\s+(?:\w+\.)?(\w+)',
+                           re.IGNORECASE)
+
+
+def normalize_sql(query):
+    """Normalizes a statement so that formatting differences do not change its cache key.
+
+    Comments are dropped, runs of whitespace collapse to one space and everything outside quoted literals and
+    identifiers is lower cased.
+
+    Parameters:
+        query(str): The statement.
+
+    Returns:
+        str: The normalized statement.
+    """
+    parts = []
+    pending_space = False
+    for token in TOKEN_PATTERN.findall(query):
+        if token.isspace() or token.startswith(('--', '/*')):
+            pending_space = True
+            continue
+        if pending_space and parts:
+            parts.append(' ')
+        pending_space = False
+        parts.append(token if token.startswith(("'", '"')) else token.lower())
+    return ''.join(parts).rstrip(';').strip()
+
+
+def cache_key(query, params=None):
+    """Builds the cache key of a statement and its parameters.
+
+    Parameters:
+        query(str): The statement.
+        params(tuple or dict): Optional psycopg2 style parameters.
+
+    Returns:
+        str: A hex digest identifying the result set.
+    """
+    payload = json.dumps([normalize_sql(query), params], default=str, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def tables_read(query):
+    """Lists the tables a query reads, so its cached result can be invalidated when one of them is loaded.
+
+    Parameters:
+        query(str): The query.
+
+    Returns:
+        list of str: The lower case table names, sorted.
+    """
+    return sorted({table.lower() for table in READ_PATTERN.findall(normalize_sql(query))})
+
+
+def tables_written(queries):
+    """Lists the tables a list of statements writes to.
+
+    Parameters:
+        queries(list of str): The statements, e.g. sql_queries.insert_table_queries.
+
+    Returns:
+        list of str: The lower case table names, sorted.
+    """
+    return sorted({table.lower() for query in queries for table in WRITE_PATTERN.findall(normalize_sql(query))})
+
+
+class TableVersions:
+    """Keeps a version number per table that is bumped every time a load commits into the table.
+
+    With a directory the versions are kept in a JSON file there, so that an ETL run invalidates the caches of
+    every client process sharing that directory. Without one they only live in this process. The file is read
+    under a shared and updated under an exclusive flock, so concurrent loaders, e.g. etl.py and stream_ingest.py,
+    never lose each other's bumps.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.versions = {}
+        self.file_state = None
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, VERSIONS_FILE)
+
+    @contextlib.contextmanager
+    def file_lock(self, exclusive):
+        """Holds a flock on the lock file next to the versions file.
+
+        Parameters:
+            exclusive(bool): Whether to lock for writing rather than reading.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, VERSIONS_LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reload(self):
+        """Rereads the versions file when another process has replaced it since it was last read."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.versions, self.file_state = {}, None
+            return
+        if (stat.st_mtime_ns, stat.st_size, stat.st_ino) != self.file_state:
+            with open(self.path) as f:
+                self.versions = json.load(f)
+            self.file_state = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def current(self, tables):
+        """Returns the current version of each table.
+
+        Parameters:
+            tables(list of str): The table names.
+
+        Returns:
+            dict: The version of each table, 0 for tables that have never been loaded.
+        """
+        with self.lock:
+            if self.directory:
+                with self.file_lock(exclusive=False):
+                    self.reload()
+            return {table: self.versions.get(table, 0) for table in tables}
+
+    def bump(self, tables):
+        """Marks tables as changed, invalidating every cached result that reads them.
+
+        The versions file is reread, updated and written under an exclusive lock. It is written next to its
+        destination and renamed into place so readers never see it half written.
+
+        Parameters:
+            tables(list of str): The table names.
+        """
+        if not tables:
+            return
+        with self.lock:
+            if not self.directory:
+                for table in tables:
+                    self.versions[table] = self.versions.get(table, 0) + 1
+                return
+            with self.file_lock(exclusive=True):
+                self.file_state = None
+                self.reload()
+                for table in tables:
+                    self.versions[table] = self.versions.get(table, 0) + 1
+                temporary_path = "{}.{}.tmp".format(self.path, os.getpid())
+                with open(temporary_path, 'w') as f:
+                    json.dump(self.versions, f, sort_keys=True)
+                os.replace(temporary_path, self.path)
+                self.file_state = None
+
+
+versions = TableVersions()
+
+
+def configure(directory=None):
+    """Sets where the shared table versions are kept, e.g. the DIRECTORY in the [CACHE] section of dwh.cfg.
+
+    Parameters:
+        directory(str): The directory shared with the query clients, or None to only invalidate in process.
+    """
+    versions.directory = directory
+    versions.file_state = None
+
+
+def invalidate_written(queries):
+    """Invalidates the cached results that read any table written by statements that were just committed.
+
+    Parameters:
+        queries(list of str): The committed statements.
+    """
+    versions.bump(tables_written(queries))
+
+
+def result_size(columns, rows):
+    """Estimates the memory held by a result set in bytes.
+
+    Parameters:
+        columns(list of str): The column names.
+        rows(list of tuple): The rows.
+
+    Returns:
+        int: The approximate size.
+    """
+    size = sys.getsizeof(rows) + sum(sys.getsizeof(column) for column in columns)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+class QueryCache:
+    """An LRU cache of query results bounded by an approximate byte budget.
+
+    Entries expire after ttl_seconds, or as soon as a table they read is loaded again. With a spill directory,
+    entries evicted from memory are written there as Parquet files and read back on the next hit, which
+    requires pyarrow. Spilled files whose entries have expired are deleted by prune_spilled, which runs at most
+    every PRUNE_INTERVAL_SECONDS when an entry is spilled.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS, spill_directory=None,
+                 table_versions=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.spill_directory = spill_directory
+        self.versions = table_versions or versions
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pruned_at = 0
+
+    def is_fresh(self, entry):
+        return (time.time() - entry['created_at'] < self.ttl_seconds
+                and self.versions.current(entry['tables']) == entry['versions'])
+
+    def get(self, key):
+        """Looks up a result set in memory, then in the spill directory.
+
+        Parameters:
+            key(str): The cache key.
+
+        Returns:
+            tuple: The column names and rows, or None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry['size']
+        if entry is None and self.spill_directory:
+            entry = self.read_spilled(key)
+
+        if entry is None or not self.is_fresh(entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.store(key, entry)
+        return entry['columns'], entry['rows']
+
+    def put(self, key, tables, table_versions, columns, rows):
+        """Caches a result set.
+
+        Parameters:
+            key(str): The cache key.
+            tables(list of str): The tables the query reads.
+            table_versions(dict): The versions of those tables taken before the query ran.
+            columns(list of str): The column names.
+            rows(list of tuple): The rows.
+        """
+        self.store(key, {
+            'columns': list(columns),
+            'rows': list(rows),
+            'tables': list(tables),
+            'versions': dict(table_versions),
+            'created_at': time.time(),
+            'size': result_size(columns, rows),
+        })
+
+    def store(self, key, entry):
+        """Puts an entry at the most recently used end and evicts from the other end to stay within budget."""
+        evicted = []
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous['size']
+            self.entries[key] = entry
+            self.size += entry['size']
+            while self.size > self.max_bytes and self.entries:
+                evicted_key, evicted_entry = self.entries.popitem(last=False)
+                self.size -= evicted_entry['size']
+                evicted.append((evicted_key, evicted_entry))
+        if self.spill_directory and evicted:
+            for evicted_key, evicted_entry in evicted:
+                self.spill(evicted_key, evicted_entry)
+            if time.time() - self.pruned_at >= PRUNE_INTERVAL_SECONDS:
+                self.prune_spilled()
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_directory, key + '.parquet')
+
+    def spill(self, key, entry):
+        """Writes an evicted entry to the spill directory, skipping results Arrow cannot represent.
+
+        Parameters:
+            key(str): The cache key.
+            entry(dict): The evicted entry.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self.is_fresh(entry):
+            return
+        metadata = {field: entry[field] for field in ('columns', 'tables', 'versions', 'created_at')}
+        try:
+            arrays = [pa.array([row[index] for row in entry['rows']]) for index in range(len(entry['columns']))]
+            table = pa.Table.from_arrays(arrays, names=['c{}'.format(index) for index in range(len(arrays))])
+        except (pa.ArrowException, ValueError):
+            return
+        table = table.replace_schema_metadata({'query_cache': json.dumps(metadata)})
+
+        os.makedirs(self.spill_directory, exist_ok=True)
+        temporary_path = "{}.{}.tmp".format(self.spill_path(key), os.getpid())
+        pq.write_table(table, temporary_path)
+        os.replace(temporary_path, self.spill_path(key))
+
+    def prune_spilled(self):
+        """Deletes the spilled files whose entries have expired or read a table that was loaded since.
+
+        Files older than ttl_seconds are deleted without being opened, including the temporary files of writers
+        that crashed; for the others only the Parquet metadata is read.
+
+        Returns:
+            int: The number of files deleted.
+        """
+        import pyarrow.parquet as pq
+
+        self.pruned_at = time.time()
+        try:
+            names = os.listdir(self.spill_directory)
+        except FileNotFoundError:
+            return 0
+        deleted = 0
+        for name in names:
+            path = os.path.join(self.spill_directory, name)
+            try:
+                expired = time.time() - os.stat(path).st_mtime >= self.ttl_seconds
+                if not expired and name.endswith('.parquet'):
+                    metadata = json.loads(pq.read_schema(path).metadata[b'query_cache'])
+                    expired = not self.is_fresh(metadata)
+                if expired:
+                    os.remove(path)
+                    deleted += 1
+            except (OSError, KeyError, TypeError, ValueError):
+                # Read back, replaced or written by another process in the meantime.
+                continue
+        return deleted
+
+    def read_spilled(self, key):
+        """Reads an entry back from the spill directory, removing it there.
+
+        Parameters:
+            key(str): The cache key.
+
+        Returns:
+            dict: The entry, or None if it was never spilled.
+        """
+        import pyarrow.parquet as pq
+
+        path = self.spill_path(key)
+        try:
+            table = pq.read_table(path)
+        except FileNotFoundError:
+            return None
+        os.remove(path)
+
+        entry = json.loads(table.schema.metadata[b'query_cache'])
+        entry['rows'] = list(zip(*[column.to_pylist() for column in table.columns]))
+        entry['size'] = result_size(entry['columns'], entry['rows'])
+        return entry
+
+
+class QueryClient:
+    """Runs read-only queries against the warehouse, answering repeated ones from a QueryCache."""
+
+    def __init__(self, conn, cache):
+        self.conn = conn
+        self.cache = cache
+
+    def query(self, query, params=None):
+        """Returns the result set of a query, from the cache when a fresh copy is there.
+
+        Parameters:
+            query(str): The SELECT statement.
+            params(tuple or dict): Optional psycopg2 style parameters.
+
+        Returns:
+            tuple: The column names and the rows.
+        """
+        key = cache_key(query, params)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        # Versions are taken before the query runs, so a load that commits while it runs invalidates the result.
+        tables = tables_read(query)
+        table_versions = self.cache.versions.current(tables)
+        cur = self.conn.cursor()
+        instrumentation.execute(cur, query, params)
+        columns = [description[0] for description in cur.description]
+        rows = cur.fetchall()
+        cur.close()
+        self.conn.rollback()
+        self.cache.put(key, tables, table_versions, columns, rows)
+        return columns, rows
+
+    def close(self):
+        self.conn.close()
+
+
+def open_client(config, backend=REDSHIFT):
+    """Opens a query client on the chosen backend with the cache configured in the [CACHE] section of dwh.cfg.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        backend(str): 'redshift' or 'duckdb'.
+
+    Returns:
+        QueryClient: The client.
+    """
+    directory = config.get('CACHE', 'DIRECTORY', fallback=None)
+    configure(directory)
+    cache = QueryCache(config.getint('CACHE', 'MAX_BYTES', fallback=DEFAULT_MAX_BYTES),
+                       config.getint('CACHE', 'TTL_SECONDS', fallback=DEFAULT_TTL_SECONDS),
+                       os.path.join(directory, 'results') if directory else None)
+    return QueryClient(connect(config, backend), cache)
+
+
+def main():
+    """The main function for query_cache.py.
+
+    Runs a query twice through the cache and prints both timings, to check that the cache answers it.
+    """
+    parser = argparse.ArgumentParser(description="Run a query through the warehouse result cache.")
+    parser.add_argument('query', help="the SELECT statement to run")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to run against: the Redshift cluster or the local DuckDB engine")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    client = open_client(config, args.backend)
+    for attempt in ('cold', 'cached'):
+        start = time.perf_counter()
+        columns, rows = client.query(args.query)
+        print("{}: {} rows in {:.4f}s".format(attempt, len(rows), time.perf_counter() - start))
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import instrumentation
+
+
+class Step:
+    """A named SQL statement and the names of the steps that must commit before it can run.
+
+    Steps that share a group can be limited to a number of concurrent runs, e.g. to cap parallel COPYs.
+    """
+
+    def __init__(self, name, query, depends_on=(), params=None, group=None):
+        self.name = name
+        self.query = query
+        self.depends_on = tuple(depends_on)
+        self.params = params
+        self.group = group
+
+    def __repr__(self):
+        return "Step({!r}, depends_on={!r})".format(self.name, self.depends_on)
+
+
+def validate_steps(steps):
+    """Checks that step names are unique, every dependency exists and there are no cycles.
+
+    Parameters:
+        steps(list of Step): The steps to validate.
+
+    Raises:
+        ValueError: If the steps do not form a valid DAG.
+    """
+    names = [step.name for step in steps]
+    if len(names) != len(set(names)):
+        raise ValueError("Duplicate step names in {}".format(names))
+    for step in steps:
+        for dependency in step.depends_on:
+            if dependency not in names:
+                raise ValueError("Step {} depends on unknown step {}".format(step.name, dependency))
+
+    remaining = {step.name: set(step.depends_on) for step in steps}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError("Dependency cycle between steps {}".format(sorted(remaining)))
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def run_step(pool, step):
+    """Runs a single step on a connection borrowed from the pool and commits it.
+
+    Parameters:
+        pool(psycopg2 connection pool): The pool to borrow a connection from.
+        step(Step): The step to run.
+
+    Returns:
+        float: The wall time of the step in seconds.
+    """
+    conn = pool.getconn()
+    try:
+        start = time.perf_counter()
+        cur = conn.cursor()
+        instrumentation.execute(cur, step.query, step.params, step.name)
+        conn.commit()
+        return time.perf_counter() - start
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def expand_dependencies(steps, replacements):
+    """Rewrites dependencies on a step that has been split into several steps, e.g. sharded COPYs.
+
+    Parameters:
+        steps(list of Step): The steps whose dependencies to rewrite, modified in place.
+        replacements(dict): The names of the steps that replace each original step name.
+
+    Returns:
+        list of Step: The same steps.
+    """
+    for step in steps:
+        depends_on = []
+        for dependency in step.depends_on:
+            depends_on.extend(replacements.get(dependency, [dependency]))
+        step.depends_on = tuple(depends_on)
+    return steps
+
+
+def run_steps(steps, pool, max_workers, step_runner=run_step, group_limits=None):
+    """Runs the steps concurrently, starting each as soon as all of its dependencies have committed.
+
+    At most max_workers steps run at once, each on its own pooled connection, and at most
+    group_limits[group] steps of a limited group. If a step fails no new steps are started, the ones
+    already running are allowed to finish and the first error is re-raised.
+
+    Parameters:
+        steps(list of Step): The steps to run.
+        pool(psycopg2 connection pool): The pool to borrow connections from, sized for max_workers.
+        max_workers(int): The maximum number of steps to run at the same time.
+        step_runner(function): Called as step_runner(pool, step) and returns the step's wall time.
+        group_limits(dict): Optional maximum number of concurrently running steps per group.
+
+    Returns:
+        dict: The wall time in seconds of each step, keyed by step name, in completion order.
+    """
+    validate_steps(steps)
+    group_limits = group_limits or {}
+    pending = {step.name: step for step in steps}
+    completed = set()
+    timings = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            if error is None:
+                for name in [name for name, step in pending.items() if completed.issuperset(step.depends_on)]:
+                    group = pending[name].group
+                    if group in group_limits:
+                        group_running = sum(1 for step in running.values() if step.group == group)
+                        if group_running >= group_limits[group]:
+                            continue
+                    step = pending.pop(name)
+                    running[executor.submit(step_runner, pool, step)] = step
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future).name
+                try:
+                    timings[name] = future.result()
+                    completed.add(name)
+                except Exception as e:
+                    if error is None:
+                        error = e
+
+    if error is not None:
+        raise error
+    return timings
+
+
+def print_timings(timings):
+    """Prints the wall time of each step.
+
+    Parameters:
+        timings(dict): The wall time in seconds of each step, keyed by step name.
+    """
+    for name, seconds in timings.items():
+        print("{:<32} {:>10.2f}s".format(name, seconds))
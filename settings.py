@@ -0,0 +1,103 @@
+import collections
+import configparser
+import functools
+import os
+
+DEFAULT_CONFIG = 'dwh.cfg'
+DEFAULT_AWS_CONFIG = 'aws_cred.cfg'
+DEFAULT_REGION = 'us-west-2'
+
+# Where the source data lives, from the [S3] section of dwh.cfg.
+S3Settings = collections.namedtuple('S3Settings', ['log_data', 'log_jsonpath', 'song_data', 'region'])
+# What the COPY statements are rendered from.
+DwhSettings = collections.namedtuple('DwhSettings', ['role_arn', 's3'])
+# The credentials and cluster definition in aws_cred.cfg.
+AwsSettings = collections.namedtuple('AwsSettings', [
+    'key', 'secret', 'region', 'cluster_type', 'num_nodes', 'node_type', 'iam_role_name', 'cluster_identifier',
+    'db', 'db_user', 'db_password', 'port'])
+
+
+def file_version(path):
+    """Identifies the current contents of a file without reading it.
+
+    Parameters:
+        path(str): The file.
+
+    Returns:
+        tuple: Its modification time, size and inode.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def unquote(value):
+    return value.strip().strip("'\"")
+
+
+@functools.lru_cache(maxsize=None)
+def parse_settings(path, version):
+    """Parses dwh.cfg, once per version of the file.
+
+    Parameters:
+        path(str): The absolute path of dwh.cfg.
+        version(tuple): The file_version of the file, so that a rewritten file is parsed again.
+
+    Returns:
+        DwhSettings: The settings.
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    s3 = config['S3']
+    return DwhSettings(role_arn=unquote(config['IAM_ROLE']['ARN']),
+                       s3=S3Settings(log_data=unquote(s3['LOG_DATA']), log_jsonpath=unquote(s3['LOG_JSONPATH']),
+                                     song_data=unquote(s3['SONG_DATA']),
+                                     region=unquote(s3.get('REGION', DEFAULT_REGION))))
+
+
+def load_settings(path=DEFAULT_CONFIG):
+    """Returns the settings of dwh.cfg, reading the file only on first use and whenever it has changed.
+
+    Parameters:
+        path(str): The path of dwh.cfg.
+
+    Returns:
+        DwhSettings: The settings.
+    """
+    return parse_settings(os.path.abspath(path), file_version(path))
+
+
+@functools.lru_cache(maxsize=None)
+def parse_aws_settings(path, version):
+    """Parses aws_cred.cfg, once per version of the file.
+
+    Parameters:
+        path(str): The absolute path of aws_cred.cfg.
+        version(tuple): The file_version of the file, so that a rewritten file is parsed again.
+
+    Returns:
+        AwsSettings: The settings.
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    aws = config['AWS']
+    dwh = config['DWH']
+    return AwsSettings(key=aws['KEY'], secret=aws['SECRET'], region=aws.get('REGION', DEFAULT_REGION),
+                       cluster_type=dwh['DWH_CLUSTER_TYPE'], num_nodes=dwh.getint('DWH_NUM_NODES'),
+                       node_type=dwh['DWH_NODE_TYPE'], iam_role_name=dwh['DWH_IAM_ROLE_NAME'],
+                       cluster_identifier=dwh['DWH_CLUSTER_IDENTIFIER'], db=dwh['DWH_DB'],
+                       db_user=dwh['DWH_DB_USER'], db_password=dwh['DWH_DB_PASSWORD'], port=dwh.getint('DWH_PORT'))
+
+
+def load_aws_settings(path=DEFAULT_AWS_CONFIG):
+    """Returns the settings of aws_cred.cfg, reading the file only on first use and whenever it has changed.
+
+    Parameters:
+        path(str): The path of aws_cred.cfg.
+
+    Returns:
+        AwsSettings: The settings.
+    """
+    return parse_aws_settings(os.path.abspath(path), file_version(path))
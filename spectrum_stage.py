@@ -0,0 +1,307 @@
+import argparse
+import configparser
+import datetime
+import hashlib
+import os
+import re
+
+import instrumentation
+from backends import BACKENDS, DUCKDB, REDSHIFT, get_object_store, quote_literal
+from ddl import parse_create_table
+from parquet_stage import DERIVED_COLUMNS, convert_events, convert_songs
+from settings import load_settings
+from sql_queries import (insert_table_steps, spectrum_partition_add, spectrum_schema_create,
+                         spectrum_staging_events_select, spectrum_staging_songs_select, spectrum_table_create,
+                         staging_events_table_create, staging_songs_table_create)
+
+# Spectrum has no TEXT type, and DECIMAL without a precision is Redshift's DECIMAL(18,0), as in the Parquet files.
+SPECTRUM_TYPES = {'TEXT': 'VARCHAR(256)', 'DECIMAL': 'DECIMAL(18,0)'}
+# The year=/month= directories parquet_stage.event_partition writes the log data into.
+PARTITION_PATTERN = re.compile(r'/year=(?P<year>\d+)/month=(?P<month>\d+)/')
+EVENTS_PARTITIONED_BY = "PARTITIONED BY (year SMALLINT, month SMALLINT)\n"
+STAGING_TABLE_PATTERN = re.compile(r'\bFROM\s+(?P<table>staging_events|staging_songs)\b')
+EPOCH = datetime.date(1970, 1, 1)
+# The etl_loaded_objects and etl_watermarks sources of the Spectrum mode, apart from those of the staged loads.
+SPECTRUM_EVENTS_SOURCE = 'spectrum_events'
+SPECTRUM_SONGS_SOURCE = 'spectrum_songs'
+
+
+def external_columns(create_statement):
+    """Lists the columns of the external table over the Parquet copy of a staging table.
+
+    The columns follow the Parquet schema of parquet_stage.arrow_schema: the staging columns in order, without
+    the DERIVED_COLUMNS.
+
+    Parameters:
+        create_statement(str): The CREATE TABLE statement of the staging table.
+
+    Returns:
+        list of tuple: The (name, Spectrum type) of each column.
+    """
+    _, columns, _ = parse_create_table(create_statement)
+    return [(column.name, SPECTRUM_TYPES.get(column.data_type.upper(), column.data_type))
+            for column in columns if column.name not in DERIVED_COLUMNS]
+
+
+def list_partitions(store, log_prefix):
+    """Lists the year and month partitions of the log Parquet files.
+
+    Parameters:
+        store(object store): The object store holding the Parquet files.
+        log_prefix(str): The s3:// prefix of the log Parquet files.
+
+    Returns:
+        list of tuple: The sorted (year, month) of each partition.
+    """
+    partitions = set()
+    for uri, _ in store.list_objects(log_prefix):
+        match = PARTITION_PATTERN.search(uri[len(log_prefix.rstrip('/')):])
+        if match is not None:
+            partitions.add((int(match.group('year')), int(match.group('month'))))
+    return sorted(partitions)
+
+
+def render_external_ddl(schema, database, role_arn, log_prefix, song_prefix, partitions):
+    """Renders the statements that (re)define the external staging tables on Redshift.
+
+    Parameters:
+        schema(str): The external schema.
+        database(str): The data catalog database behind the schema.
+        role_arn(str): The ARN of the role the cluster reads S3 and the data catalog with.
+        log_prefix(str): The s3:// prefix of the log Parquet files.
+        song_prefix(str): The s3:// prefix of the song Parquet files.
+        partitions(list of tuple): The (year, month) partitions of the log files to register.
+
+    Returns:
+        list of str: The statements, in order.
+    """
+    statements = [spectrum_schema_create.format(schema=schema, database=database, role_arn=role_arn)]
+    for table, create_statement, prefix, partitioned_by in (
+            ('staging_events', staging_events_table_create, log_prefix, EVENTS_PARTITIONED_BY),
+            ('staging_songs', staging_songs_table_create, song_prefix, '')):
+        columns = ',\n'.join("    {:<20}{}".format(name, data_type)
+                             for name, data_type in external_columns(create_statement))
+        statements.append("DROP TABLE IF EXISTS {}.{}".format(schema, table))
+        statements.append(spectrum_table_create.format(schema=schema, table=table, columns=columns,
+                                                       partitioned_by=partitioned_by,
+                                                       location=prefix.rstrip('/') + '/'))
+    for year, month in partitions:
+        statements.append(spectrum_partition_add.format(
+            schema=schema, table='staging_events', partition="year={}, month={}".format(year, month),
+            location="{}/year={}/month={:02d}/".format(log_prefix.rstrip('/'), year, month)))
+    return statements
+
+
+def render_local_ddl(store, schema, log_prefix, song_prefix):
+    """Renders DuckDB views that stand in for the external staging tables, reading the local Parquet files.
+
+    Parameters:
+        store(LocalObjectStore): The local object store holding the Parquet files.
+        schema(str): The schema to create the views in.
+        log_prefix(str): The s3:// prefix of the log Parquet files.
+        song_prefix(str): The s3:// prefix of the song Parquet files.
+
+    Returns:
+        list of str: The statements, in order.
+    """
+    statements = ["CREATE SCHEMA IF NOT EXISTS {}".format(schema)]
+    for table, prefix, hive_partitioning in (('staging_events', log_prefix, 'true'),
+                                             ('staging_songs', song_prefix, 'false')):
+        files = os.path.join(store.local_path(prefix.rstrip('/')), '**', '*.parquet')
+        statements.append("CREATE OR REPLACE VIEW {}.{} AS SELECT * FROM read_parquet({}, hive_partitioning = {})"
+                          .format(schema, table, quote_literal(files), hive_partitioning))
+    return statements
+
+
+def get_spectrum_prefixes(config):
+    """Returns where the Parquet files behind the external tables live, under PREFIX in [SPECTRUM].
+
+    They are kept apart from PARQUET_PREFIX, which etl.py --parquet rewrites from scratch on every run.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+
+    Returns:
+        tuple: The s3:// prefixes of the log and song Parquet files.
+    """
+    prefix = config['SPECTRUM']['PREFIX'].strip("'").rstrip('/')
+    return prefix + '/log_data', prefix + '/song_data'
+
+
+def batch_basename(uris):
+    """Names the Parquet files of a batch of source objects after the objects, so a retried batch overwrites its
+    own files instead of adding a second copy of the rows.
+
+    Parameters:
+        uris(list of str): The source objects of the batch.
+
+    Returns:
+        str: The file basename.
+    """
+    return 'batch-' + hashlib.sha1('\n'.join(sorted(uris)).encode('utf-8')).hexdigest()[:16]
+
+
+def convert_new_objects(store, config, loaded):
+    """Converts only the log and song objects that no earlier run converted, next to the existing Parquet files.
+
+    Parameters:
+        store(object store): The object store holding the source data and the Parquet files.
+        config(ConfigParser): The parsed dwh.cfg.
+        loaded(dict): The uris already converted, keyed by SPECTRUM_EVENTS_SOURCE and SPECTRUM_SONGS_SOURCE.
+
+    Returns:
+        dict: The uris converted by this run, keyed the same way.
+    """
+    log_prefix, song_prefix = get_spectrum_prefixes(config)
+    log_data = config['S3']['LOG_DATA'].strip("'")
+    song_data = config['S3']['SONG_DATA'].strip("'")
+    new_objects = {source: [uri for uri, _ in store.list_objects(prefix) if uri not in loaded.get(source, set())]
+                   for source, prefix in ((SPECTRUM_EVENTS_SOURCE, log_data), (SPECTRUM_SONGS_SOURCE, song_data))}
+
+    events = new_objects[SPECTRUM_EVENTS_SOURCE]
+    songs = new_objects[SPECTRUM_SONGS_SOURCE]
+    if events:
+        convert_events(store, log_data, config['S3']['LOG_JSONPATH'].strip("'"), log_prefix, uris=events,
+                       basename=batch_basename(events))
+    if songs:
+        convert_songs(store, song_data, song_prefix, uris=songs, basename=batch_basename(songs))
+    print("Converted {} new log and {} new song objects to Parquet".format(len(events), len(songs)))
+    return new_objects
+
+
+def epoch_millis(day):
+    return (day - EPOCH).days * 86400000
+
+
+def partition_predicate(start_date=None, end_date=None, after_ts=None):
+    """Builds the filter on the log partitions and timestamps of a run's date range.
+
+    The year and month conditions only reference partition columns, so Spectrum skips the partitions outside
+    the range without listing their files. The ts conditions trim the first and last months to the exact range.
+
+    Parameters:
+        start_date(date): The first day of the range, or None for no lower bound.
+        end_date(date): The day after the range, or None for no upper bound.
+        after_ts(int): Only events after this epoch millisecond timestamp, e.g. the watermark of the last run.
+
+    Returns:
+        str: The SQL predicate, TRUE when the range is unbounded.
+    """
+    conditions = []
+    first_day = start_date
+    if after_ts is not None:
+        after_day = (datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=after_ts)).date()
+        first_day = after_day if first_day is None else max(first_day, after_day)
+    if first_day is not None:
+        conditions.append("(year > {0} OR (year = {0} AND month >= {1}))".format(first_day.year, first_day.month))
+    if start_date is not None:
+        conditions.append("ts >= {}".format(epoch_millis(start_date)))
+    if after_ts is not None:
+        conditions.append("ts > {}".format(int(after_ts)))
+    if end_date is not None:
+        last_day = end_date - datetime.timedelta(days=1)
+        conditions.append("(year < {0} OR (year = {0} AND month <= {1}))".format(last_day.year, last_day.month))
+        conditions.append("ts < {}".format(epoch_millis(end_date)))
+    return ' AND '.join(conditions) or 'TRUE'
+
+
+def spectrum_query(query, schema, predicate):
+    """Rewrites an insert query to read the external staging tables instead of the loaded ones.
+
+    Parameters:
+        query(str): The insert query, reading staging_events and staging_songs.
+        schema(str): The external schema.
+        predicate(str): The partition_predicate of the run.
+
+    Returns:
+        str: The query with each staging table replaced by a select from its external table.
+    """
+    selects = {'staging_events': spectrum_staging_events_select.format(schema=schema, predicate=predicate),
+               'staging_songs': spectrum_staging_songs_select.format(schema=schema)}
+    return STAGING_TABLE_PATTERN.sub(
+        lambda match: "FROM {} {}".format(selects[match.group('table')], match.group('table')), query)
+
+
+def spectrum_insert_steps(schema, predicate):
+    """Returns the insert queries of insert_table_steps rewritten to read the external staging tables.
+
+    Parameters:
+        schema(str): The external schema.
+        predicate(str): The partition_predicate of the run.
+
+    Returns:
+        list of tuple: The (name, query) of each insert, in insert_table_steps order.
+    """
+    return [(name, spectrum_query(query, schema, predicate)) for name, query, _ in insert_table_steps]
+
+
+def render_ddl(config, store, backend=REDSHIFT):
+    """Renders the statements that define the external staging tables for the settings in dwh.cfg.
+
+    Parameters:
+        config(ConfigParser): The parsed dwh.cfg.
+        store(object store): The object store holding the Parquet files.
+        backend(str): 'redshift' for Spectrum external tables, 'duckdb' for local views.
+
+    Returns:
+        list of str: The statements, in order.
+    """
+    schema = config['SPECTRUM']['SCHEMA']
+    log_prefix, song_prefix = get_spectrum_prefixes(config)
+    if backend == DUCKDB:
+        return render_local_ddl(store, schema, log_prefix, song_prefix)
+    return render_external_ddl(schema, config['SPECTRUM']['DATABASE'], load_settings().role_arn, log_prefix,
+                               song_prefix, list_partitions(store, log_prefix))
+
+
+def create_external_tables(conn, statements):
+    """Runs the external table statements.
+
+    External DDL cannot run inside a transaction, so the statements run in autocommit mode.
+
+    Parameters:
+        conn(psycopg2 connection): The connection to the data warehouse.
+        statements(list of str): The statements from render_ddl.
+    """
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        for statement in statements:
+            instrumentation.execute(cur, statement)
+    finally:
+        conn.autocommit = False
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main():
+    """The main function for spectrum_stage.py.
+
+    Prints the statements that define the external staging tables over the Parquet copies of the log and song
+    data, and the insert queries that read them for a date range, without running anything. With --local-data
+    the partitions are listed from the local object store, so the Redshift DDL renders without AWS access.
+    """
+    parser = argparse.ArgumentParser(description="Render the Spectrum external staging DDL and insert queries.")
+    parser.add_argument('--start-date', type=parse_date, help="the first day of log data to insert, YYYY-MM-DD")
+    parser.add_argument('--end-date', type=parse_date, help="the day after the last day to insert, YYYY-MM-DD")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="render Spectrum external tables, or the local views of the duckdb backend")
+    parser.add_argument('--local-data', action='store_true',
+                        help="list the log partitions from DATA_ROOT in [LOCAL] instead of S3")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    store = get_object_store(config, DUCKDB if args.local_data else args.backend)
+    for statement in render_ddl(config, store, args.backend):
+        print(statement.strip() + ';\n')
+    for name, query in spectrum_insert_steps(config['SPECTRUM']['SCHEMA'],
+                                             partition_predicate(args.start_date, args.end_date)):
+        print("-- {}\n{};\n".format(name, query.strip()))
+
+
+if __name__ == "__main__":
+    main()
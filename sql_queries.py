@@ -1,10 +1,12 @@
-import configparser
+import collections
 
-# CONFIG
+from settings import DEFAULT_CONFIG, load_settings
 
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
-DWH_ROLE_ARN = config['IAM_ROLE']['ARN']
+# The staging columns loaded by COPY. song_key is derived after the load by the song key updates.
+STAGING_EVENTS_COLUMNS = ("artist, auth, firstName, gender, itemInSession, lastName, length, level, location, "
+                          "method, page, registration, sessionId, song, status, ts, userAgent, userId")
+STAGING_SONGS_COLUMNS = ("num_songs, artist_id, artist_latitude, artist_longitude, artist_location, artist_name, "
+                         "song_id, title, duration, year")
 
 # DROP TABLES
 
@@ -15,6 +17,13 @@ user_table_drop = "DROP TABLE IF EXISTS dim_users"
 song_table_drop = "DROP TABLE IF EXISTS dim_songs"
 artist_table_drop = "DROP TABLE IF EXISTS dim_artists"
 time_table_drop = "DROP TABLE IF EXISTS dim_times"
+calendar_table_drop = "DROP TABLE IF EXISTS dim_calendar"
+song_plays_hourly_table_drop = "DROP TABLE IF EXISTS agg_song_plays_hourly"
+song_plays_daily_table_drop = "DROP TABLE IF EXISTS agg_song_plays_daily"
+artist_plays_weekly_table_drop = "DROP TABLE IF EXISTS agg_artist_plays_weekly"
+daily_active_users_table_drop = "DROP TABLE IF EXISTS agg_daily_active_users"
+etl_watermarks_table_drop = "DROP TABLE IF EXISTS etl_watermarks"
+etl_loaded_objects_table_drop = "DROP TABLE IF EXISTS etl_loaded_objects"
 
 # CREATE TABLES
 
@@ -38,7 +47,8 @@ CREATE TABLE IF NOT EXISTS staging_events
     status              SMALLINT    NOT NULL,
     ts                  BIGINT      NOT NULL,
     userAgent           TEXT,
-    userId              INTEGER
+    userId              INTEGER,
+    song_key            BIGINT
 )
 """)
 
@@ -54,7 +64,8 @@ CREATE TABLE IF NOT EXISTS staging_songs
     song_id             TEXT        NOT NULL,
     title               TEXT        NOT NULL,
     duration            DECIMAL     NOT NULL,
-    year                INTEGER     NOT NULL
+    year                INTEGER     NOT NULL,
+    song_key            BIGINT
 )
 """)
 
@@ -91,7 +102,8 @@ CREATE TABLE IF NOT EXISTS dim_songs
     title               TEXT        NOT NULL,
     artist_id           TEXT        NOT NULL    DISTKEY,
     year                INTEGER     NOT NULL,
-    duration            DECIMAL     NOT NULL
+    duration            DECIMAL     NOT NULL,
+    song_key            BIGINT
 )
 """)
 
@@ -109,7 +121,21 @@ CREATE TABLE IF NOT EXISTS dim_artists
 time_table_create = ("""
 CREATE TABLE IF NOT EXISTS dim_times
 (
-    start_time          BIGINT      PRIMARY KEY,
+    start_time          BIGINT      PRIMARY KEY SORTKEY,
+    hour                INTEGER     NOT NULL,
+    day                 INTEGER     NOT NULL,
+    week                INTEGER     NOT NULL,
+    month               INTEGER     NOT NULL,
+    year                INTEGER     NOT NULL,
+    weekday             INTEGER     NOT NULL
+)
+""")
+
+calendar_table_create = ("""
+CREATE TABLE IF NOT EXISTS dim_calendar
+(
+    calendar_id         BIGINT      PRIMARY KEY SORTKEY,
+    start_ts            TIMESTAMP   NOT NULL,
     hour                INTEGER     NOT NULL,
     day                 INTEGER     NOT NULL,
     week                INTEGER     NOT NULL,
@@ -117,87 +143,605 @@ CREATE TABLE IF NOT EXISTS dim_times
     year                INTEGER     NOT NULL,
     weekday             INTEGER     NOT NULL
 )
+DISTSTYLE ALL
+""")
+
+# ROLLUP TABLES
+# Periods are keyed like start_time, in epoch milliseconds: the start of the hour, day or Monday of the week.
+
+song_plays_hourly_table_create = ("""
+CREATE TABLE IF NOT EXISTS agg_song_plays_hourly
+(
+    hour_start          BIGINT      NOT NULL    SORTKEY,
+    song_id             TEXT        NOT NULL    DISTKEY,
+    artist_id           TEXT        NOT NULL,
+    plays               BIGINT      NOT NULL
+)
+""")
+
+song_plays_daily_table_create = ("""
+CREATE TABLE IF NOT EXISTS agg_song_plays_daily
+(
+    day_start           BIGINT      NOT NULL    SORTKEY,
+    song_id             TEXT        NOT NULL    DISTKEY,
+    artist_id           TEXT        NOT NULL,
+    plays               BIGINT      NOT NULL
+)
+""")
+
+artist_plays_weekly_table_create = ("""
+CREATE TABLE IF NOT EXISTS agg_artist_plays_weekly
+(
+    week_start          BIGINT      NOT NULL    SORTKEY,
+    artist_id           TEXT        NOT NULL    DISTKEY,
+    plays               BIGINT      NOT NULL
+)
+""")
+
+daily_active_users_table_create = ("""
+CREATE TABLE IF NOT EXISTS agg_daily_active_users
+(
+    day_start           BIGINT      NOT NULL    SORTKEY,
+    level               VARCHAR(5)  NOT NULL,
+    active_users        INTEGER     NOT NULL
+)
+DISTSTYLE ALL
+""")
+
+etl_watermarks_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_watermarks
+(
+    source              VARCHAR(32) PRIMARY KEY,
+    watermark           BIGINT      NOT NULL,
+    updated_at          TIMESTAMP   NOT NULL
+)
+""")
+
+etl_loaded_objects_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_loaded_objects
+(
+    source              VARCHAR(32) NOT NULL,
+    object_key          TEXT        NOT NULL,
+    loaded_at           TIMESTAMP   NOT NULL
+)
 """)
 
 # STAGING TABLES
 
-staging_events_copy = ("""
-COPY staging_events 
-FROM {}
+# The COPY statements name the role and the source data from dwh.cfg, so they are rendered on first use by
+# copy_queries rather than when this module is imported. They are also available as module attributes,
+# e.g. sql_queries.staging_events_copy.
+CopyQueries = collections.namedtuple('CopyQueries', [
+    'staging_events_copy', 'staging_songs_copy', 'staging_events_manifest_copy', 'staging_songs_manifest_copy',
+    'staging_events_parquet_copy', 'staging_songs_parquet_copy', 'staging_events_clean_copy',
+    'staging_events_compact_copy', 'staging_songs_compact_copy', 'calendar_copy'])
+
+# The rendered COPY statements of each (role ARN, S3 settings).
+rendered_copy_queries = {}
+
+
+def render_copy_queries(role_arn, s3):
+    """Renders the COPY statements.
+
+    Parameters:
+        role_arn(str): The ARN of the role the cluster reads S3 with.
+        s3(S3Settings): The source data and its region.
+
+    Returns:
+        CopyQueries: The statements.
+    """
+    staging_events_copy = ("""
+COPY staging_events ({})
+FROM '{}'
+credentials 'aws_iam_role={}'
+json '{}' region '{}';
+""").format(STAGING_EVENTS_COLUMNS, s3.log_data, role_arn, s3.log_jsonpath, s3.region)
+
+    staging_songs_copy = ("""
+COPY staging_songs ({})
+FROM '{}'
+credentials 'aws_iam_role={}'
+json 'auto' region '{}';
+""").format(STAGING_SONGS_COLUMNS, s3.song_data, role_arn, s3.region)
+
+    staging_events_manifest_copy = ("""
+COPY staging_events ({})
+FROM %s
+credentials 'aws_iam_role={}'
+json '{}' region '{}'
+manifest;
+""").format(STAGING_EVENTS_COLUMNS, role_arn, s3.log_jsonpath, s3.region)
+
+    staging_songs_manifest_copy = ("""
+COPY staging_songs ({})
+FROM %s
+credentials 'aws_iam_role={}'
+json 'auto' region '{}'
+manifest;
+""").format(STAGING_SONGS_COLUMNS, role_arn, s3.region)
+
+    staging_events_parquet_copy = ("""
+COPY staging_events ({})
+FROM %s
 credentials 'aws_iam_role={}'
-json 's3://udacity-dend/log_json_path.json' region 'us-west-2';
-""").format("'s3://udacity-dend/log_data'", DWH_ROLE_ARN)
+FORMAT AS PARQUET;
+""").format(STAGING_EVENTS_COLUMNS, role_arn)
 
-staging_songs_copy = ("""
-COPY staging_songs 
-FROM {}
+    staging_songs_parquet_copy = ("""
+COPY staging_songs ({})
+FROM %s
 credentials 'aws_iam_role={}'
-json 'auto' region 'us-west-2';
-""").format("'s3://udacity-dend/song_data'", DWH_ROLE_ARN)
+FORMAT AS PARQUET;
+""").format(STAGING_SONGS_COLUMNS, role_arn)
+
+    staging_events_clean_copy = ("""
+COPY staging_events ({})
+FROM %s
+credentials 'aws_iam_role={}'
+json '{}' region '{}'
+GZIP;
+""").format(STAGING_EVENTS_COLUMNS, role_arn, s3.log_jsonpath, s3.region)
+
+    staging_events_compact_copy = ("""
+COPY staging_events ({})
+FROM %s
+credentials 'aws_iam_role={}'
+json '{}' region '{}'
+manifest GZIP;
+""").format(STAGING_EVENTS_COLUMNS, role_arn, s3.log_jsonpath, s3.region)
+
+    staging_songs_compact_copy = ("""
+COPY staging_songs ({})
+FROM %s
+credentials 'aws_iam_role={}'
+json 'auto' region '{}'
+manifest GZIP;
+""").format(STAGING_SONGS_COLUMNS, role_arn, s3.region)
+
+    calendar_copy = ("""
+COPY dim_calendar
+FROM %s
+credentials 'aws_iam_role={}'
+CSV GZIP;
+""").format(role_arn)
+
+    return CopyQueries(staging_events_copy, staging_songs_copy, staging_events_manifest_copy,
+                       staging_songs_manifest_copy, staging_events_parquet_copy, staging_songs_parquet_copy,
+                       staging_events_clean_copy, staging_events_compact_copy, staging_songs_compact_copy,
+                       calendar_copy)
+
+
+def copy_queries(path=DEFAULT_CONFIG):
+    """Returns the COPY statements for the settings in dwh.cfg, rendering them once per version of the file.
+
+    Parameters:
+        path(str): The path of dwh.cfg.
+
+    Returns:
+        CopyQueries: The statements.
+    """
+    settings = load_settings(path)
+    if settings not in rendered_copy_queries:
+        rendered_copy_queries[settings] = render_copy_queries(settings.role_arn, settings.s3)
+    return rendered_copy_queries[settings]
+
+
+# The contiguous runs of calendar_id already in dim_calendar between two keys, so that only the gaps are generated.
+calendar_covered_ranges = ("""
+SELECT MIN(calendar_id), MAX(calendar_id)
+FROM (
+    SELECT calendar_id, calendar_id - ROW_NUMBER() OVER (ORDER BY calendar_id) AS run
+    FROM dim_calendar
+    WHERE calendar_id BETWEEN %s AND %s
+) ids
+GROUP BY run
+ORDER BY 1
+""")
+
+# The normalized (title, artist name, duration) of a song hashed to an integer, so that events resolve to
+# songs with an integer equi-join instead of joining on free text.
+SONG_KEY = "FNV_HASH(LOWER(TRIM({title})) || '|' || LOWER(TRIM({artist})) || '|' || CAST(ROUND({duration}) AS VARCHAR))"
+EVENTS_SONG_KEY = SONG_KEY.format(title='song', artist='artist', duration='length')
+EVENTS_SONG_KEY_CONDITION = "song IS NOT NULL AND artist IS NOT NULL AND length IS NOT NULL"
+SONGS_SONG_KEY = SONG_KEY.format(title='title', artist='artist_name', duration='duration')
+# A column of a dimension row differs from the merged row. <> alone is NULL, and so false, when either side is
+# NULL; here a NULL differs from a value and equals another NULL.
+COLUMN_CHANGED = "({table}.{column} <> {merge}.{column} OR ({table}.{column} IS NULL) <> ({merge}.{column} IS NULL))"
+
+
+def columns_changed(table, merge, columns):
+    """Builds the condition that a dimension row differs from the merged row in any of the columns.
+
+    Parameters:
+        table(str): The dimension table.
+        merge(str): The table of merged rows.
+        columns(list of str): The columns to compare.
+
+    Returns:
+        str: The SQL condition.
+    """
+    return "\n         OR ".join(COLUMN_CHANGED.format(table=table, merge=merge, column=column) for column in columns)
+
+
+staging_events_song_key_update = ("""
+UPDATE staging_events
+SET song_key = {}
+WHERE {}
+""").format(EVENTS_SONG_KEY, EVENTS_SONG_KEY_CONDITION)
+
+staging_songs_song_key_update = ("""
+UPDATE staging_songs
+SET song_key = {}
+""").format(SONGS_SONG_KEY)
+
+# Songs loaded before dim_songs had a song_key, or by a migration that added the column, have none, and the
+# incremental songplay insert would never resolve an event to them. Their key is derived from the stored title,
+# duration and artist name.
+dim_songs_song_key_backfill = ("""
+UPDATE dim_songs
+SET song_key = {}
+FROM dim_artists
+WHERE dim_artists.artist_id = dim_songs.artist_id AND dim_songs.song_key IS NULL
+""").format(SONG_KEY.format(title='dim_songs.title', artist='dim_artists.name', duration='dim_songs.duration'))
+
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
 
 # FINAL TABLES
 
 songplay_table_insert = ("""
 INSERT INTO fact_songplays (songplay_id, start_time, user_id, song_id, artist_id, session_id, user_agent, level, location)
 SELECT 
-    sessionid || '-' || iteminsession AS songplay_id,
-    ts AS start_time,
-    userId AS user_id,
-    song AS song_id,
-    artist AS artist_id,
-    sessionId AS session_id,
-    userAgent AS user_agent,
-    level AS level,
-    location AS location
+    staging_events.sessionid || '-' || staging_events.iteminsession AS songplay_id,
+    staging_events.ts AS start_time,
+    staging_events.userId AS user_id,
+    songs.song_id AS song_id,
+    songs.artist_id AS artist_id,
+    staging_events.sessionId AS session_id,
+    staging_events.userAgent AS user_agent,
+    staging_events.level AS level,
+    staging_events.location AS location
 FROM staging_events
-WHERE userid IS NOT NULL AND song IS NOT NULL AND artist IS NOT NULL AND location IS NOT NULL
+JOIN (
+    SELECT
+        song_key,
+        song_id,
+        artist_id,
+        ROW_NUMBER() OVER (PARTITION BY song_key ORDER BY song_id) AS row_number
+    FROM staging_songs
+) songs ON songs.song_key = staging_events.song_key AND songs.row_number = 1
+WHERE staging_events.userid IS NOT NULL AND staging_events.location IS NOT NULL
 """)
 
 user_table_insert = ("""
+DROP TABLE IF EXISTS merge_dim_users;
+
+CREATE TEMP TABLE merge_dim_users AS
+SELECT user_id, first_name, last_name, gender, level
+FROM (
+    SELECT
+        userId AS user_id,
+        firstName AS first_name,
+        lastName AS last_name,
+        gender AS gender,
+        level AS level,
+        ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS row_number
+    FROM staging_events
+    WHERE userid IS NOT NULL
+) latest
+WHERE row_number = 1;
+
+DELETE FROM dim_users
+USING merge_dim_users
+WHERE dim_users.user_id = merge_dim_users.user_id
+    AND ({}
+         OR dim_users.user_id IN (SELECT user_id FROM dim_users GROUP BY user_id HAVING COUNT(*) > 1));
+
 INSERT INTO dim_users (user_id, first_name, last_name, gender, level)
-SELECT
-    DISTINCT(userId) AS user_id,
-    firstName AS first_name,
-    lastName AS last_name,
-    gender AS gender,
-    level AS level
-FROM staging_events
-WHERE userid IS NOT NULL
-""")
+SELECT user_id, first_name, last_name, gender, level
+FROM merge_dim_users
+WHERE NOT EXISTS (SELECT 1 FROM dim_users WHERE dim_users.user_id = merge_dim_users.user_id);
+""").format(columns_changed('dim_users', 'merge_dim_users', ['first_name', 'last_name', 'gender', 'level']))
 
 song_table_insert = ("""
-INSERT INTO dim_songs (song_id, title, artist_id, year, duration)
-SELECT
-    DISTINCT(song_id) AS song_id,
-    title AS title,
-    artist_id AS artist_id,
-    year AS year,
-    duration AS duration
-FROM staging_songs
-""")
+DROP TABLE IF EXISTS merge_dim_songs;
+
+CREATE TEMP TABLE merge_dim_songs AS
+SELECT song_id, title, artist_id, year, duration, song_key
+FROM (
+    SELECT
+        song_id AS song_id,
+        title AS title,
+        artist_id AS artist_id,
+        year AS year,
+        duration AS duration,
+        song_key AS song_key,
+        ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC, duration DESC) AS row_number
+    FROM staging_songs
+) latest
+WHERE row_number = 1;
+
+DELETE FROM dim_songs
+USING merge_dim_songs
+WHERE dim_songs.song_id = merge_dim_songs.song_id
+    AND ({}
+         OR dim_songs.song_id IN (SELECT song_id FROM dim_songs GROUP BY song_id HAVING COUNT(*) > 1));
+
+INSERT INTO dim_songs (song_id, title, artist_id, year, duration, song_key)
+SELECT song_id, title, artist_id, year, duration, song_key
+FROM merge_dim_songs
+WHERE NOT EXISTS (SELECT 1 FROM dim_songs WHERE dim_songs.song_id = merge_dim_songs.song_id);
+""").format(columns_changed('dim_songs', 'merge_dim_songs', ['title', 'artist_id', 'year', 'duration', 'song_key']))
 
 artist_table_insert = ("""
+DROP TABLE IF EXISTS merge_dim_artists;
+
+CREATE TEMP TABLE merge_dim_artists AS
+SELECT artist_id, name, location, latitude, longitude
+FROM (
+    SELECT
+        artist_id AS artist_id,
+        artist_name AS name,
+        artist_location AS location,
+        artist_latitude AS latitude,
+        artist_longitude AS longitude,
+        ROW_NUMBER() OVER (PARTITION BY artist_id
+                           ORDER BY artist_location, artist_latitude, artist_longitude, artist_name) AS row_number
+    FROM staging_songs
+) latest
+WHERE row_number = 1;
+
+DELETE FROM dim_artists
+USING merge_dim_artists
+WHERE dim_artists.artist_id = merge_dim_artists.artist_id
+    AND ({}
+         OR dim_artists.artist_id IN (SELECT artist_id FROM dim_artists GROUP BY artist_id HAVING COUNT(*) > 1));
+
 INSERT INTO dim_artists (artist_id, name, location, latitude, longitude)
-SELECT
-    DISTINCT(artist_id) AS artist_id,
-    artist_name AS name,
-    artist_location AS location,
-    artist_latitude AS latitude,
-    artist_longitude AS longitude
-FROM staging_songs
+SELECT artist_id, name, location, latitude, longitude
+FROM merge_dim_artists
+WHERE NOT EXISTS (SELECT 1 FROM dim_artists WHERE dim_artists.artist_id = merge_dim_artists.artist_id);
+""").format(columns_changed('dim_artists', 'merge_dim_artists', ['name', 'location', 'latitude', 'longitude']))
+
+# Merges before duplicate keys were collapsed could leave a key with several rows. The rows of each duplicated
+# key are replaced by one of them, so that this only rewrites the duplicated keys.
+DIM_DEDUPE = ("""
+DROP TABLE IF EXISTS dedupe_{table};
+
+CREATE TEMP TABLE dedupe_{table} AS
+SELECT {columns}
+FROM (
+    SELECT {columns}, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY {columns}) AS row_number
+    FROM {table}
+    WHERE {key} IN (SELECT {key} FROM {table} GROUP BY {key} HAVING COUNT(*) > 1)
+) duplicated
+WHERE row_number = 1;
+
+DELETE FROM {table}
+USING dedupe_{table}
+WHERE {table}.{key} = dedupe_{table}.{key};
+
+INSERT INTO {table} ({columns})
+SELECT {columns}
+FROM dedupe_{table};
 """)
+user_table_dedupe = DIM_DEDUPE.format(table='dim_users', key='user_id',
+                                      columns='user_id, first_name, last_name, gender, level')
+song_table_dedupe = DIM_DEDUPE.format(table='dim_songs', key='song_id',
+                                      columns='song_id, title, artist_id, year, duration, song_key')
+artist_table_dedupe = DIM_DEDUPE.format(table='dim_artists', key='artist_id',
+                                        columns='artist_id, name, location, latitude, longitude')
 
 time_table_insert = ("""
 INSERT INTO dim_times (start_time, hour, day, week, month, year, weekday)
 SELECT
-    DISTINCT(ts) as start_time,
-    EXTRACT(hour from timestamp 'epoch' + ts/1000 * interval '1 second') as hour,
-    EXTRACT(day from timestamp 'epoch' + ts/1000 * interval '1 second') as day,
-    EXTRACT(week from timestamp 'epoch' + ts/1000 * interval '1 second') as week,
-    EXTRACT(month from timestamp 'epoch' + ts/1000 * interval '1 second') as month,
-    EXTRACT(year from timestamp 'epoch' + ts/1000 * interval '1 second') as year,
-    EXTRACT(weekday from timestamp 'epoch' + ts/1000 * interval '1 second') as weekday
+    start_time,
+    EXTRACT(hour from start_ts) AS hour,
+    EXTRACT(day from start_ts) AS day,
+    EXTRACT(week from start_ts) AS week,
+    EXTRACT(month from start_ts) AS month,
+    EXTRACT(year from start_ts) AS year,
+    EXTRACT(weekday from start_ts) AS weekday
+FROM (
+    SELECT
+        start_time,
+        timestamp 'epoch' + start_time/1000 * interval '1 second' AS start_ts
+    FROM (
+        SELECT DISTINCT ts AS start_time
+        FROM staging_events
+        WHERE ts > (SELECT COALESCE(MAX(start_time), 0) FROM dim_times)
+    ) new_times
+) times
+""")
+
+# INCREMENTAL LOADS
+
+# Only the new songs are staged in an incremental run, so events resolve against dim_songs instead. A full load
+# records no watermark or loaded objects, so the first incremental run after it stages every object again; the
+# songplays it already inserted are skipped by their id.
+songplay_incremental_insert = ("""
+INSERT INTO fact_songplays (songplay_id, start_time, user_id, song_id, artist_id, session_id, user_agent, level, location)
+SELECT 
+    staging_events.sessionid || '-' || staging_events.iteminsession AS songplay_id,
+    staging_events.ts AS start_time,
+    staging_events.userId AS user_id,
+    songs.song_id AS song_id,
+    songs.artist_id AS artist_id,
+    staging_events.sessionId AS session_id,
+    staging_events.userAgent AS user_agent,
+    staging_events.level AS level,
+    staging_events.location AS location
 FROM staging_events
+JOIN (
+    SELECT
+        song_key,
+        song_id,
+        artist_id,
+        ROW_NUMBER() OVER (PARTITION BY song_key ORDER BY song_id) AS row_number
+    FROM dim_songs
+) songs ON songs.song_key = staging_events.song_key AND songs.row_number = 1
+WHERE staging_events.userid IS NOT NULL AND staging_events.location IS NOT NULL
+    AND staging_events.ts > %s
+    AND NOT EXISTS (SELECT 1 FROM fact_songplays
+                    WHERE fact_songplays.songplay_id = staging_events.sessionid || '-' || staging_events.iteminsession)
+""")
+
+staging_events_ts_range = "SELECT MIN(ts), MAX(ts) FROM staging_events"
+
+# STREAMING LOADS
+# The stream ingest stages into TEMP tables of the same names, created once per connection. They shadow the shared
+# staging tables in its own session only, so its micro-batches and an etl.py run never truncate or load each
+# other's rows.
+
+staging_events_temp_create = "CREATE TEMP TABLE staging_events AS SELECT * FROM staging_events WHERE 1 = 0"
+staging_songs_temp_create = "CREATE TEMP TABLE staging_songs AS SELECT * FROM staging_songs WHERE 1 = 0"
+
+# Events can arrive late, after a later micro-batch has already loaded, so the stream takes every staged event the
+# fact table does not hold yet, whatever its time. Events sent twice are deduplicated on the songplay id.
+songplay_stream_insert = ("""
+INSERT INTO fact_songplays (songplay_id, start_time, user_id, song_id, artist_id, session_id, user_agent, level, location)
+SELECT
+    events.songplay_id AS songplay_id,
+    events.ts AS start_time,
+    events.userId AS user_id,
+    songs.song_id AS song_id,
+    songs.artist_id AS artist_id,
+    events.sessionId AS session_id,
+    events.userAgent AS user_agent,
+    events.level AS level,
+    events.location AS location
+FROM (
+    SELECT
+        sessionid || '-' || iteminsession AS songplay_id,
+        ts,
+        userId,
+        sessionId,
+        userAgent,
+        level,
+        location,
+        song_key,
+        ROW_NUMBER() OVER (PARTITION BY sessionid, iteminsession ORDER BY ts) AS row_number
+    FROM staging_events
+    WHERE userid IS NOT NULL AND location IS NOT NULL
+) events
+JOIN (
+    SELECT
+        song_key,
+        song_id,
+        artist_id,
+        ROW_NUMBER() OVER (PARTITION BY song_key ORDER BY song_id) AS row_number
+    FROM dim_songs
+) songs ON songs.song_key = events.song_key AND songs.row_number = 1
+WHERE events.row_number = 1
+    AND NOT EXISTS (SELECT 1 FROM fact_songplays WHERE fact_songplays.songplay_id = events.songplay_id)
+""")
+
+time_stream_insert = ("""
+INSERT INTO dim_times (start_time, hour, day, week, month, year, weekday)
+SELECT
+    start_time,
+    EXTRACT(hour from start_ts) AS hour,
+    EXTRACT(day from start_ts) AS day,
+    EXTRACT(week from start_ts) AS week,
+    EXTRACT(month from start_ts) AS month,
+    EXTRACT(year from start_ts) AS year,
+    EXTRACT(weekday from start_ts) AS weekday
+FROM (
+    SELECT
+        start_time,
+        timestamp 'epoch' + start_time/1000 * interval '1 second' AS start_ts
+    FROM (
+        SELECT DISTINCT ts AS start_time
+        FROM staging_events
+        WHERE NOT EXISTS (SELECT 1 FROM dim_times WHERE dim_times.start_time = staging_events.ts)
+    ) new_times
+) times
+""")
+
+# Taken first by every transaction that merges into the warehouse tables, so that concurrent loads, e.g. etl.py
+# --incremental and the stream ingest, wait for each other rather than fail with serializable isolation errors.
+# Only loaders read etl_watermarks, so queries of the warehouse tables are never blocked by it.
+load_lock = "LOCK etl_watermarks"
+
+watermark_select = "SELECT watermark FROM etl_watermarks WHERE source = %s"
+watermark_delete = "DELETE FROM etl_watermarks WHERE source = %s"
+watermark_insert = "INSERT INTO etl_watermarks (source, watermark, updated_at) VALUES (%s, %s, %s)"
+
+loaded_objects_select = "SELECT object_key FROM etl_loaded_objects WHERE source = %s"
+# One statement inserts many objects, formatted with a (%s, %s, %s) row for each of them.
+loaded_objects_insert = "INSERT INTO etl_loaded_objects (source, object_key, loaded_at) VALUES {}"
+
+# ROLLUPS
+# Refreshed after every load from the first start time the load may have inserted, rather than from a watermark,
+# as the stream ingest and etl.py load overlapping and late periods. The hours from the hour of that start time on
+# are rebuilt from the fact table, the days and weeks from the small hourly rollup, and the active users, which
+# cannot be summed, from the fact table again. Without a start time the rollups are rebuilt from the first play.
+
+rollup_refresh_start = ("""
+DROP TABLE IF EXISTS rollup_refresh_start;
+
+CREATE TEMP TABLE rollup_refresh_start AS
+SELECT COALESCE(CAST(%s AS BIGINT), MIN(start_time)) AS start_time
+FROM fact_songplays;
+""")
+
+song_plays_hourly_refresh = ("""
+DELETE FROM agg_song_plays_hourly
+WHERE hour_start >= (SELECT start_time - start_time % 3600000 FROM rollup_refresh_start);
+
+INSERT INTO agg_song_plays_hourly (hour_start, song_id, artist_id, plays)
+SELECT
+    start_time - start_time % 3600000 AS hour_start,
+    song_id,
+    artist_id,
+    COUNT(*) AS plays
+FROM fact_songplays
+WHERE start_time >= (SELECT start_time - start_time % 3600000 FROM rollup_refresh_start)
+GROUP BY 1, 2, 3;
+""")
+
+song_plays_daily_refresh = ("""
+DELETE FROM agg_song_plays_daily
+WHERE day_start >= (SELECT start_time - start_time % 86400000 FROM rollup_refresh_start);
+
+INSERT INTO agg_song_plays_daily (day_start, song_id, artist_id, plays)
+SELECT
+    hour_start - hour_start % 86400000 AS day_start,
+    song_id,
+    artist_id,
+    SUM(plays) AS plays
+FROM agg_song_plays_hourly
+WHERE hour_start >= (SELECT start_time - start_time % 86400000 FROM rollup_refresh_start)
+GROUP BY 1, 2, 3;
+""")
+
+# The epoch fell on a Thursday, so weeks start 3 days (259200000 ms) before a multiple of 7 days.
+artist_plays_weekly_refresh = ("""
+DELETE FROM agg_artist_plays_weekly
+WHERE week_start >= (SELECT start_time - (start_time + 259200000) % 604800000 FROM rollup_refresh_start);
+
+INSERT INTO agg_artist_plays_weekly (week_start, artist_id, plays)
+SELECT
+    hour_start - (hour_start + 259200000) % 604800000 AS week_start,
+    artist_id,
+    SUM(plays) AS plays
+FROM agg_song_plays_hourly
+WHERE hour_start >= (SELECT start_time - (start_time + 259200000) % 604800000 FROM rollup_refresh_start)
+GROUP BY 1, 2;
+""")
+
+daily_active_users_refresh = ("""
+DELETE FROM agg_daily_active_users
+WHERE day_start >= (SELECT start_time - start_time % 86400000 FROM rollup_refresh_start);
+
+INSERT INTO agg_daily_active_users (day_start, level, active_users)
+SELECT
+    start_time - start_time % 86400000 AS day_start,
+    level,
+    COUNT(DISTINCT user_id) AS active_users
+FROM fact_songplays
+WHERE start_time >= (SELECT start_time - start_time % 86400000 FROM rollup_refresh_start)
+GROUP BY 1, 2;
 """)
 
 # QUERY LISTS
@@ -208,7 +752,14 @@ create_table_queries = [staging_events_table_create,
                         user_table_create,
                         song_table_create,
                         artist_table_create,
-                        time_table_create]
+                        time_table_create,
+                        calendar_table_create,
+                        song_plays_hourly_table_create,
+                        song_plays_daily_table_create,
+                        artist_plays_weekly_table_create,
+                        daily_active_users_table_create,
+                        etl_watermarks_table_create,
+                        etl_loaded_objects_table_create]
 
 drop_table_queries = [staging_events_table_drop,
                       staging_songs_table_drop,
@@ -216,13 +767,153 @@ drop_table_queries = [staging_events_table_drop,
                       user_table_drop,
                       song_table_drop,
                       artist_table_drop,
-                      time_table_drop]
+                      time_table_drop,
+                      calendar_table_drop,
+                      song_plays_hourly_table_drop,
+                      song_plays_daily_table_drop,
+                      artist_plays_weekly_table_drop,
+                      daily_active_users_table_drop,
+                      etl_watermarks_table_drop,
+                      etl_loaded_objects_table_drop]
 
-copy_table_queries = [staging_events_copy,
-                      staging_songs_copy]
+song_key_update_queries = [staging_events_song_key_update,
+                           staging_songs_song_key_update,
+                           dim_songs_song_key_backfill]
 
 insert_table_queries = [songplay_table_insert,
                         user_table_insert,
                         song_table_insert,
                         artist_table_insert,
                         time_table_insert]
+
+dim_dedupe_queries = [user_table_dedupe,
+                      song_table_dedupe,
+                      artist_table_dedupe]
+
+rollup_refresh_queries = [song_plays_hourly_refresh,
+                          song_plays_daily_refresh,
+                          artist_plays_weekly_refresh,
+                          daily_active_users_refresh]
+
+# CATALOG
+
+catalog_columns_select = ("""
+SELECT table_name, column_name, data_type, character_maximum_length, numeric_precision, numeric_scale
+FROM information_schema.columns
+WHERE table_schema = current_schema()
+ORDER BY table_name, ordinal_position
+""")
+
+catalog_keys_select = ("""
+SELECT def.tablename, def."column", def.distkey, def.sortkey, cls.reldiststyle
+FROM pg_table_def def
+JOIN pg_class cls ON cls.relname = def.tablename
+JOIN pg_namespace nsp ON nsp.oid = cls.relnamespace AND nsp.nspname = def.schemaname
+WHERE def.schemaname = current_schema()
+""")
+
+# SPECTRUM
+# External tables over the Parquet copies of the log and song data, read in place instead of being copied into
+# the staging tables. {schema} is the external schema, {predicate} prunes the log partitions of a run.
+
+spectrum_schema_create = ("""
+CREATE EXTERNAL SCHEMA IF NOT EXISTS {schema}
+FROM DATA CATALOG DATABASE '{database}'
+IAM_ROLE '{role_arn}'
+CREATE EXTERNAL DATABASE IF NOT EXISTS
+""")
+
+spectrum_table_create = ("""
+CREATE EXTERNAL TABLE {schema}.{table}
+(
+{columns}
+)
+{partitioned_by}STORED AS PARQUET
+LOCATION '{location}'
+""")
+
+spectrum_partition_add = ("""
+ALTER TABLE {schema}.{table} ADD IF NOT EXISTS
+PARTITION ({partition}) LOCATION '{location}'
+""")
+
+# Stand in for staging_events and staging_songs in the insert queries, deriving song_key as the updates do.
+spectrum_staging_events_select = ("""(
+    SELECT {columns}, CASE WHEN {condition} THEN {song_key} END AS song_key
+    FROM {{schema}}.staging_events
+    WHERE {{predicate}}
+)""").format(columns=STAGING_EVENTS_COLUMNS, condition=EVENTS_SONG_KEY_CONDITION, song_key=EVENTS_SONG_KEY)
+
+spectrum_staging_events_ts_range = "SELECT MIN(ts), MAX(ts) FROM {schema}.staging_events WHERE {predicate}"
+
+spectrum_staging_songs_select = ("""(
+    SELECT {columns}, {song_key} AS song_key
+    FROM {{schema}}.staging_songs
+)""").format(columns=STAGING_SONGS_COLUMNS, song_key=SONGS_SONG_KEY)
+
+# EXPORTS
+# Feature sets for downstream ML, exported in bulk by export.py with UNLOAD or a streaming cursor.
+
+user_song_plays_export = ("""
+SELECT
+    user_id,
+    song_id,
+    artist_id,
+    COUNT(*) AS plays,
+    MIN(start_time) AS first_played,
+    MAX(start_time) AS last_played
+FROM fact_songplays
+WHERE user_id IS NOT NULL AND song_id IS NOT NULL
+GROUP BY user_id, song_id, artist_id
+""")
+
+export_queries = {'user_song_plays': user_song_plays_export}
+
+# {query} is the SELECT as a quoted literal; every slice writes its own files, so the export runs in parallel.
+unload_query = ("""
+UNLOAD ({query})
+TO '{destination}'
+IAM_ROLE '{role_arn}'
+FORMAT AS PARQUET
+{partition_by}PARALLEL ON
+MAXFILESIZE {max_file_size_mb} MB
+MANIFEST
+""")
+
+# Per-table sort, delete and statistics health, for the post-load maintenance of maintenance.py.
+# unsorted and stats_off are percentages; unsorted is NULL for tables without a sort key.
+table_health_select = ("""
+SELECT "table", size, tbl_rows, estimated_visible_rows, unsorted, stats_off, sortkey1
+FROM svv_table_info
+WHERE schema = current_schema()
+ORDER BY "table"
+""")
+
+# STEP DEPENDENCIES
+# Each step is (name, query, names of the steps whose tables it reads).
+
+song_key_steps = [('staging_events_song_key_update', staging_events_song_key_update, ('staging_events_copy',)),
+                  ('staging_songs_song_key_update', staging_songs_song_key_update, ('staging_songs_copy',)),
+                  ('dim_songs_song_key_backfill', dim_songs_song_key_backfill, ())]
+
+insert_table_steps = [('songplay_table_insert', songplay_table_insert,
+                       ('staging_events_song_key_update', 'staging_songs_song_key_update')),
+                      ('user_table_insert', user_table_insert, ('staging_events_copy',)),
+                      ('song_table_insert', song_table_insert,
+                       ('staging_songs_song_key_update', 'dim_songs_song_key_backfill')),
+                      ('artist_table_insert', artist_table_insert, ('staging_songs_copy',)),
+                      ('time_table_insert', time_table_insert, ('staging_events_copy',))]
+
+
+def __getattr__(name):
+    """Renders the COPY statements, and the lists holding them, when they are first looked up."""
+    if name in CopyQueries._fields:
+        return getattr(copy_queries(), name)
+    if name == 'copy_table_queries':
+        queries = copy_queries()
+        return [queries.staging_events_copy, queries.staging_songs_copy]
+    if name == 'staging_table_steps':
+        queries = copy_queries()
+        return [('staging_events_copy', queries.staging_events_copy, ()),
+                ('staging_songs_copy', queries.staging_songs_copy, ())]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
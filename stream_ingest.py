@@ -0,0 +1,275 @@
+import argparse
+import configparser
+import datetime
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+
+import instrumentation
+import query_cache
+import sql_queries
+from backends import BACKENDS, REDSHIFT, connect, get_object_store
+from etl import find_new_objects, get_loaded_objects, load_staged_delta, stage_objects, update_song_keys
+from sql_queries import (staging_events_temp_create, staging_events_truncate, staging_songs_temp_create,
+                         staging_songs_truncate)
+
+logger = logging.getLogger('dwh.stream')
+
+STREAM_SOURCE = 'stream'
+# How often blocked readers and the batcher wake up to check for shutdown.
+POLL_SECONDS = 0.5
+
+
+class MicroBatchIngest:
+    """Buffers incoming song play events and loads them into the warehouse in micro-batches.
+
+    Readers hand newline-delimited JSON events to offer, which blocks while the bounded queue is full, so a
+    slow warehouse pushes back on the readers instead of growing memory. run drains the queue into a batch
+    until it reaches max_records or max_bytes, or max_seconds have passed since its first event. Each batch is
+    written as one compact JSON object under the stream prefix, then COPYd into staging and loaded with the
+    incremental inserts. The batch object is only marked as loaded in the transaction of its inserts, so
+    objects written before a crash are loaded on the next start.
+
+    The batches are staged in TEMP tables private to the connection and tracked by their own 'stream' watermark,
+    so an etl.py --incremental run can load at the same time; the transactions of both that write the warehouse
+    tables take sql_queries.load_lock first, so they queue instead of failing serialization. Events that arrive
+    after a later batch has loaded are still loaded, as songplays are deduplicated on their id rather than on the
+    watermark.
+    """
+
+    def __init__(self, conn, store, stream_prefix, manifest_prefix, max_records, max_bytes, max_seconds,
+                 queue_size):
+        self.conn = conn
+        self.store = store
+        self.stream_prefix = stream_prefix.rstrip('/')
+        self.manifest_prefix = manifest_prefix
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.batch_count = 0
+        self.staging_created = False
+
+    def offer(self, line):
+        """Queues one event, blocking while the queue is full. Lines that are not JSON objects are dropped.
+
+        Parameters:
+            line(str or bytes): The JSON event.
+        """
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        line = line.strip()
+        if not line:
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            logger.warning("Dropping an event that is not JSON: %s", line[:200])
+            return
+        if not isinstance(record, dict):
+            logger.warning("Dropping an event that is not a JSON object: %s", line[:200])
+            return
+
+        encoded = json.dumps(record, separators=(',', ':'))
+        while not self.stop.is_set():
+            try:
+                self.queue.put(encoded, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        """Loads micro-batches until stop is set, then loads whatever is still queued."""
+        self.recover()
+        batch = []
+        size = 0
+        deadline = None
+        while not (self.stop.is_set() and self.queue.empty()):
+            timeout = POLL_SECONDS if deadline is None else max(0, min(POLL_SECONDS, deadline - time.monotonic()))
+            try:
+                line = self.queue.get(timeout=timeout)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_seconds
+                batch.append(line)
+                size += len(line) + 1
+            except queue.Empty:
+                pass
+            if batch and (len(batch) >= self.max_records or size >= self.max_bytes
+                          or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch, size, deadline = [], 0, None
+        if batch:
+            self.flush(batch)
+
+    def flush(self, batch):
+        """Writes a batch of events as one object and loads it.
+
+        Parameters:
+            batch(list of str): The compact JSON events.
+        """
+        now = datetime.datetime.utcnow()
+        uri = "{}/{:%Y/%m/%d}/batch-{:%Y%m%dT%H%M%S%f}-{}.json".format(self.stream_prefix, now, now,
+                                                                      self.batch_count)
+        self.batch_count += 1
+        self.store.put_object(uri, ("\n".join(batch) + "\n").encode('utf-8'))
+        start = time.perf_counter()
+        self.load([uri])
+        logger.info("Loaded %d events from %s in %.2fs, %d queued", len(batch), uri,
+                    time.perf_counter() - start, self.queue.qsize())
+
+    def recover(self):
+        """Loads the batch objects written by a previous run that never committed."""
+        cur = self.conn.cursor()
+        pending = find_new_objects(self.store, self.stream_prefix, get_loaded_objects(cur, STREAM_SOURCE))
+        if pending:
+            logger.info("Loading %d batch objects left by a previous run", len(pending))
+            self.load(pending)
+
+    def load(self, uris):
+        """Stages batch objects and loads them into the warehouse tables.
+
+        Parameters:
+            uris(list of str): The uris of the batch objects.
+        """
+        cur = self.conn.cursor()
+        try:
+            if not self.staging_created:
+                instrumentation.execute(cur, staging_events_temp_create)
+                instrumentation.execute(cur, staging_songs_temp_create)
+            instrumentation.execute(cur, staging_events_truncate)
+            instrumentation.execute(cur, staging_songs_truncate)
+            self.conn.commit()
+            self.staging_created = True
+            stage_objects(cur, self.store, STREAM_SOURCE, uris, self.manifest_prefix,
+                          sql_queries.staging_events_manifest_copy)
+            self.conn.commit()
+            update_song_keys(cur, self.conn)
+            load_staged_delta(cur, self.conn, {STREAM_SOURCE: uris}, watermark_source=STREAM_SOURCE,
+                              late_events=True)
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+def tail_file(path, ingest, from_start=False):
+    """Follows a newline-delimited JSON file like tail -F, offering every complete line to the ingest.
+
+    The file is reopened from its start when it is rotated or truncated.
+
+    Parameters:
+        path(str): The file to follow.
+        ingest(MicroBatchIngest): The ingest to offer the events to.
+        from_start(bool): Whether to read the lines already in the file, rather than only new ones.
+    """
+    handle = None
+    partial = b''
+    while not ingest.stop.is_set():
+        if handle is None:
+            try:
+                handle = open(path, 'rb')
+            except FileNotFoundError:
+                ingest.stop.wait(POLL_SECONDS)
+                continue
+            if not from_start:
+                handle.seek(0, os.SEEK_END)
+            # Files that appear after a rotation are new, so they are read from the start.
+            from_start = True
+            partial = b''
+
+        chunk = handle.readline()
+        if chunk:
+            if chunk.endswith(b'\n'):
+                ingest.offer(partial + chunk)
+                partial = b''
+            else:
+                partial += chunk
+            continue
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != os.fstat(handle.fileno()).st_ino or stat.st_size < handle.tell():
+            handle.close()
+            handle = None
+            continue
+        ingest.stop.wait(POLL_SECONDS)
+    if handle is not None:
+        handle.close()
+
+
+class EventHandler(socketserver.StreamRequestHandler):
+    """Reads newline-delimited JSON events from a TCP connection. A full queue stops reading the socket."""
+
+    def handle(self):
+        for line in self.rfile:
+            if self.server.ingest.stop.is_set():
+                break
+            self.server.ingest.offer(line)
+
+
+class EventServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, ingest):
+        super().__init__(address, EventHandler)
+        self.ingest = ingest
+
+
+def main():
+    """The main function for stream_ingest.py.
+
+    Runs until interrupted, loading song play events that are appended to a file or sent to a TCP port in
+    micro-batches sized by the [STREAM] section of dwh.cfg. Queued events are loaded before it exits.
+    """
+    parser = argparse.ArgumentParser(description="Continuously load song play events in micro-batches.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--tail', metavar='PATH', help="follow a newline-delimited JSON event file")
+    source.add_argument('--listen', metavar='PORT', type=int,
+                        help="accept newline-delimited JSON events on this TCP port")
+    parser.add_argument('--host', default='127.0.0.1', help="the address to listen on with --listen")
+    parser.add_argument('--from-start', action='store_true', help="with --tail, also load the existing lines")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to run against: the Redshift cluster or the local DuckDB engine")
+    args = parser.parse_args()
+    instrumentation.configure(capture_query_ids=args.backend == REDSHIFT)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    query_cache.configure(config.get('CACHE', 'DIRECTORY', fallback=None))
+    stream = config['STREAM']
+    conn = connect(config, args.backend)
+    ingest = MicroBatchIngest(conn, get_object_store(config, args.backend), stream['PREFIX'].strip("'"),
+                              config['ETL']['MANIFEST_PREFIX'].strip("'"), stream.getint('MAX_BATCH_RECORDS'),
+                              stream.getint('MAX_BATCH_BYTES'), stream.getfloat('MAX_BATCH_SECONDS'),
+                              stream.getint('QUEUE_SIZE'))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: ingest.stop.set())
+
+    server = None
+    if args.tail:
+        reader = threading.Thread(target=tail_file, args=(args.tail, ingest, args.from_start), daemon=True)
+    else:
+        server = EventServer((args.host, args.listen), ingest)
+        reader = threading.Thread(target=server.serve_forever, args=(POLL_SECONDS,), daemon=True)
+    reader.start()
+
+    try:
+        ingest.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import configparser
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOG_KEYS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+            'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+SONG_COUNT = 20
+EVENTS_PER_DAY = 30
+# Every ninth event has no user and is not a song play.
+PLAYS_PER_DAY = EVENTS_PER_DAY - len(range(0, EVENTS_PER_DAY, 9))
+COUNTED_TABLES = ['fact_songplays', 'dim_users', 'dim_songs', 'dim_artists', 'dim_times', 'agg_song_plays_hourly',
+                  'agg_song_plays_daily', 'agg_artist_plays_weekly', 'agg_daily_active_users', 'etl_loaded_objects']
+
+pytest.importorskip('duckdb')
+
+
+def song(index):
+    return {'num_songs': 1, 'artist_id': 'AR{}'.format(index % 7), 'artist_latitude': None,
+            'artist_longitude': None, 'artist_location': 'NY' if index % 2 else '',
+            'artist_name': 'Artist {}'.format(index % 7), 'song_id': 'SO{}'.format(index),
+            'title': 'Song {}'.format(index), 'duration': 200.5 + index, 'year': 2000 + index % 3}
+
+
+def events(day):
+    """Returns the log events of a day of November 2018, one session of EVENTS_PER_DAY song plays."""
+    for item in range(EVENTS_PER_DAY):
+        played = song((day * 7 + item) % SONG_COUNT)
+        yield {'artist': played['artist_name'], 'auth': 'Logged In', 'firstName': 'First', 'gender': 'F',
+               'itemInSession': item, 'lastName': 'Last', 'length': played['duration'],
+               'level': 'paid' if item % 2 else 'free', 'location': 'San Francisco', 'method': 'PUT',
+               'page': 'NextSong', 'registration': 1540919166796.0, 'sessionId': day * 10, 'song': played['title'],
+               'status': 200, 'ts': 1541030400000 + (day - 1) * 86400000 + item * 60000, 'userAgent': 'test',
+               'userId': str(item % 5 + 1) if item % 9 else ''}
+
+
+class Warehouse:
+    """A DuckDB warehouse in a temporary directory, with the source data in its local object store."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        shutil.copy(os.path.join(REPO, 'dwh.cfg'), str(directory))
+        self.config = configparser.ConfigParser()
+        self.config.read(str(directory / 'dwh.cfg'))
+        self.source = directory / self.config['LOCAL']['DATA_ROOT'] / 'udacity-dend'
+        self.write('log_json_path.json', json.dumps({'jsonpaths': ["$['{}']".format(key) for key in LOG_KEYS]}))
+        for index in range(SONG_COUNT):
+            self.write('song_data/{}/A/B/TR{}.json'.format('ABC'[index % 3], index), json.dumps(song(index)))
+
+    def write(self, key, body):
+        path = self.source / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(body)
+
+    def add_log_day(self, day):
+        self.write('log_data/2018/11/2018-11-{:02d}-events.json'.format(day),
+                   ''.join(json.dumps(event) + '\n' for event in events(day)))
+
+    def run(self, script, *args):
+        subprocess.run([sys.executable, os.path.join(REPO, script), '--backend', 'duckdb'] + list(args),
+                       cwd=str(self.directory), check=True, stdout=subprocess.DEVNULL)
+
+    def query(self, sql):
+        import duckdb
+
+        connection = duckdb.connect(str(self.directory / self.config['LOCAL']['DATABASE']), read_only=True)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def counts(self):
+        return {table: self.query("SELECT COUNT(*) FROM {}".format(table))[0][0] for table in COUNTED_TABLES}
+
+
+@pytest.fixture
+def warehouse(tmp_path):
+    warehouse = Warehouse(tmp_path)
+    warehouse.run('create_tables.py')
+    return warehouse
+
+
+def test_repeated_incremental_run_loads_nothing(warehouse):
+    for day in (1, 2):
+        warehouse.add_log_day(day)
+    warehouse.run('etl.py')
+    warehouse.run('etl.py', '--incremental')
+    loaded = warehouse.counts()
+    assert loaded['fact_songplays'] == 2 * PLAYS_PER_DAY
+
+    warehouse.add_log_day(3)
+    warehouse.run('etl.py', '--incremental')
+    loaded = warehouse.counts()
+    assert loaded['fact_songplays'] == 3 * PLAYS_PER_DAY
+
+    warehouse.run('etl.py', '--incremental')
+    assert warehouse.counts() == loaded
+
+
+def test_rollups_match_facts_after_stream_and_incremental_runs(warehouse, monkeypatch):
+    from backends import connect, get_object_store
+    from stream_ingest import MicroBatchIngest
+
+    for day in (1, 2):
+        warehouse.add_log_day(day)
+    warehouse.run('etl.py', '--incremental')
+
+    monkeypatch.chdir(warehouse.directory)
+    config = warehouse.config
+    conn = connect(config, 'duckdb')
+    try:
+        ingest = MicroBatchIngest(conn, get_object_store(config, 'duckdb'), config['STREAM']['PREFIX'].strip("'"),
+                                  config['ETL']['MANIFEST_PREFIX'].strip("'"), 1000, 1 << 20, 1.0, 1000)
+        ingest.flush([json.dumps(event) for event in events(4)])
+    finally:
+        conn.close()
+
+    # Day 3 arrives after the stream has loaded day 4.
+    warehouse.add_log_day(3)
+    warehouse.run('etl.py', '--incremental')
+
+    plays = warehouse.query("SELECT COUNT(*) FROM fact_songplays")[0][0]
+    assert plays == 4 * PLAYS_PER_DAY
+    for rollup in ('agg_song_plays_hourly', 'agg_song_plays_daily', 'agg_artist_plays_weekly'):
+        assert warehouse.query("SELECT SUM(plays) FROM {}".format(rollup))[0][0] == plays
+    active_users = warehouse.query("SELECT day_start, level, active_users FROM agg_daily_active_users")
+    assert sorted(active_users) == sorted(warehouse.query(
+        "SELECT start_time - start_time % 86400000, level, COUNT(DISTINCT user_id) FROM fact_songplays GROUP BY 1, 2"))
@@ -0,0 +1,188 @@
+import argparse
+import configparser
+import datetime
+import gzip
+import io
+
+import instrumentation
+import sql_queries
+from backends import BACKENDS, REDSHIFT, connect, get_object_store
+from parquet_stage import clear_prefix
+from sql_queries import calendar_covered_ranges
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# Length of one dim_calendar row in milliseconds. calendar_id is the number of these since the epoch, so a
+# fact row's key is start_time / GRANULARITIES[granularity] and needs no lookup.
+GRANULARITIES = {'second': 1000, 'minute': 60000}
+
+
+def calendar_id(moment, granularity):
+    """Returns the dim_calendar surrogate key of a moment.
+
+    Parameters:
+        moment(datetime): The moment.
+        granularity(str): 'second' or 'minute'.
+
+    Returns:
+        int: The number of whole granularity steps since the epoch.
+    """
+    return int((moment - EPOCH).total_seconds() * 1000) // GRANULARITIES[granularity]
+
+
+def calendar_rows(first_id, last_id, granularity):
+    """Yields dim_calendar rows with the same hour, day, week, month, year and weekday as EXTRACT on Redshift.
+
+    Parameters:
+        first_id(int): The first calendar_id to generate.
+        last_id(int): The last calendar_id to generate, inclusive.
+        granularity(str): 'second' or 'minute'.
+
+    Yields:
+        tuple: (calendar_id, start_ts, hour, day, week, month, year, weekday).
+    """
+    step = GRANULARITIES[granularity]
+    for key in range(first_id, last_id + 1):
+        moment = EPOCH + datetime.timedelta(milliseconds=key * step)
+        yield (key, moment.strftime('%Y-%m-%d %H:%M:%S'), moment.hour, moment.day, moment.isocalendar()[1],
+               moment.month, moment.year, (moment.weekday() + 1) % 7)
+
+
+def missing_ranges(covered, first_id, last_id):
+    """Returns the ranges of keys from first_id to last_id that are not covered yet, before, between and after
+    the covered ones.
+
+    Parameters:
+        covered(list of tuple): The sorted (first, last) key ranges already in dim_calendar.
+        first_id(int): The first calendar_id needed.
+        last_id(int): The last calendar_id needed, inclusive.
+
+    Returns:
+        list of tuple: The (first, last) key ranges to generate.
+    """
+    missing = []
+    next_id = first_id
+    for covered_first, covered_last in covered:
+        if covered_first > next_id:
+            missing.append((next_id, min(covered_first - 1, last_id)))
+        next_id = max(next_id, covered_last + 1)
+    if next_id <= last_id:
+        missing.append((next_id, last_id))
+    return missing
+
+
+def month_chunks(first_id, last_id, granularity):
+    """Splits a range of keys at month boundaries.
+
+    Parameters:
+        first_id(int): The first calendar_id.
+        last_id(int): The last calendar_id, inclusive.
+        granularity(str): 'second' or 'minute'.
+
+    Yields:
+        tuple: The (first, last) keys of each month in the range.
+    """
+    while first_id <= last_id:
+        moment = EPOCH + datetime.timedelta(milliseconds=first_id * GRANULARITIES[granularity])
+        next_month = datetime.datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1)
+        chunk_last = min(calendar_id(next_month, granularity) - 1, last_id)
+        yield first_id, chunk_last
+        first_id = chunk_last + 1
+
+
+def write_calendar(store, uri, first_id, last_id, granularity):
+    """Writes dim_calendar rows as a gzipped CSV object for COPY.
+
+    The object is compressed as it is generated, so only its compressed bytes are held in memory.
+
+    Parameters:
+        store(object store): The object store to write to.
+        uri(str): The s3:// uri of the CSV object.
+        first_id(int): The first calendar_id to generate.
+        last_id(int): The last calendar_id to generate, inclusive.
+        granularity(str): 'second' or 'minute'.
+
+    Returns:
+        int: The number of rows written.
+    """
+    buffer = io.BytesIO()
+    count = 0
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+        for row in calendar_rows(first_id, last_id, granularity):
+            f.write((','.join(str(value) for value in row) + '\n').encode('utf-8'))
+            count += 1
+    store.put_object(uri, buffer.getvalue())
+    return count
+
+
+def build_calendar(cur, conn, store, prefix, start, end, granularity):
+    """Extends dim_calendar to cover start to end, generating only the rows it does not hold yet.
+
+    The missing keys can lie before, between or after the ranges already loaded. They are written as one gzipped
+    CSV object per month, which bounds the memory a year at second granularity needs, and loaded with a single
+    COPY of their common key prefix.
+
+    Parameters:
+        cur(psycopg2 cursor): The cursor to execute the queries.
+        conn(psycopg2 connection): The connection to the data warehouse.
+        store(object store): The object store to stage the generated rows in.
+        prefix(str): The s3:// prefix to write the generated CSV under.
+        start(datetime): The first moment the calendar must cover.
+        end(datetime): The last moment the calendar must cover.
+        granularity(str): 'second' or 'minute'.
+
+    Returns:
+        int: The number of rows added.
+    """
+    first_id = calendar_id(start, granularity)
+    last_id = calendar_id(end, granularity)
+    if first_id > last_id:
+        return 0
+    instrumentation.execute(cur, calendar_covered_ranges, (first_id, last_id))
+    missing = missing_ranges(cur.fetchall(), first_id, last_id)
+    if not missing:
+        return 0
+
+    batch_prefix = "{}/dim_calendar-{}-{}-".format(prefix.rstrip('/'), first_id, last_id)
+    clear_prefix(store, batch_prefix)
+    count = 0
+    for range_first, range_last in missing:
+        for chunk_first, chunk_last in month_chunks(range_first, range_last, granularity):
+            count += write_calendar(store, "{}{}.csv.gz".format(batch_prefix, chunk_first), chunk_first, chunk_last,
+                                    granularity)
+    instrumentation.execute(cur, sql_queries.calendar_copy, (batch_prefix,))
+    conn.commit()
+    clear_prefix(store, batch_prefix)
+    return count
+
+
+def main():
+    """The main function for time_dimension.py.
+
+    Pre-generates dim_calendar rows at the CALENDAR_GRANULARITY set in the [ETL] section of dwh.cfg for a
+    date range, so that fact_songplays can be joined to it on calendar_id = start_time / granularity.
+    """
+    parser = argparse.ArgumentParser(description="Pre-generate the dim_calendar table for a date range.")
+    parser.add_argument('--start', required=True, type=datetime.date.fromisoformat, help="first day, YYYY-MM-DD")
+    parser.add_argument('--end', required=True, type=datetime.date.fromisoformat, help="last day, YYYY-MM-DD")
+    parser.add_argument('--backend', choices=BACKENDS, default=REDSHIFT,
+                        help="the warehouse to run against: the Redshift cluster or the local DuckDB engine")
+    args = parser.parse_args()
+    instrumentation.configure(capture_query_ids=args.backend == REDSHIFT)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = connect(config, args.backend)
+    cur = conn.cursor()
+
+    start = datetime.datetime.combine(args.start, datetime.time())
+    end = datetime.datetime.combine(args.end, datetime.time(23, 59, 59))
+    count = build_calendar(cur, conn, get_object_store(config, args.backend),
+                           config['ETL']['CALENDAR_PREFIX'].strip("'"), start, end,
+                           config['ETL']['CALENDAR_GRANULARITY'])
+    print("Added {} dim_calendar rows".format(count))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()